@@ -0,0 +1,6 @@
+"""Data layer for the Brazilian e-commerce dashboard."""
+
+from analytics.facts import load_item_facts, load_order_facts
+from analytics.ingest import TABLES, load_table, memory_report
+
+__all__ = ['TABLES', 'load_item_facts', 'load_order_facts', 'load_table', 'memory_report']
@@ -0,0 +1,235 @@
+"""Aggregates behind the dashboard charts.
+
+Aggregates come in two layers. Partial aggregates (``city_stats``,
+``category_counts``, ...) hold plain counts and sums, so they can be added
+together across batches or chunks. The final aggregates that pages display
+(means, top and bottom lists, thresholds) are cheap functions of those
+partials.
+
+Percentiles cannot be added up that way, so :func:`delivery_percentiles`
+works on the order facts themselves, with one sort for every group at once.
+
+Histograms are binned here rather than in the browser: a chart gets one
+count per bin instead of one row per order.
+"""
+
+import numpy as np
+import pandas as pd
+
+DELIVERY_PERCENTILES = [50, 90, 99]
+
+
+def city_stats(order_facts):
+    """Orders, delivery times and reviews per customer city as counts and sums."""
+    grouped = order_facts.groupby('customer_city', observed=True)
+    stats = grouped.agg(
+        order_count=('customer_id', 'size'),
+        delivery_time_sum=('delivery_time', 'sum'),
+        delivery_count=('delivery_time', 'count'),
+        review_count=('review_count', 'sum'),
+        review_score_sum=('review_score_sum', 'sum'),
+    )
+    stats.index = stats.index.astype(object)
+    return stats
+
+
+def category_counts(item_facts):
+    """Ordered items per English product category."""
+    counts = item_facts.groupby('product_category_name_english', observed=True).size()
+    counts.index = counts.index.astype(object)
+    return counts.rename('order_count').to_frame()
+
+
+def payment_type_stats(order_payments):
+    """Number and total value of payments per payment type."""
+    stats = order_payments.groupby('payment_type', observed=True).agg(
+        payment_count=('payment_value', 'size'),
+        payment_value_sum=('payment_value', 'sum'),
+    )
+    stats.index = stats.index.astype(object)
+    return stats
+
+
+def review_score_counts(order_reviews):
+    """Number of reviews per score."""
+    return order_reviews.groupby('review_score').size().rename('count').to_frame()
+
+
+def entity_counts(customers, orders, products):
+    """Distinct customers, orders and products as a one-row frame."""
+    return pd.DataFrame([{
+        'customers': customers['customer_unique_id'].nunique(),
+        'orders': orders['order_id'].nunique(),
+        'products': products['product_id'].nunique(),
+    }])
+
+
+def merge_partials(left, right):
+    """Add two partial aggregates of the same kind, row by row."""
+    merged = left.add(right, fill_value=0)
+    return merged.astype(left.dtypes.to_dict())
+
+
+def top_bottom_cities_by_orders(city_stats, n=15):
+    """The ``n`` cities with the most and the fewest orders.
+
+    The ``position`` column tells the two lists apart.
+    """
+    counts = city_stats['order_count'].sort_values(ascending=False, kind='stable')
+    top = counts.head(n).reset_index().assign(position='top')
+    bottom = counts.tail(n).reset_index().assign(position='bottom')
+    return pd.concat([top, bottom], ignore_index=True)
+
+
+def city_delivery_times(city_stats):
+    """Average delivery time in days per city, slowest first."""
+    delivered = city_stats[city_stats['delivery_count'] > 0]
+    mean = delivered['delivery_time_sum'] / delivered['delivery_count']
+    return mean.rename('delivery_time_days').sort_values(ascending=False, kind='stable').reset_index()
+
+
+def worst_rated_cities(city_stats, min_reviews=5):
+    """Average review score per city with at least ``min_reviews`` reviews, worst first."""
+    rated = city_stats[city_stats['review_count'] >= min_reviews]
+    worst = pd.DataFrame({
+        'city': rated.index,
+        'avg_score': (rated['review_score_sum'] / rated['review_count']).to_numpy(),
+        'review_count': rated['review_count'].to_numpy(),
+    })
+    return worst.sort_values('avg_score', kind='stable', ignore_index=True)
+
+
+def histogram(values, edges):
+    """Number of ``values`` between each pair of consecutive ``edges``.
+
+    Bins include their left edge, and the last one its right edge too, like
+    ``numpy.histogram``; missing values and values outside the edges are not
+    counted. Returns bin_start, bin_end and count.
+    """
+    values = np.asarray(values, dtype='float64')
+    counts, edges = np.histogram(values[~np.isnan(values)], bins=np.asarray(edges, dtype='float64'))
+    return pd.DataFrame({'bin_start': edges[:-1], 'bin_end': edges[1:], 'count': counts})
+
+
+def delivery_time_histogram(order_facts, max_days=180):
+    """Orders delivered within ``max_days`` per whole day of delivery time.
+
+    Each bin is centred on its day, from half a day before to half a day after.
+    """
+    return histogram(order_facts['delivery_time'], np.arange(max_days + 2) - 0.5)
+
+
+def group_percentiles(values, codes, group_count, percentiles):
+    """Percentiles of ``values`` within each group, from a single sort.
+
+    ``codes`` are group numbers from 0 to ``group_count - 1``. Percentiles are
+    interpolated linearly, like pandas' ``quantile``; empty groups get NaN.
+    Returns one array per percentile.
+    """
+    counts = np.bincount(codes, minlength=group_count)
+    # Sort by group, then by value, so each group's values are a sorted run
+    span = values.max() - values.min() + 1 if len(values) else 0
+    if len(values) and span * group_count < 2 ** 62 and np.array_equal(values, np.floor(values)):
+        # Whole numbers such as days: sort one (group, value) integer key instead of an argsort
+        low = values.min()
+        keys = np.sort(codes.astype('int64') * int(span) + (values - low).astype('int64'))
+        ordered = keys % int(span) + low
+    else:
+        ordered = values[np.lexsort((values, codes))]
+    starts = np.cumsum(counts) - counts
+    last = np.maximum(counts - 1, 0)
+    results = []
+    for percentile in percentiles:
+        rank = last * percentile / 100
+        below = np.floor(rank).astype('int64')
+        if len(ordered):
+            low = ordered[np.minimum(starts + below, len(ordered) - 1)]
+            high = ordered[np.minimum(starts + np.minimum(below + 1, last), len(ordered) - 1)]
+            result = low + (high - low) * (rank - below)
+        else:
+            result = np.zeros(group_count)
+        results.append(np.where(counts > 0, result, np.nan))
+    return results
+
+
+def delivery_percentiles(order_facts, by='customer_city', percentiles=DELIVERY_PERCENTILES):
+    """Delivery time percentiles, late rate and order counts per city or state (``by``).
+
+    Per group: orders, delivered orders, the ``p50_days``, ``p90_days``, ...
+    percentiles and mean of their delivery time in days, and ``late_rate``,
+    the share of delivered orders that arrived after their estimated delivery
+    date. Slowest first by the last percentile.
+    """
+    groups = order_facts[by]
+    if isinstance(groups.dtype, pd.CategoricalDtype):
+        codes, labels = groups.cat.codes.to_numpy(), groups.cat.categories
+    else:
+        codes, labels = pd.factorize(groups)
+    days = order_facts['delivery_time'].to_numpy(dtype='float64')
+    located = codes >= 0
+    delivered = located & ~np.isnan(days)
+    delivered_codes = codes[delivered]
+
+    # Late: delivered on a later day than the estimate
+    late = (order_facts['order_delivered_customer_date'].to_numpy().astype('datetime64[D]')
+            > order_facts['order_estimated_delivery_date'].to_numpy().astype('datetime64[D]'))
+    estimated = delivered & order_facts['order_estimated_delivery_date'].notna().to_numpy()
+
+    delivered_count = np.bincount(delivered_codes, minlength=len(labels))
+    stats = pd.DataFrame({
+        by: labels.astype(object),
+        'order_count': np.bincount(codes[located], minlength=len(labels)),
+        'delivered_count': delivered_count,
+    })
+    values = group_percentiles(days[delivered], delivered_codes, len(labels), percentiles)
+    for percentile, value in zip(percentiles, values):
+        stats[f'p{percentile}_days'] = value
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats['mean_days'] = np.bincount(delivered_codes, weights=days[delivered], minlength=len(labels)) / delivered_count
+        stats['late_rate'] = (np.bincount(codes[estimated & late], minlength=len(labels))
+                              / np.bincount(codes[estimated], minlength=len(labels)))
+    stats = stats[stats['order_count'] > 0]
+    return stats.sort_values(f'p{percentiles[-1]}_days', ascending=False, kind='stable', ignore_index=True)
+
+
+def category_order_counts(category_counts):
+    """Ordered items per category, most ordered first."""
+    return category_counts.sort_values('order_count', ascending=False, kind='stable').reset_index()
+
+
+def payment_stats(payment_type_stats):
+    """Payment count and average payment value per payment type, most used first."""
+    stats = payment_type_stats.assign(
+        payment_value_mean=payment_type_stats['payment_value_sum'] / payment_type_stats['payment_count']
+    )
+    return stats.sort_values('payment_count', ascending=False, kind='stable').reset_index()
+
+
+def payment_type_distribution(payment_stats, threshold=1000):
+    """Payment counts of the payment types used more than ``threshold`` times."""
+    counts = payment_stats.set_index('payment_type')['payment_count']
+    return counts[counts > threshold]
+
+
+def average_payment_by_type(payment_stats, exclude=('not_defined',)):
+    """Average payment value per payment type in name order, minus ``exclude``."""
+    means = payment_stats.set_index('payment_type')['payment_value_mean'].sort_index()
+    return means[~means.index.isin(exclude)]
+
+
+def review_score_distribution(review_score_counts):
+    """Number of reviews per score, in score order."""
+    return review_score_counts.sort_index().reset_index()
+
+
+def overview_metrics(entity_counts, review_score_counts, payment_type_stats):
+    """The headline numbers of the Overview page as a one-row frame."""
+    counts = entity_counts.iloc[0]
+    scores = review_score_counts['count']
+    return pd.DataFrame([{
+        'total_customers': counts['customers'],
+        'total_orders': counts['orders'],
+        'total_products': counts['products'],
+        'average_rating': (scores * scores.index).sum() / scores.sum(),
+        'average_order_value': payment_type_stats['payment_value_sum'].sum() / payment_type_stats['payment_count'].sum(),
+    }])
@@ -0,0 +1,315 @@
+"""Local HTTP/JSON API over the dashboard's aggregates.
+
+Run it with ``python -m analytics serve``. Every aggregate of
+:mod:`analytics.store` is available under ``/aggregates/<name>``, and the
+numbers other services ask for most have short paths::
+
+    /overview                          headline metrics of the Overview page
+    /cities/worst-rated?min_reviews=5&limit=10
+    /cities/longest-delivery?limit=10
+    /categories?limit=20
+    /payments
+    /reviews/scores
+    /states/delivery-distances
+    /segments
+    /cohorts
+
+Aggregate parameters (such as ``min_reviews``) are passed in the query
+string, along with ``limit`` and the dashboard's filters: ``state`` and
+``category`` (repeated or comma separated) and ``start``/``end`` dates.
+Responses are JSON arrays of records, as written by ``compute --format json``.
+
+Unfiltered results are read from the aggregate store, like the dashboard
+does; filtered ones are rolled up from one shared :class:`Dataset`, loaded on
+the first filtered request. Encoded responses are kept in a thread-safe LRU
+cache keyed by the data version, path and query, so an append or a replaced
+CSV never serves old numbers. Requests are handled in one thread each.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.parse import parse_qsl, urlsplit
+from urllib.request import urlopen
+
+import numpy as np
+import pandas as pd
+
+from analytics import cube, store
+from analytics.dataset import Dataset
+from analytics.ingest import DATA_DIR, data_version
+
+DEFAULT_PORT = 8600
+DEFAULT_CACHE_SIZE = 256
+
+# Query parameters every aggregate accepts, next to its own
+FILTER_PARAMS = ['state', 'category', 'start', 'end']
+
+# Short paths for the aggregates other services use most
+ROUTES = {
+    '/overview': 'overview_metrics',
+    '/cities/worst-rated': 'worst_rated_cities',
+    '/cities/longest-delivery': 'city_delivery_times',
+    '/categories': 'category_order_counts',
+    '/payments': 'payment_stats',
+    '/reviews/scores': 'review_score_distribution',
+    '/states/delivery-distances': 'state_delivery_distances',
+    '/segments': 'rfm_segments',
+    '/cohorts': 'cohort_retention',
+}
+
+
+class QueryError(ValueError):
+    """A request the API cannot answer; ``status`` is the HTTP status to reply with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class LRUCache:
+    """Thread-safe mapping that keeps the ``maxsize`` most recently used entries."""
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """The value stored under ``key``, marked as most recently used; ``None`` if absent."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        """Store ``value``, evicting the least recently used entries beyond ``maxsize``."""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def peek(self, key):
+        """Like :meth:`get`, without counting a hit or miss or changing the order."""
+        with self._lock:
+            return self._entries.get(key)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+def _value(text):
+    # Numbers and booleans as JSON, anything else as a string, like the CLI's --param
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
+
+
+def parse_query(name, query):
+    """Split a query string into aggregate parameters, filters and a row limit."""
+    defaults = store.AGGREGATES[name].defaults
+    params, limit = {}, None
+    filters = {'state': set(), 'category': set(), 'start': None, 'end': None}
+    for key, text in parse_qsl(query, keep_blank_values=True):
+        if key in defaults:
+            params[key] = _value(text)
+        elif key in ('state', 'category'):
+            filters[key].update(part for part in text.split(',') if part)
+        elif key in ('start', 'end'):
+            try:
+                filters[key] = pd.Timestamp(text).date()
+            except ValueError:
+                raise QueryError(f'{key} must be a date such as 2018-01-31, not {text!r}')
+        elif key == 'limit':
+            if not text.isdigit():
+                raise QueryError(f'limit must be a non-negative integer, not {text!r}')
+            limit = int(text)
+        else:
+            accepted = sorted(defaults) + FILTER_PARAMS + ['limit']
+            raise QueryError(f'Unknown parameter {key!r} for {name}; accepted: {", ".join(accepted)}')
+    filters = cube.Filters(filters['start'], filters['end'], tuple(sorted(filters['state'])), tuple(sorted(filters['category'])))
+    return params, filters, limit
+
+
+def to_json(df, limit=None):
+    """A frame as UTF-8 JSON records; missing values become ``null``."""
+    if limit is not None:
+        df = df.head(limit)
+    if not isinstance(df.index, pd.RangeIndex):
+        df = df.reset_index()
+    return df.to_json(orient='records', date_format='iso').encode()
+
+
+class QueryEngine:
+    """Answers aggregate queries for one data folder, with cached responses."""
+
+    def __init__(self, data_dir=DATA_DIR, cache_size=DEFAULT_CACHE_SIZE):
+        self.data_dir = data_dir
+        self.cache = LRUCache(cache_size)
+        self._dataset = None
+        self._dataset_lock = threading.Lock()
+        # One lock per response being computed, so concurrent misses compute it once
+        self._computing = {}
+        self._computing_lock = threading.Lock()
+
+    def dataset(self, version):
+        """The shared dataset of ``version``, reloaded when the data changed."""
+        with self._dataset_lock:
+            if self._dataset is None or self._dataset.version != version:
+                # Drop the old copy before loading the new one
+                self._dataset = None
+                self._dataset = Dataset.load(self.data_dir)
+            return self._dataset
+
+    def _aggregate(self, name, filters, version, params):
+        try:
+            if cube.is_active(filters):
+                return self.dataset(version).filtered(name, filters, **params)
+            return store.materialize(name, self.data_dir, **params)
+        except TypeError as error:
+            # A parameter value of the wrong type
+            raise QueryError(str(error))
+
+    def resolve(self, path):
+        """The aggregate served at ``path``."""
+        path = path.rstrip('/') or '/'
+        if path in ROUTES:
+            return ROUTES[path]
+        prefix, _, name = path.rpartition('/')
+        if prefix == '/aggregates' and name in store.AGGREGATES:
+            return name
+        raise QueryError(f'No such path: {path}; see / for the available ones', status=404)
+
+    def index(self):
+        return json.dumps({
+            'routes': ROUTES,
+            'aggregates': {name: aggregate.defaults for name, aggregate in store.AGGREGATES.items()},
+            'filters': FILTER_PARAMS + ['limit'],
+            'cache': self.cache.stats(),
+        }).encode()
+
+    def respond(self, target):
+        """JSON body for a request target such as ``/cities/worst-rated?limit=10``, and whether it was cached."""
+        url = urlsplit(target)
+        if url.path.rstrip('/') in ('', '/aggregates'):
+            return self.index(), False
+        version = data_version(self.data_dir)
+        key = (version, url.path.rstrip('/'), tuple(sorted(parse_qsl(url.query, keep_blank_values=True))))
+        body = self.cache.get(key)
+        if body is not None:
+            return body, True
+        name = self.resolve(url.path)
+        params, filters, limit = parse_query(name, url.query)
+        with self._computing_lock:
+            lock = self._computing.setdefault(key, threading.Lock())
+        try:
+            with lock:
+                # Another request may have computed it while this one waited
+                body = self.cache.peek(key)
+                if body is None:
+                    body = to_json(self._aggregate(name, filters, version, params), limit)
+                    self.cache.put(key, body)
+        finally:
+            with self._computing_lock:
+                self._computing.pop(key, None)
+        return body, False
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server_version = 'AnalyticsAPI/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        try:
+            body, cached = self.server.engine.respond(self.path)
+            self._send(200, body, cached)
+        except QueryError as error:
+            self._send(error.status, json.dumps({'error': str(error)}).encode())
+        except Exception as error:
+            self.log_error('%s failed: %r', self.path, error)
+            self._send(500, json.dumps({'error': f'{type(error).__name__}: {error}'}).encode())
+
+    def _send(self, status, body, cached=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if cached is not None:
+            self.send_header('X-Cache', 'HIT' if cached else 'MISS')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class APIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 makes bursts of clients wait a second for a TCP retry
+    request_queue_size = 128
+
+
+def make_server(host='127.0.0.1', port=DEFAULT_PORT, data_dir=DATA_DIR, cache_size=DEFAULT_CACHE_SIZE, quiet=False):
+    """A threading HTTP server answering from ``data_dir``; call ``serve_forever()`` on it."""
+    server = APIServer((host, port), RequestHandler)
+    server.engine = QueryEngine(data_dir, cache_size)
+    server.quiet = quiet
+    return server
+
+
+Timing = namedtuple('Timing', ['path', 'status', 'ms'])
+
+
+def _fetch(url):
+    start = time.perf_counter()
+    try:
+        with urlopen(url) as response:
+            response.read()
+            status = response.status
+    except HTTPError as error:
+        status = error.code
+    return status, (time.perf_counter() - start) * 1000
+
+
+def load_test(base_url, paths, clients=8, requests=1000):
+    """Send ``requests`` GETs cycling through ``paths`` from ``clients`` threads.
+
+    Returns the throughput and latency percentiles in ms per path and overall.
+    """
+    targets = [paths[i % len(paths)] for i in range(requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        results = list(pool.map(lambda path: (path, *_fetch(base_url.rstrip('/') + path)), targets))
+    elapsed = time.perf_counter() - start
+    timings = pd.DataFrame([Timing(*result) for result in results])
+
+    def summary(group):
+        return pd.Series({
+            'requests': len(group),
+            'errors': int((group['status'] != 200).sum()),
+            'p50_ms': np.percentile(group['ms'], 50),
+            'p95_ms': np.percentile(group['ms'], 95),
+            'p99_ms': np.percentile(group['ms'], 99),
+        })
+
+    per_path = timings.groupby('path', sort=False)[['status', 'ms']].apply(summary)
+    per_path.loc['all'] = summary(timings)
+    per_path['requests'] = per_path['requests'].astype(int)
+    per_path['errors'] = per_path['errors'].astype(int)
+    return per_path, requests / elapsed
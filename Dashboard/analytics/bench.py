@@ -0,0 +1,185 @@
+"""Benchmarks for the loaders and the page computations.
+
+Each step runs in a fresh worker process, so one step's caches and heap do
+not affect the next and its peak resident memory can be read from the
+operating system. Steps:
+
+* ``parse``: read a table from its CSV, clean it and convert it to the compact
+  schema, i.e. what a cold start does.
+* ``load``: read a table (or a fact table) from its Parquet cache.
+* ``page``: everything a dashboard page computes from the cached tables,
+  bypassing the aggregate store.
+
+Wall time is the fastest of ``repeat`` runs; peak memory is the growth of the
+worker's maximum resident set during the first run.
+"""
+
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import pandas as pd
+
+from analytics import aggregates, cube, facts, segments, spatial, store, synthetic
+from analytics.geo import GeoIndex
+from analytics.ingest import DATA_DIR, TABLES, build_caches, build_table, load_table
+from analytics.search import ReviewIndex
+
+
+def _geo_index(data_dir):
+    return GeoIndex.from_geolocation(load_table('geolocation', data_dir))
+
+
+def _customer_distribution(data_dir):
+    geo_index = _geo_index(data_dir)
+    coordinates = geo_index.lookup_zip(load_table('customers', data_dir)['customer_zip_code_prefix'])
+    grid = spatial.bin_points_by_zoom(coordinates['geolocation_lat'], coordinates['geolocation_lng'])
+    cities = geo_index.with_city_coordinates(store.compute('city_stats', data_dir).reset_index(), 'customer_city')
+    return grid, cities
+
+
+def _delivery_analysis(data_dir):
+    order_facts = facts.load_order_facts(data_dir)
+    times = aggregates.delivery_time_histogram(order_facts, max_days=180)
+    percentiles = aggregates.delivery_percentiles(order_facts, 'customer_city')
+    cities = _geo_index(data_dir).with_city_coordinates(percentiles, 'customer_city')
+    longest = store.compute('city_delivery_times', data_dir).nlargest(10, 'delivery_time_days')
+    summary = pd.Series(cube.mean_and_std(cube.load_cube(data_dir), 'delivery_time', 'delivery_count'), index=['mean', 'std'])
+    return (summary, times, cities, longest, aggregates.delivery_percentiles(order_facts, 'customer_state'),
+            store.compute('state_delivery_distances', data_dir))
+
+
+def _customer_reviews(data_dir):
+    worst = store.compute('worst_rated_cities', data_dir).rename(columns={'city': 'customer_city'})
+    cities = _geo_index(data_dir).with_city_coordinates(worst, 'customer_city')
+    index = ReviewIndex.from_reviews(load_table('order_reviews', data_dir), facts.load_order_facts(data_dir))
+    return (store.compute('review_score_distribution', data_dir), cities, worst.nsmallest(10, 'avg_score'),
+            index.search('nao receb*', scores=[1, 2]))
+
+
+def _payment_analysis(data_dir):
+    payment_stats = store.compute('payment_stats', data_dir)
+    return (aggregates.payment_type_distribution(payment_stats, threshold=1000),
+            aggregates.average_payment_by_type(payment_stats, exclude=['not_defined']))
+
+
+def _customer_segments(data_dir):
+    customer_months = segments.customer_months(facts.load_order_facts(data_dir))
+    customer_rfm = segments.customer_rfm(customer_months)
+    return segments.rfm_segments(customer_rfm), segments.rfm_grid(customer_rfm), segments.cohort_retention(customer_months)
+
+
+# What each dashboard page computes once its data is loaded
+PAGES = {
+    'overview': lambda data_dir: store.compute('overview_metrics', data_dir),
+    'customer_distribution': _customer_distribution,
+    'delivery_analysis': _delivery_analysis,
+    'customer_reviews': _customer_reviews,
+    'product_analysis': lambda data_dir: store.compute('category_order_counts', data_dir),
+    'payment_analysis': _payment_analysis,
+    'customer_segments': _customer_segments,
+}
+
+FACT_LOADERS = {
+    'order_facts': facts.load_order_facts,
+    'item_facts': facts.load_item_facts,
+}
+
+
+def _load(name, data_dir):
+    if name in FACT_LOADERS:
+        return FACT_LOADERS[name](data_dir)
+    return load_table(name, data_dir)
+
+
+STEPS = {
+    'parse': lambda name, data_dir: build_table(name, data_dir)[0],
+    'load': _load,
+    'page': lambda name, data_dir: PAGES[name](data_dir),
+}
+
+
+def _max_rss():
+    # VmHWM belongs to this process image; ru_maxrss on Linux also counts the
+    # parent's peak inherited across fork and exec
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _rows(result):
+    if isinstance(result, tuple):
+        return sum(_rows(part) for part in result)
+    if isinstance(result, dict):
+        return sum(_rows(part) for part in result.values())
+    return len(result)
+
+
+def _measure(kind, name, data_dir, repeat):
+    """Run one step ``repeat`` times in the current (fresh) process."""
+    baseline = _max_rss()
+    timings, peak, rows = [], None, None
+    for _ in range(repeat):
+        result = None
+        start = time.perf_counter()
+        result = STEPS[kind](name, data_dir)
+        timings.append(time.perf_counter() - start)
+        if peak is None:
+            peak = _max_rss() - baseline
+            rows = _rows(result)
+    return {'kind': kind, 'step': name, 'rows': rows, 'wall_ms': min(timings) * 1000, 'peak_mb': peak / 2 ** 20}
+
+
+def steps():
+    """Every ``(kind, name)`` pair that is benchmarked."""
+    return (
+        [('parse', name) for name in TABLES]
+        + [('load', name) for name in [*TABLES, *FACT_LOADERS]]
+        + [('page', name) for name in PAGES]
+    )
+
+
+def _warm(data_dir):
+    # Build the Parquet caches once so "load" and "page" steps measure warm reads
+    build_caches(data_dir=data_dir)
+    for load in FACT_LOADERS.values():
+        load(data_dir)
+
+
+def run(data_dir=DATA_DIR, repeat=3, progress=None):
+    """Benchmark every step against the data in ``data_dir``; returns a frame."""
+    _warm(data_dir)
+    rows = []
+    for kind, name in steps():
+        # A new worker per step, so caches and peak memory start from scratch
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+            rows.append(pool.submit(_measure, kind, name, data_dir, repeat).result())
+        if progress:
+            progress(rows[-1])
+    return pd.DataFrame(rows)
+
+
+def run_scales(scales, work_dir, repeat=3, seed=0, reference_dir=DATA_DIR, progress=None):
+    """Generate synthetic data at each scale under ``work_dir`` and benchmark it.
+
+    Data already generated with the same scale and seed is reused.
+    """
+    results = []
+    for scale in scales:
+        data_dir = os.path.join(work_dir, f'{scale:g}x')
+        if synthetic.generated_scale(data_dir) != (scale, seed):
+            synthetic.generate(data_dir, scale, seed, reference_dir)
+        result = run(data_dir, repeat, progress)
+        result.insert(0, 'scale', scale)
+        results.append(result)
+    return pd.concat(results, ignore_index=True)
@@ -0,0 +1,308 @@
+"""Out-of-core computation of the aggregates, for data too large to load.
+
+:func:`compute_partials` streams every CSV export, followed by its appended
+batches, in chunks and folds each chunk into the same partial aggregates that
+:mod:`analytics.aggregates` builds from the in-memory fact tables: counts and
+sums per city, category, payment type and review score, and distinct entity
+counts. The final aggregates (top and bottom cities, review count thresholds,
+...) are derived from those partials exactly as in memory by :func:`compute`;
+per-city partials have one row per city, so top-k lists taken from them are
+exact.
+
+Joins between tables go through compact lookups instead of merges: IDs are
+hashed to uint64 with :func:`pandas.util.hash_pandas_object` and kept in
+sorted arrays next to the one value needed from the other table (a
+customer's city, an order's city, a product's category), found with
+``searchsorted``. Only these lookups, the distinct customers and one chunk
+are held at a time; distinct orders and products are counted from the keys
+of their lookups. Chunk sizes are derived from ``memory_budget`` after
+subtracting what is held; the budget is an estimate that keeps peak memory
+bounded, not a hard limit.
+
+As in :func:`analytics.ingest.load_table`, a row in a later batch replaces an
+earlier row with the same primary key. The CSV exports themselves are
+assumed to have unique keys.
+"""
+
+import numpy as np
+import pandas as pd
+
+from analytics import store
+from analytics.ingest import DATA_DIR, PRIMARY_KEYS, TABLES, delta_paths, read_source, source_path
+
+DEFAULT_MEMORY_BUDGET = 512 * 2 ** 20
+
+# Parsing and cleaning a chunk briefly needs a few times its final size
+_CHUNK_OVERHEAD = 8
+_MIN_CHUNK_ROWS = 1000
+_SAMPLE_ROWS = 1000
+
+
+def _hash(df, columns):
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+
+class _Lookup:
+    """One integer value per hashed key, filled chunk by chunk, then frozen for lookups."""
+
+    def __init__(self):
+        self._parts = []
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.values = np.empty(0, dtype=np.int32)
+
+    def add(self, keys, values):
+        self._parts.append((keys, values.astype(np.int32)))
+
+    def freeze(self):
+        if self._parts:
+            keys = np.concatenate([keys for keys, _ in self._parts])
+            values = np.concatenate([values for _, values in self._parts])
+            self._parts = []
+            order = np.argsort(keys, kind='stable')
+            self.keys, self.values = keys[order], values[order]
+
+    def get(self, keys):
+        """Values of ``keys``, -1 where a key is unknown."""
+        if not len(self.keys):
+            return np.full(len(keys), -1, dtype=np.int32)
+        positions = np.searchsorted(self.keys, keys).clip(max=len(self.keys) - 1)
+        return np.where(self.keys[positions] == keys, self.values[positions], -1)
+
+    def __len__(self):
+        """Distinct keys of the frozen lookup."""
+        return int(np.count_nonzero(self.keys[1:] != self.keys[:-1])) + 1 if len(self.keys) else 0
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.values.nbytes + sum(k.nbytes + v.nbytes for k, v in self._parts)
+
+
+class _Codes:
+    """Stable integer codes for strings seen across chunks; missing values get -1."""
+
+    def __init__(self):
+        self._codes = {}
+
+    def encode(self, values):
+        codes, uniques = pd.factorize(values)
+        mapping = np.array([self._codes.setdefault(value, len(self._codes)) for value in uniques] + [-1])
+        return mapping[codes]
+
+    @property
+    def names(self):
+        return list(self._codes)
+
+
+class _Totals:
+    """Counts and sums per integer code, growing as new codes appear."""
+
+    def __init__(self, columns):
+        self.totals = {column: np.zeros(0) for column in columns}
+
+    def add(self, codes, **columns):
+        valid = codes >= 0
+        codes = codes[valid]
+        size = int(codes.max()) + 1 if len(codes) else 0
+        for column, weights in columns.items():
+            # ``None`` counts rows; anything else is summed
+            weights = None if weights is None else np.asarray(weights, dtype=np.float64)[valid]
+            sums = np.bincount(codes, weights=weights, minlength=size)
+            total = self.totals[column]
+            if len(total) < len(sums):
+                total = np.pad(total, (0, len(sums) - len(total)))
+            total[:len(sums)] += sums
+            self.totals[column] = total
+
+    def frame(self, names, index_name):
+        size = max(len(total) for total in self.totals.values())
+        totals = {column: np.pad(total, (0, size - len(total))) for column, total in self.totals.items()}
+        return pd.DataFrame(totals, index=pd.Index(list(names)[:size], dtype=object, name=index_name))
+
+
+class _Distinct:
+    """Distinct hashed values seen across chunks."""
+
+    def __init__(self):
+        self._parts = []
+        self.values = np.empty(0, dtype=np.uint64)
+
+    def add(self, values):
+        self._parts.append(np.unique(values))
+        # Deduplicate only once the buffered chunks outgrow the distinct values, so that
+        # every value is sorted a logarithmic number of times rather than once per chunk
+        if sum(len(part) for part in self._parts) > max(len(self.values), _MIN_CHUNK_ROWS):
+            self._compact()
+
+    def _compact(self):
+        if self._parts:
+            self.values = np.unique(np.concatenate([self.values] + self._parts))
+            self._parts = []
+
+    def __len__(self):
+        self._compact()
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + sum(part.nbytes for part in self._parts)
+
+
+def _superseded_keys(name, data_dir):
+    """For the CSV and every batch of ``name``, the hashed keys that later batches replace."""
+    paths = delta_paths(name, data_dir)
+    keys = PRIMARY_KEYS.get(name)
+    if not keys or not paths:
+        return [None] * (len(paths) + 1)
+    later = [np.empty(0, dtype=np.uint64)]
+    for path in reversed(paths):
+        later.append(np.union1d(later[-1], _hash(pd.read_parquet(path, columns=keys), keys)))
+    return later[::-1]
+
+
+def _read_batch(path, keys):
+    batch = pd.read_parquet(path)
+    yield batch.drop_duplicates(keys, keep='last') if keys else batch
+
+
+class _Stream:
+    """Reads tables in chunks sized to what the budget leaves next to the lookups and distinct sets."""
+
+    def __init__(self, data_dir, memory_budget):
+        self.data_dir = data_dir
+        self.memory_budget = memory_budget
+        self.held = []
+
+    def _hold(self, held):
+        self.held.append(held)
+        return held
+
+    def lookup(self):
+        return self._hold(_Lookup())
+
+    def distinct(self):
+        return self._hold(_Distinct())
+
+    def release(self, held):
+        self.held.remove(held)
+
+    def _chunk_rows(self, name):
+        sample = pd.read_csv(source_path(name, self.data_dir), skiprows=1, nrows=_SAMPLE_ROWS,
+                             **TABLES[name].read_options)
+        row_bytes = sample.memory_usage(index=False, deep=True).sum() / max(len(sample), 1)
+        available = self.memory_budget - sum(held.nbytes for held in self.held)
+        rows = int(available / (row_bytes * _CHUNK_OVERHEAD))
+        if rows < _MIN_CHUNK_ROWS:
+            raise MemoryError(
+                f'A memory budget of {self.memory_budget / 2 ** 20:.0f} MB leaves too little room '
+                f'for chunks of {name} next to the key lookups and distinct sets'
+            )
+        return rows
+
+    def chunks(self, name):
+        """Cleaned chunks of the CSV export of ``name``, then of its appended batches."""
+        spec = TABLES[name]
+        keys = PRIMARY_KEYS.get(name)
+        superseded = _superseded_keys(name, self.data_dir)
+        # Every export starts with an Excel "sep=," hint line
+        reader = pd.read_csv(source_path(name, self.data_dir), skiprows=1, chunksize=self._chunk_rows(name),
+                             **spec.read_options)
+        sources = [(spec.clean(chunk) for chunk in reader)]
+        # Batches are stored cleaned, and each one was small enough to be appended in one go
+        sources += [_read_batch(path, keys) for path in delta_paths(name, self.data_dir)]
+        for chunks, replaced in zip(sources, superseded):
+            for chunk in chunks:
+                if replaced is not None and len(replaced):
+                    chunk = chunk[~np.isin(_hash(chunk, keys), replaced)]
+                yield chunk
+
+
+def compute_partials(data_dir=DATA_DIR, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Stream the tables in ``data_dir`` and return every partial aggregate by name."""
+    stream = _Stream(data_dir, memory_budget)
+
+    # Customers: the city of every customer_id, and distinct people
+    cities = _Codes()
+    customer_cities = stream.lookup()
+    people = stream.distinct()
+    for chunk in stream.chunks('customers'):
+        customer_cities.add(_hash(chunk, ['customer_id']), cities.encode(chunk['customer_city']))
+        people.add(_hash(chunk.dropna(subset=['customer_unique_id']), ['customer_unique_id']))
+    customer_cities.freeze()
+    customer_count = len(people)
+    stream.release(people)
+
+    # Orders: counts and delivery times per city, and the city of every order
+    city_totals = _Totals(['order_count', 'delivery_time_sum', 'delivery_count', 'review_count', 'review_score_sum'])
+    order_cities = stream.lookup()
+    for chunk in stream.chunks('orders'):
+        city = customer_cities.get(_hash(chunk, ['customer_id']))
+        delivery_time = (chunk['order_delivered_customer_date'] - chunk['order_purchase_timestamp']).dt.days.to_numpy()
+        delivered = ~np.isnan(delivery_time)
+        city_totals.add(city, order_count=None, delivery_time_sum=np.where(delivered, delivery_time, 0),
+                        delivery_count=delivered)
+        order_cities.add(_hash(chunk, ['order_id']), city)
+    order_cities.freeze()
+    order_count = len(order_cities)
+    stream.release(customer_cities)
+
+    # Reviews count towards the city of their order
+    score_totals = _Totals(['count'])
+    for chunk in stream.chunks('order_reviews'):
+        scores = chunk['review_score'].to_numpy()
+        city_totals.add(order_cities.get(_hash(chunk, ['order_id'])), review_count=None, review_score_sum=scores)
+        score_totals.add(scores.astype(np.int64), count=None)
+    stream.release(order_cities)
+
+    payment_types = _Codes()
+    payment_totals = _Totals(['payment_count', 'payment_value_cents'])
+    for chunk in stream.chunks('order_payments'):
+        # Whole cents add up exactly, whatever the chunking
+        cents = np.round(chunk['payment_value'].to_numpy() * 100)
+        payment_totals.add(payment_types.encode(chunk['payment_type']), payment_count=None, payment_value_cents=cents)
+
+    # Products: the English category of every product, and distinct products
+    translation = read_source('product_category_trans', data_dir)
+    english = dict(zip(
+        translation['product_category_name'].astype(str),
+        translation['product_category_name_english'].astype(str),
+    ))
+    categories = _Codes()
+    product_categories = stream.lookup()
+    for chunk in stream.chunks('products'):
+        product_categories.add(_hash(chunk, ['product_id']),
+                               categories.encode(chunk['product_category_name'].map(english)))
+    product_categories.freeze()
+    product_count = len(product_categories)
+
+    category_totals = _Totals(['order_count'])
+    for chunk in stream.chunks('order_items'):
+        category_totals.add(product_categories.get(_hash(chunk, ['product_id'])), order_count=None)
+    stream.release(product_categories)
+
+    city_stats = city_totals.frame(cities.names, 'customer_city')
+    city_stats = city_stats[city_stats['order_count'] > 0]
+    payment_type_stats = payment_totals.frame(payment_types.names, 'payment_type')
+    payment_type_stats['payment_value_sum'] = payment_type_stats.pop('payment_value_cents') / 100
+    review_score_counts = score_totals.frame(range(len(score_totals.totals['count'])), 'review_score')
+    partials = {
+        'city_stats': city_stats,
+        'category_counts': category_totals.frame(categories.names, 'product_category_name_english'),
+        'payment_type_stats': payment_type_stats,
+        'review_score_counts': review_score_counts[review_score_counts['count'] > 0],
+        'entity_counts': pd.DataFrame([{'customers': customer_count, 'orders': order_count, 'products': product_count}]),
+    }
+    for name, partial in partials.items():
+        # Totals are accumulated as floats; counts go back to integers
+        counts = [column for column in partial.columns if not column.endswith('_sum') or column == 'review_score_sum']
+        partial = partial.astype(dict.fromkeys(counts, 'int64'))
+        partials[name] = partial if name == 'entity_counts' else partial.sort_index()
+    return partials
+
+
+def compute(name, partials, **params):
+    """Compute the aggregate ``name`` from the result of :func:`compute_partials`."""
+    if name in partials:
+        return partials[name]
+    aggregate = store.AGGREGATES[name]
+    resolve = lambda dependency: compute(dependency, partials)
+    return aggregate.compute(resolve, None, **{**aggregate.defaults, **params})
@@ -0,0 +1,254 @@
+"""Command line interface, run as ``python -m analytics <command>``.
+
+Paths default to the ``Data`` folder next to the current directory, so run it
+from the ``Dashboard`` folder or pass ``--data-dir``.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import pandas as pd
+
+from analytics import api, bench, chunked, perf, store, synthetic
+from analytics.dataset import Dataset
+from analytics.incremental import APPENDABLE_TABLES, append_batch
+from analytics.ingest import DATA_DIR, TABLES, cache_dir, memory_report
+
+
+def _parse_params(pairs):
+    params = {}
+    for pair in pairs:
+        key, _, value = pair.partition('=')
+        try:
+            params[key] = json.loads(value)
+        except json.JSONDecodeError:
+            params[key] = value
+    return params
+
+
+def _size(value):
+    """Parse a byte count such as ``512M`` or ``2G``."""
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+    value = value.strip().upper().rstrip('B')
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def _names(names):
+    unknown = sorted(set(names) - set(store.AGGREGATES))
+    if unknown:
+        raise SystemExit(f'Unknown aggregates: {", ".join(unknown)}. Run "python -m analytics list" to see them.')
+    return names or list(store.AGGREGATES)
+
+
+def _write(df, path, output_format):
+    if output_format == 'json':
+        if not isinstance(df.index, pd.RangeIndex):
+            df = df.reset_index()
+        df.to_json(path, orient='records', indent=2, date_format='iso')
+    else:
+        df.to_parquet(path)
+
+
+def _read_batch_file(path):
+    # Accept the exports' "sep=," first line as well as plain CSV
+    with open(path, encoding='utf-8-sig') as handle:
+        skip = 1 if handle.readline().startswith('sep=') else 0
+    return pd.read_csv(path, skiprows=skip)
+
+
+def list_command(args):
+    for name, aggregate in store.AGGREGATES.items():
+        params = ', '.join(f'{key}={value}' for key, value in aggregate.defaults.items())
+        print(f'{name}({params})' if params else name)
+
+
+def compute_command(args):
+    params = _parse_params(args.param)
+    os.makedirs(args.out, exist_ok=True)
+    get = store.compute if args.fresh else store.materialize
+    if args.chunked:
+        start = time.perf_counter()
+        partials = chunked.compute_partials(args.data_dir, args.memory_budget)
+        print(f'Streamed the tables in {time.perf_counter() - start:.1f} s')
+
+        def get(name, data_dir, **own_params):
+            df = chunked.compute(name, partials, **own_params)
+            # Stored like a materialized result, so the dashboard can read it without loading the tables
+            store.save(name, df, data_dir, **own_params)
+            return df
+
+    names = _names(args.names)
+    if args.chunked:
+        skipped = [name for name in names if name in store.FACT_AGGREGATES]
+        if skipped:
+            print(f'Skipping {", ".join(skipped)}: they need the full fact tables, not --chunked')
+        names = [name for name in names if name not in skipped]
+    for name in names:
+        # Pass each aggregate only the parameters it accepts
+        own_params = {key: value for key, value in params.items() if key in store.AGGREGATES[name].defaults}
+        start = time.perf_counter()
+        df = get(name, args.data_dir, **own_params)
+        elapsed = time.perf_counter() - start
+        path = os.path.join(args.out, f'{name}.{args.format}')
+        _write(df, path, args.format)
+        print(f'{name}: {len(df)} rows in {elapsed * 1000:.1f} ms -> {path}')
+
+
+def warm_command(args):
+    start = time.perf_counter()
+    dataset = Dataset.load(args.data_dir)
+    # Loading every frame builds the caches of the fact tables and the cube too
+    dataset.preload(dataset.names)
+    size = sum(dataset.memory_bytes().values())
+    print(f'{len(dataset.names)} frames (tables, fact tables and the cube) ready in {time.perf_counter() - start:.1f} s '
+          f'({size / 2 ** 20:.0f} MB in memory)')
+    start = time.perf_counter()
+    for name in store.AGGREGATES:
+        store.materialize(name, args.data_dir)
+    print(f'{len(store.AGGREGATES)} aggregates stored in {time.perf_counter() - start:.1f} s')
+
+
+def generate_command(args):
+    start = time.perf_counter()
+    rows = synthetic.generate(args.out, args.scale, args.seed, reference_dir=args.data_dir)
+    for name, count in rows.items():
+        print(f'{TABLES[name].filename}: {count} rows')
+    print(f'Written to {args.out} in {time.perf_counter() - start:.1f} s')
+
+
+def benchmark_command(args):
+    progress = lambda row: print(f"{row['kind']:>5} {row['step']:<24} {row['wall_ms']:10.1f} ms {row['peak_mb']:9.1f} MB",
+                                 file=sys.stderr)
+    if args.scale:
+        results = bench.run_scales(args.scale, args.work_dir, args.repeat, args.seed, args.data_dir, progress)
+    else:
+        results = bench.run(args.data_dir, args.repeat, progress)
+    print(results.to_string(index=False, float_format='{:.1f}'.format))
+    if args.out:
+        results.to_csv(args.out, index=False)
+
+
+def memory_command(args):
+    print(memory_report(args.data_dir).to_string(index=False))
+
+
+def prune_command(args):
+    print(f'Removed {store.prune(args.data_dir)} stale aggregates')
+
+
+def perf_command(args):
+    log_path = args.log or os.path.join(cache_dir(args.data_dir), perf.LOG_NAME)
+    if not os.path.exists(log_path):
+        raise SystemExit(f'No rerun log at {log_path}: open the dashboard first')
+    summary = perf.summarize(log_path, by='span' if args.spans else 'page', since=args.since)
+    print(summary.to_string(float_format='{:.1f}'.format))
+
+
+def serve_command(args):
+    server = api.make_server(args.host, args.port, args.data_dir, args.cache_size, args.quiet)
+    print(f'Serving {args.data_dir} on http://{args.host}:{server.server_port}/ (Ctrl+C to stop)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def loadtest_command(args):
+    paths = args.paths or list(api.ROUTES)
+    results, throughput = api.load_test(args.url, paths, args.clients, args.requests)
+    print(results.to_string(float_format='{:.2f}'.format))
+    print(f'{throughput:.0f} requests/s with {args.clients} clients')
+
+
+def append_command(args):
+    batch = {name: _read_batch_file(path) for name, path in vars(args).items() if name in APPENDABLE_TABLES and path}
+    if not batch:
+        raise SystemExit('Nothing to append: pass at least one of ' + ', '.join(f'--{name}' for name in APPENDABLE_TABLES))
+    incremental = append_batch(batch, args.data_dir)
+    print('Aggregates updated incrementally' if incremental else 'Existing rows changed; aggregates will be recomputed')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m analytics', description='Brazilian e-commerce analytics engine')
+    parser.add_argument('--data-dir', default=DATA_DIR, help='folder with the CSV exports (default: %(default)s)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    commands.add_parser('list', help='list the available aggregates').set_defaults(run=list_command)
+
+    compute = commands.add_parser('compute', help='compute aggregates and write them to files')
+    compute.add_argument('names', nargs='*', help='aggregates to compute (default: all)')
+    compute.add_argument('--out', default='output', help='output folder (default: %(default)s)')
+    compute.add_argument('--format', choices=['parquet', 'json'], default='parquet')
+    compute.add_argument('--param', action='append', default=[], metavar='KEY=VALUE',
+                         help='aggregate parameter, e.g. min_reviews=10; may be repeated')
+    compute.add_argument('--fresh', action='store_true', help='recompute instead of reading the aggregate store')
+    compute.add_argument('--chunked', action='store_true',
+                         help='stream the CSV files in chunks instead of loading them, and store the results')
+    compute.add_argument('--memory-budget', type=_size, default=chunked.DEFAULT_MEMORY_BUDGET, metavar='SIZE',
+                         help='approximate memory limit for --chunked, e.g. 256M or 2G (default: 512M)')
+    compute.set_defaults(run=compute_command)
+
+    commands.add_parser(
+        'warm', help='build every cache the dashboard reads, so its first visit only loads them'
+    ).set_defaults(run=warm_command)
+
+    generate = commands.add_parser('generate', help='write a synthetic dataset for benchmarks')
+    generate.add_argument('out', help='folder to write the CSV files to')
+    generate.add_argument('--scale', type=float, default=1, help='size relative to the public dataset (default: %(default)s)')
+    generate.add_argument('--seed', type=int, default=0)
+    generate.set_defaults(run=generate_command)
+
+    benchmark = commands.add_parser('benchmark', help='time and measure the memory of each loader and page')
+    benchmark.add_argument('--scale', type=float, nargs='+',
+                           help='benchmark synthetic data at these scales instead of --data-dir, e.g. 1 10 100')
+    benchmark.add_argument('--work-dir', default='benchmark-data', help='where synthetic data is generated (default: %(default)s)')
+    benchmark.add_argument('--seed', type=int, default=0)
+    benchmark.add_argument('--repeat', type=int, default=3)
+    benchmark.add_argument('--out', help='also write the results to this CSV file')
+    benchmark.set_defaults(run=benchmark_command)
+
+    commands.add_parser('memory', help='show memory saved by the compact schema').set_defaults(run=memory_command)
+    commands.add_parser('prune', help='drop stored aggregates of old data').set_defaults(run=prune_command)
+
+    perf_parser = commands.add_parser('perf', help='p50/p95 rerun latency per dashboard page from its timing log')
+    perf_parser.add_argument('--spans', action='store_true', help='break the latency down by timing span')
+    perf_parser.add_argument('--since', metavar='DATE', help='only reruns from this date or time on, e.g. 2024-11-01')
+    perf_parser.add_argument('--log', help=f'rerun log to read (default: <data-dir>/.cache/{perf.LOG_NAME})')
+    perf_parser.set_defaults(run=perf_command)
+
+    serve = commands.add_parser('serve', help='answer aggregate queries over HTTP as JSON')
+    serve.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    serve.add_argument('--port', type=int, default=api.DEFAULT_PORT, help='default: %(default)s')
+    serve.add_argument('--cache-size', type=int, default=api.DEFAULT_CACHE_SIZE,
+                       help='responses kept in memory (default: %(default)s)')
+    serve.add_argument('--quiet', action='store_true', help='do not log each request')
+    serve.set_defaults(run=serve_command)
+
+    loadtest = commands.add_parser('loadtest', help='measure the latency and throughput of a running API server')
+    loadtest.add_argument('paths', nargs='*', help='request targets to cycle through (default: every short path)')
+    loadtest.add_argument('--url', default=f'http://127.0.0.1:{api.DEFAULT_PORT}', help='default: %(default)s')
+    loadtest.add_argument('--clients', type=int, default=8, help='concurrent clients (default: %(default)s)')
+    loadtest.add_argument('--requests', type=int, default=2000, help='total requests (default: %(default)s)')
+    loadtest.set_defaults(run=loadtest_command)
+
+    append = commands.add_parser('append', help='append a batch of new rows from CSV files')
+    for name in APPENDABLE_TABLES:
+        append.add_argument(f'--{name}', metavar='CSV')
+    append.set_defaults(run=append_command)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""Pre-aggregated cube for slicing the dashboard by date, state and category.
+
+The cube holds counts, sums and sums of squares per (purchase day, customer
+state, customer city, product category, payment type). It mixes three grains:
+
+* order measures (orders, delivery times, reviews) count each order once,
+  under its first item's category and its first payment's type;
+* item measures (items, prices) count each item under its own category;
+* payment measures count each payment under its own payment type.
+
+Because every measure is additive, a filter is answered by masking the cube's
+rows and summing them; :func:`compute` then turns those sums into the same
+partial aggregates :mod:`analytics.aggregates` builds from the fact tables,
+so every final aggregate in :data:`analytics.store.AGGREGATES` can be
+computed for a slice. Distinct counts (customers, products) are not additive
+and are answered from the fact tables by :func:`entity_counts`.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from analytics import perf, store
+from analytics.facts import ITEM_FACT_SOURCES, load_item_facts, load_order_facts
+from analytics.ingest import DATA_DIR, load_cached, load_table, table_fingerprint
+from analytics.schema import concat_tables, memory_bytes
+
+DIMENSIONS = ['day', 'customer_state', 'customer_city', 'category', 'payment_type']
+REVIEW_SCORES = [1, 2, 3, 4, 5]
+
+# Bump whenever the cube layout changes
+CUBE_VERSION = 1
+
+# Purchase days are inclusive; empty state and category tuples mean "all"
+Filters = namedtuple('Filters', ['start', 'end', 'states', 'categories'], defaults=[None, None, (), ()])
+NO_FILTERS = Filters()
+
+
+def build_order_dimensions(order_facts, item_facts):
+    """The cube dimensions of every order, indexed by ``order_id``."""
+    first_items = item_facts.sort_values('order_item_id', kind='stable').drop_duplicates('order_id')
+    categories = first_items.set_index('order_id')['product_category_name_english']
+    return pd.DataFrame({
+        'day': order_facts['order_purchase_timestamp'].dt.normalize(),
+        'customer_state': order_facts['customer_state'],
+        'customer_city': order_facts['customer_city'],
+        'category': categories.reindex(order_facts.index),
+        'payment_type': order_facts['payment_type'],
+    })
+
+
+def build_cube(order_facts, item_facts, order_payments, order_reviews):
+    """Sum the order, item and payment measures per cell of the cube."""
+    dimensions = build_order_dimensions(order_facts, item_facts)
+
+    delivery_time = order_facts['delivery_time']
+    scores = order_reviews['review_score'].astype('int64')
+    score_counts = pd.crosstab(order_reviews['order_id'], scores).reindex(columns=REVIEW_SCORES, fill_value=0)
+    score_counts.columns = [f'review_score_{score}_count' for score in REVIEW_SCORES]
+    orders = dimensions.assign(
+        order_count=1,
+        delivery_count=delivery_time.notna().astype('int64'),
+        delivery_time_sum=delivery_time.fillna(0),
+        delivery_time_sumsq=delivery_time.fillna(0) ** 2,
+        review_count=order_facts['review_count'].astype('int64'),
+        review_score_sum=order_facts['review_score_sum'].astype('int64'),
+        review_score_sumsq=(scores ** 2).groupby(order_reviews['order_id']).sum(),
+    ).join(score_counts)
+
+    # Items and payments take the cell of their order, except for their own category or type
+    item_dimensions = dimensions.drop(columns='category').reindex(item_facts['order_id'])
+    items = item_dimensions.reset_index(drop=True).assign(
+        category=item_facts['product_category_name_english'].array,
+        item_count=1,
+        price_sum=item_facts['price'].to_numpy(),
+        price_sumsq=item_facts['price'].to_numpy() ** 2,
+        freight_value_sum=item_facts['freight_value'].to_numpy(),
+    )
+    payment_dimensions = dimensions.drop(columns='payment_type').reindex(order_payments['order_id'])
+    payments = payment_dimensions.reset_index(drop=True).assign(
+        payment_type=order_payments['payment_type'].array,
+        payment_count=1,
+        payment_value_sum=order_payments['payment_value'].to_numpy(),
+        payment_value_sumsq=order_payments['payment_value'].to_numpy() ** 2,
+    )
+
+    rows = concat_tables([orders.reset_index(drop=True), items, payments])
+    measures = [column for column in rows.columns if column not in DIMENSIONS]
+    rows[measures] = rows[measures].fillna(0)
+    cube = rows.groupby(DIMENSIONS, observed=True, dropna=False, sort=False)[measures].sum().reset_index()
+    counts = [column for column in measures if column.endswith('_count') or column == 'review_score_sum']
+    cube[counts] = cube[counts].astype('int64')
+    return cube
+
+
+def _cube_fingerprint(data_dir):
+    parts = [f'cube:{CUBE_VERSION}'.encode()] + [table_fingerprint(name, data_dir) for name in ITEM_FACT_SOURCES]
+    return b'|'.join(parts)
+
+
+def load_cube(data_dir=DATA_DIR):
+    """Load the cube, rebuilding it when any of its source tables changed."""
+    def build():
+        sources = [
+            load_order_facts(data_dir),
+            load_item_facts(data_dir),
+            load_table('order_payments', data_dir),
+            load_table('order_reviews', data_dir),
+        ]
+        with perf.span('build cube', rows_in=sum(map(len, sources))) as record:
+            cube = build_cube(*sources)
+            record['rows_out'] = len(cube)
+        return cube, {'rows': len(cube), 'bytes_after': memory_bytes(cube)}
+
+    return load_cached('cube', _cube_fingerprint(data_dir), build, data_dir)
+
+
+def is_active(filters):
+    return filters != NO_FILTERS
+
+
+def _mask(df, filters):
+    mask = np.ones(len(df), dtype=bool)
+    if filters.start is not None:
+        mask &= (df['day'] >= pd.Timestamp(filters.start)).to_numpy()
+    if filters.end is not None:
+        mask &= (df['day'] <= pd.Timestamp(filters.end)).to_numpy()
+    if filters.states:
+        mask &= df['customer_state'].isin(filters.states).to_numpy()
+    if filters.categories:
+        mask &= df['category'].isin(filters.categories).to_numpy()
+    return mask
+
+
+def slice_cube(cube, filters):
+    """The cells of ``cube`` inside ``filters``."""
+    if not is_active(filters):
+        return cube
+    return cube[_mask(cube, filters)]
+
+
+def order_mask(order_dimensions, filters):
+    """Boolean mask of the orders inside ``filters``, aligned with ``order_dimensions``."""
+    return _mask(order_dimensions, filters)
+
+
+def _rollup(cube, dimension, measures, count):
+    sums = cube.groupby(dimension, observed=True)[measures].sum()
+    # Cells can hold only another grain's measures, e.g. items of orders filed under other categories
+    sums = sums[sums[count] > 0]
+    sums.index = sums.index.astype(object)
+    return sums
+
+
+def city_stats(cube):
+    """Same as :func:`analytics.aggregates.city_stats`, from cube cells."""
+    return _rollup(cube, 'customer_city', [
+        'order_count', 'delivery_time_sum', 'delivery_count', 'review_count', 'review_score_sum',
+    ], 'order_count')
+
+
+def category_counts(cube):
+    """Same as :func:`analytics.aggregates.category_counts`, from cube cells."""
+    counts = _rollup(cube, 'category', ['item_count'], 'item_count')
+    counts.index.name = 'product_category_name_english'
+    return counts.rename(columns={'item_count': 'order_count'})
+
+
+def payment_type_stats(cube):
+    """Same as :func:`analytics.aggregates.payment_type_stats`, from cube cells."""
+    return _rollup(cube, 'payment_type', ['payment_count', 'payment_value_sum'], 'payment_count')
+
+
+def review_score_counts(cube):
+    """Same as :func:`analytics.aggregates.review_score_counts`, from cube cells."""
+    counts = pd.Series(
+        [cube[f'review_score_{score}_count'].sum() for score in REVIEW_SCORES],
+        index=pd.Index(REVIEW_SCORES, name='review_score'), name='count',
+    )
+    return counts[counts > 0].to_frame()
+
+
+PARTIALS = {
+    'city_stats': city_stats,
+    'category_counts': category_counts,
+    'payment_type_stats': payment_type_stats,
+    'review_score_counts': review_score_counts,
+}
+
+
+def filter_items(item_facts, order_dimensions, filters, in_orders=None):
+    """The items of ``item_facts`` inside ``filters``: of matching orders and, if given, categories."""
+    if in_orders is None:
+        in_orders = order_mask(order_dimensions, filters)
+    items = item_facts[pd.Series(in_orders, index=order_dimensions.index).reindex(item_facts['order_id']).to_numpy()]
+    if filters.categories:
+        items = items[items['product_category_name_english'].isin(filters.categories)]
+    return items
+
+
+def entity_counts(order_facts, item_facts, order_dimensions, filters):
+    """Distinct customers, orders and ordered products inside ``filters``."""
+    in_orders = order_mask(order_dimensions, filters)
+    items = filter_items(item_facts, order_dimensions, filters, in_orders)
+    return pd.DataFrame([{
+        'customers': order_facts.loc[in_orders, 'customer_unique_id'].nunique(),
+        'orders': int(in_orders.sum()),
+        'products': items['product_id'].nunique(),
+    }])
+
+
+def compute(name, cube, partials=None, **params):
+    """Compute the aggregate ``name`` from (a slice of) the cube.
+
+    ``partials`` supplies partial aggregates the cube cannot provide, such as
+    :func:`entity_counts`.
+    """
+    partials = partials or {}
+    if name in partials:
+        return partials[name]
+    if name in PARTIALS:
+        return PARTIALS[name](cube)
+    aggregate = store.AGGREGATES[name]
+    resolve = lambda dependency: compute(dependency, cube, partials)
+    return aggregate.compute(resolve, None, **{**aggregate.defaults, **params})
+
+
+def mean_and_std(cube, measure, count):
+    """Mean and population standard deviation of ``measure`` from its sums."""
+    n = cube[count].sum()
+    if n == 0:
+        return np.nan, np.nan
+    mean = cube[f'{measure}_sum'].sum() / n
+    variance = cube[f'{measure}_sumsq'].sum() / n - mean ** 2
+    return mean, np.sqrt(max(variance, 0))
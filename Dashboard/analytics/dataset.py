@@ -0,0 +1,168 @@
+"""One read-only copy of every table, shared by all dashboard sessions.
+
+Frames handed out by ``st.cache_data`` are unpickled afresh on every call,
+so each rerun of each session pays for its own copy. :class:`Dataset` holds
+the nine tables, both fact tables, the cube and the order dimensions,
+marks their arrays read-only and hands out shallow copies: they share the
+frozen arrays, so taking one costs microseconds and no memory. Columns a
+caller adds stay on its own copy, and any in-place write to shared data
+raises ``ValueError: assignment destination is read-only`` instead of
+leaking into other sessions.
+
+Each frame is loaded the first time it is asked for, so a page that only
+reads the cube never loads the geolocation table or the fact tables. The
+geolocation centroids and the review search index
+(:class:`analytics.search.ReviewIndex`) are built on first use as well.
+Derived columns the pages need (delivery times, review counts and sums,
+each order's cube dimensions) are part of the fact tables and are computed
+once, when the fact tables are built.
+"""
+
+import threading
+
+import numpy as np
+import pandas as pd
+
+from analytics import aggregates, cube, distance, facts, perf, segments
+from analytics.cube import build_order_dimensions, load_cube
+from analytics.geo import GeoIndex
+from analytics.ingest import DATA_DIR, TABLES, build_caches, data_version, load_table
+from analytics.schema import memory_bytes
+from analytics.search import ReviewIndex
+from analytics.store import SEGMENT_AGGREGATES
+
+
+def freeze(df):
+    """Mark the arrays behind ``df`` read-only, in place; returns ``df``."""
+    for array in df._mgr.arrays:
+        # Categorical and datetime columns wrap a plain ndarray
+        array = getattr(array, '_ndarray', array)
+        if isinstance(array, np.ndarray):
+            array.flags.writeable = False
+    # pandas builds an index's hash table on its first lookup, which is not
+    # thread-safe; build it now so concurrent lookups only read it
+    df.index.is_unique
+    return df
+
+
+def _freeze_geo_index(geo_index):
+    for table in [geo_index.by_zip, geo_index.by_city, geo_index.by_city_state]:
+        freeze(table)
+    return geo_index
+
+
+# How each member other than the tables is loaded, from the dataset it belongs to
+_LOADERS = {
+    'order_facts': lambda dataset: facts.load_order_facts(dataset.data_dir),
+    'item_facts': lambda dataset: facts.load_item_facts(dataset.data_dir),
+    'cube': lambda dataset: load_cube(dataset.data_dir),
+    'order_dimensions': lambda dataset: build_order_dimensions(dataset['order_facts'], dataset['item_facts']),
+    'geo_index': lambda dataset: _freeze_geo_index(GeoIndex.from_geolocation(dataset['geolocation'])),
+    'review_index': lambda dataset: ReviewIndex.from_reviews(dataset['order_reviews'], dataset['order_facts']),
+}
+
+FRAMES = list(TABLES) + ['order_facts', 'item_facts', 'cube', 'order_dimensions']
+
+
+class Dataset:
+    """Read-only frames by name, plus the geolocation centroids and the review search index.
+
+    Every member is loaded on first use and then kept; concurrent first uses
+    of one member load it once.
+    """
+
+    def __init__(self, data_dir, version):
+        self.data_dir = data_dir
+        self.version = version
+        self._members = {}
+        # One lock per member, so loading one does not hold up the others
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    @classmethod
+    def load(cls, data_dir=DATA_DIR):
+        """The dataset of ``data_dir``, rebuilding stale table caches first; nothing is read yet."""
+        version = data_version(data_dir)
+        with perf.span('build caches'):
+            build_caches(data_dir=data_dir)
+        return cls(data_dir, version)
+
+    def _member(self, name):
+        with self._locks_lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in self._members:
+                with perf.span(f'load {name}') as record:
+                    member = _LOADERS[name](self) if name in _LOADERS else load_table(name, self.data_dir)
+                    self._members[name] = freeze(member) if isinstance(member, pd.DataFrame) else member
+                    record['rows_out'] = perf.rows(member)
+            return self._members[name]
+
+    @property
+    def geo_index(self):
+        return self._member('geo_index')
+
+    @property
+    def review_index(self):
+        return self._member('review_index')
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        # A new frame over the same read-only arrays
+        return self._member(name).copy(deep=False)
+
+    def __contains__(self, name):
+        return name in FRAMES
+
+    @property
+    def names(self):
+        return list(FRAMES)
+
+    def preload(self, names=None):
+        """Load ``names`` now rather than on first use; by default every frame and both indexes."""
+        for name in FRAMES + ['geo_index', 'review_index'] if names is None else names:
+            self._member(name)
+        return self
+
+    def memory_bytes(self):
+        """In-memory size of every frame loaded so far, by name."""
+        return {name: memory_bytes(df) for name, df in self._members.items() if isinstance(df, pd.DataFrame)}
+
+    def search_reviews(self, query, scores=None, cities=None, filters=None):
+        """Reviews whose title or message contains every word of ``query``, with their customer city.
+
+        ``scores`` and ``cities`` narrow the results to those review scores and
+        cities, and ``filters`` to the orders inside the sidebar filters.
+        """
+        reviews = self['order_reviews']
+        within = None
+        if filters is not None and cube.is_active(filters):
+            mask = pd.Series(cube.order_mask(self['order_dimensions'], filters), index=self['order_dimensions'].index)
+            within = mask.reindex(reviews['order_id'], fill_value=False).to_numpy()
+        rows = self.review_index.search(query, scores, cities, within)
+        matches = reviews.iloc[rows]
+        return matches.assign(customer_city=self.review_index.cities_of(rows))
+
+    def filtered(self, name, filters, **params):
+        """The aggregate ``name`` of the orders inside ``filters`` (see :mod:`analytics.store`)."""
+        if name in ('city_delivery_percentiles', 'state_delivery_percentiles'):
+            order_facts = self['order_facts'][cube.order_mask(self['order_dimensions'], filters)]
+            by = 'customer_city' if name == 'city_delivery_percentiles' else 'customer_state'
+            return aggregates.delivery_percentiles(order_facts, by)
+        if name == 'delivery_time_histogram':
+            order_facts = self['order_facts'][cube.order_mask(self['order_dimensions'], filters)]
+            return aggregates.delivery_time_histogram(order_facts, **params)
+        if name == 'state_delivery_distances':
+            items = cube.filter_items(self['item_facts'], self['order_dimensions'], filters)
+            return distance.state_delivery_distances(self['order_facts'], items, self['sellers'], self.geo_index)
+        partials = {}
+        if name in SEGMENT_AGGREGATES:
+            order_facts = self['order_facts'][cube.order_mask(self['order_dimensions'], filters)]
+            partials['customer_months'] = segments.customer_months(order_facts)
+        if name == 'overview_metrics':
+            # Distinct customer and product counts need the fact tables
+            partials['entity_counts'] = cube.entity_counts(
+                self['order_facts'], self['item_facts'], self['order_dimensions'], filters
+            )
+        return cube.compute(name, cube.slice_cube(self['cube'], filters), partials, **params)
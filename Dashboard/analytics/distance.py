@@ -0,0 +1,174 @@
+"""Distances between sellers and customers.
+
+Sellers and customers are placed at the centroid of their zip prefix (see
+:class:`analytics.geo.GeoIndex`) and distances are great-circle distances
+computed with the haversine formula over whole arrays, so every order item
+is handled in one NumPy pass.
+
+:class:`GridIndex` answers nearest-point queries, e.g. the seller closest to
+each customer. Points are bucketed into square cells of a few tens of
+kilometres and each query scans rings of cells around its own, stopping
+once no unscanned cell can hold anything closer than what it found.
+"""
+
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance in km between two arrays of coordinates, element by element."""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(values, dtype='float64')) for values in [lat1, lng1, lat2, lng2])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def _ring(radius):
+    """Cell offsets at Chebyshev distance ``radius`` from a cell."""
+    if radius == 0:
+        return np.zeros((1, 2), dtype='int64')
+    side = np.arange(-radius, radius + 1)
+    inner = side[1:-1]
+    return np.concatenate([
+        np.column_stack([np.full(len(side), -radius), side]),
+        np.column_stack([np.full(len(side), radius), side]),
+        np.column_stack([inner, np.full(len(inner), -radius)]),
+        np.column_stack([inner, np.full(len(inner), radius)]),
+    ])
+
+
+class GridIndex:
+    """Points bucketed into square cells of ``cell_size`` degrees for nearest-point queries."""
+
+    def __init__(self, lat, lng, cell_size=0.25):
+        lat = np.asarray(lat, dtype='float64')
+        lng = np.asarray(lng, dtype='float64')
+        valid = ~(np.isnan(lat) | np.isnan(lng))
+        self.cell_size = cell_size
+        self._columns = int(np.ceil(360 / cell_size)) + 1
+        rows, cols = self._cells(lat[valid], lng[valid])
+        cells = rows * self._columns + cols
+        order = np.argsort(cells, kind='stable')
+        self._cell_ids = cells[order]
+        self.positions = np.flatnonzero(valid)[order]
+        self.lat = lat[valid][order]
+        self.lng = lng[valid][order]
+        self._bounds = (rows.min(), rows.max(), cols.min(), cols.max()) if len(rows) else None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _cells(self, lat, lng):
+        rows = np.floor((lat + 90) / self.cell_size).astype('int64')
+        cols = np.floor((lng + 180) / self.cell_size).astype('int64')
+        return rows, cols
+
+    def _points_in(self, cells):
+        """``(query, point)`` pairs for the points inside each of ``cells``."""
+        start = np.searchsorted(self._cell_ids, cells, side='left')
+        counts = np.searchsorted(self._cell_ids, cells, side='right') - start
+        queries = np.repeat(np.arange(len(cells)), counts)
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return queries, np.repeat(start, counts) + within
+
+    def nearest(self, lat, lng):
+        """The nearest point to each query and its distance in km.
+
+        Returns the point's position in the arrays the index was built from
+        and the distance; ``-1`` and NaN for queries with missing coordinates
+        or when the index is empty.
+        """
+        lat = np.asarray(lat, dtype='float64')
+        lng = np.asarray(lng, dtype='float64')
+        best = np.full(len(lat), -1)
+        best_km = np.full(len(lat), np.inf)
+        pending = np.flatnonzero(~(np.isnan(lat) | np.isnan(lng)))
+        if self._bounds is None:
+            pending = pending[:0]
+        rows, cols = self._cells(lat, lng)
+        if len(pending):
+            # Beyond this many rings every cell lies outside the indexed area
+            row_min, row_max, col_min, col_max = self._bounds
+            last_ring = np.maximum.reduce([
+                np.abs(rows - row_min), np.abs(rows - row_max), np.abs(cols - col_min), np.abs(cols - col_max),
+            ])
+        radius = 0
+        while len(pending):
+            offsets = _ring(radius)
+            queries = np.repeat(pending, len(offsets))
+            cells = (rows[queries] + np.tile(offsets[:, 0], len(pending))) * self._columns + (
+                cols[queries] + np.tile(offsets[:, 1], len(pending)))
+            pairs, points = self._points_in(cells)
+            queries = queries[pairs]
+            km = haversine_km(lat[queries], lng[queries], self.lat[points], self.lng[points])
+            # Closest candidate per query: sort by query, then distance, and keep the first of each
+            order = np.lexsort((km, queries))
+            first = order[np.r_[True, queries[order][1:] != queries[order][:-1]]] if len(order) else order
+            closer = km[first] < best_km[queries[first]]
+            best[queries[first][closer]] = points[first][closer]
+            best_km[queries[first][closer]] = km[first][closer]
+            # Anything outside the scanned rings is at least `radius` whole cells away; a degree of
+            # longitude shrinks towards the poles, so measure it at the ring's highest latitude
+            edge_lat = np.minimum(np.abs(lat[pending]) + (radius + 1) * self.cell_size, 90)
+            reach_km = radius * self.cell_size * KM_PER_DEGREE * np.cos(np.radians(edge_lat))
+            done = (best_km[pending] <= reach_km) | (radius >= last_ring[pending])
+            pending = pending[~done]
+            radius += 1
+        found = best >= 0
+        positions = np.where(found, self.positions[np.where(found, best, 0)] if len(self) else -1, -1)
+        return positions, np.where(found, best_km, np.nan)
+
+
+def seller_index(sellers, geo_index, cell_size=0.25):
+    """:class:`GridIndex` over the distinct zip centroids of ``sellers``."""
+    zip_prefixes = pd.Series(sellers['seller_zip_code_prefix'].unique())
+    coordinates = geo_index.lookup_zip(zip_prefixes)
+    return GridIndex(coordinates['geolocation_lat'], coordinates['geolocation_lng'], cell_size)
+
+
+def item_distances(item_facts, geo_index):
+    """Great-circle km from each item's seller to its customer; NaN where a zip prefix is unknown."""
+    seller = geo_index.lookup_zip(item_facts['seller_zip_code_prefix'])
+    customer = geo_index.lookup_zip(item_facts['customer_zip_code_prefix'])
+    km = haversine_km(seller['geolocation_lat'], seller['geolocation_lng'],
+                      customer['geolocation_lat'], customer['geolocation_lng'])
+    return pd.Series(km, index=item_facts.index, name='distance_km')
+
+
+def nearest_seller_distances(zip_prefixes, index, geo_index):
+    """Km from each customer zip prefix to the nearest seller in ``index``."""
+    zip_prefixes = pd.Series(zip_prefixes)
+    # Each distinct prefix is queried once
+    codes, distinct = pd.factorize(zip_prefixes)
+    coordinates = geo_index.lookup_zip(pd.Series(distinct))
+    _, km = index.nearest(coordinates['geolocation_lat'], coordinates['geolocation_lng'])
+    km = np.append(km, np.nan)
+    return pd.Series(km[codes], index=zip_prefixes.index, name='nearest_seller_km')
+
+
+def state_delivery_distances(order_facts, item_facts, sellers, geo_index):
+    """Distance travelled and delivery time of order items per customer state.
+
+    Per state: the number of items whose seller and customer could both be
+    placed, their mean seller-to-customer distance, the mean distance from
+    their customers to the nearest seller, and the mean delivery time in days
+    of the delivered ones.
+    """
+    items = pd.DataFrame({
+        'customer_state': item_facts['customer_state'],
+        'distance_km': item_distances(item_facts, geo_index),
+        'nearest_seller_km': nearest_seller_distances(
+            item_facts['customer_zip_code_prefix'], seller_index(sellers, geo_index), geo_index
+        ).to_numpy(),
+        'delivery_days': order_facts['delivery_time'].reindex(item_facts['order_id']).to_numpy(),
+    })
+    stats = items.groupby('customer_state', observed=True).agg(
+        item_count=('distance_km', 'count'),
+        distance_km=('distance_km', 'mean'),
+        nearest_seller_km=('nearest_seller_km', 'mean'),
+        delivery_days=('delivery_days', 'mean'),
+    )
+    stats.index = stats.index.astype(object)
+    return stats.sort_values('distance_km', ascending=False, kind='stable').reset_index()
@@ -0,0 +1,116 @@
+"""Denormalised fact tables shared by every dashboard page.
+
+The raw tables have different grains, so two facts are built:
+
+* ``order_facts``: one row per order, indexed by ``order_id``, with the
+  customer's location, delivery time and the order's items, payments and
+  reviews rolled up. Review counts and score sums are kept next to the mean
+  so per-city averages weight every review exactly as a review-level join
+  would.
+* ``item_facts``: one row per order item with the product's English
+  category, the seller's location and the customer's location.
+
+Both are built with integer joins on the surrogate keys and cached as
+Parquet next to the tables they come from.
+"""
+
+from analytics import perf
+from analytics.ingest import DATA_DIR, build_caches, load_cached, load_tables, table_fingerprint
+from analytics.schema import memory_bytes
+
+ORDER_FACT_SOURCES = ['orders', 'customers', 'order_items', 'order_payments', 'order_reviews']
+ITEM_FACT_SOURCES = ORDER_FACT_SOURCES + ['products', 'product_category_trans', 'sellers']
+
+# Bump whenever the fact layout changes
+FACTS_VERSION = 1
+
+
+def build_order_facts(orders, customers, order_items, order_payments, order_reviews):
+    """Join the order-level tables into one row per order."""
+    facts = orders.merge(
+        customers[['customer_id', 'customer_unique_id', 'customer_zip_code_prefix', 'customer_city', 'customer_state']],
+        on='customer_id', how='left',
+    )
+    facts['delivery_time'] = (facts['order_delivered_customer_date'] - facts['order_purchase_timestamp']).dt.days
+    facts = facts.set_index('order_id')
+
+    items = order_items.groupby('order_id').agg(
+        item_count=('order_item_id', 'size'),
+        price=('price', 'sum'),
+        freight_value=('freight_value', 'sum'),
+    )
+    payments = order_payments.groupby('order_id').agg(
+        payment_count=('payment_sequential', 'size'),
+        payment_value=('payment_value', 'sum'),
+    )
+    # An order's main payment method is its first payment
+    first_payments = order_payments.sort_values('payment_sequential').drop_duplicates('order_id')
+    payments['payment_type'] = first_payments.set_index('order_id')['payment_type']
+    reviews = order_reviews.groupby('order_id').agg(
+        review_count=('review_score', 'size'),
+        review_score_sum=('review_score', 'sum'),
+    )
+    facts = facts.join([items, payments, reviews])
+
+    for column in ['item_count', 'payment_count', 'review_count']:
+        facts[column] = facts[column].fillna(0).astype('int16')
+    facts['review_score_sum'] = facts['review_score_sum'].fillna(0).astype('int32')
+    facts['review_score'] = facts['review_score_sum'] / facts['review_count'].where(facts['review_count'] > 0)
+    return facts
+
+
+def build_item_facts(order_facts, order_items, products, product_category_trans, sellers):
+    """Join order items with their product, seller and customer."""
+    english = dict(zip(
+        product_category_trans['product_category_name'].astype(str),
+        product_category_trans['product_category_name_english'].astype(str),
+    ))
+    product_columns = products[['product_id', 'product_category_name']].copy()
+    # Untranslated categories become missing, as with an inner join on the translation
+    product_columns['product_category_name_english'] = (
+        product_columns['product_category_name'].map(english).astype('category')
+    )
+    facts = order_items.merge(product_columns, on='product_id', how='left')
+    facts = facts.merge(
+        sellers[['seller_id', 'seller_zip_code_prefix', 'seller_city', 'seller_state']],
+        on='seller_id', how='left',
+    )
+    customer_columns = order_facts[['customer_zip_code_prefix', 'customer_city', 'customer_state']]
+    return facts.join(customer_columns, on='order_id')
+
+
+def _facts_fingerprint(sources, data_dir):
+    parts = [f'facts:{FACTS_VERSION}'.encode()] + [table_fingerprint(name, data_dir) for name in sources]
+    return b'|'.join(parts)
+
+
+def _stats(df):
+    return {'rows': len(df), 'bytes_after': memory_bytes(df)}
+
+
+def load_order_facts(data_dir=DATA_DIR):
+    """Load ``order_facts``, rebuilding it when any of its source tables changed."""
+    def build():
+        tables = load_tables(ORDER_FACT_SOURCES, data_dir)
+        with perf.span('build order_facts', rows_in=sum(map(len, tables.values()))) as record:
+            facts = build_order_facts(*(tables[name] for name in ORDER_FACT_SOURCES))
+            record['rows_out'] = len(facts)
+        return facts, _stats(facts)
+
+    return load_cached('order_facts', _facts_fingerprint(ORDER_FACT_SOURCES, data_dir), build, data_dir)
+
+
+def load_item_facts(data_dir=DATA_DIR):
+    """Load ``item_facts``, rebuilding it when any of its source tables changed."""
+    def build():
+        # Rebuild every stale source at once, not order facts' sources first
+        build_caches(ITEM_FACT_SOURCES, data_dir)
+        names = ['order_items', 'products', 'product_category_trans', 'sellers']
+        tables = load_tables(names, data_dir)
+        order_facts = load_order_facts(data_dir)
+        with perf.span('build item_facts', rows_in=len(order_facts) + sum(map(len, tables.values()))) as record:
+            facts = build_item_facts(order_facts, *(tables[name] for name in names))
+            record['rows_out'] = len(facts)
+        return facts, _stats(facts)
+
+    return load_cached('item_facts', _facts_fingerprint(ITEM_FACT_SOURCES, data_dir), build, data_dir)
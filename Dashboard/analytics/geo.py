@@ -0,0 +1,92 @@
+"""Centroid lookups over the geolocation table.
+
+The geolocation table has about a million rows with many coordinates per
+zip prefix and city. :class:`GeoIndex` averages them once into three small
+hash-indexed tables (by zip prefix, by city and by city and state) so pages
+can look up coordinates without scanning the full table.
+"""
+
+import numpy as np
+import pandas as pd
+
+COORDINATE_COLUMNS = ['geolocation_lat', 'geolocation_lng']
+
+
+def _positions(index, keys):
+    """Positions of ``keys`` in ``index``, with -1 for keys that are missing."""
+    if isinstance(getattr(keys, 'dtype', None), pd.CategoricalDtype):
+        # Look up each category once, then broadcast through the codes
+        codes = np.asarray(keys.cat.codes)
+        category_positions = index.get_indexer(keys.cat.categories.astype(object))
+        return np.where(codes >= 0, category_positions[codes], -1)
+    return index.get_indexer(keys)
+
+
+class GeoIndex:
+    """Average coordinates by zip prefix, by city and by (city, state)."""
+
+    def __init__(self, by_zip, by_city, by_city_state):
+        self.by_zip = by_zip
+        self.by_city = by_city
+        self.by_city_state = by_city_state
+
+    @classmethod
+    def from_geolocation(cls, geolocation_df):
+        coordinates = geolocation_df[COORDINATE_COLUMNS].astype('float64')
+        zip_prefix = geolocation_df['geolocation_zip_code_prefix']
+        city = geolocation_df['geolocation_city'].astype(object)
+        state = geolocation_df['geolocation_state'].astype(object)
+        return cls(
+            coordinates.groupby(zip_prefix).mean(),
+            coordinates.groupby(city).mean(),
+            coordinates.groupby([city, state]).mean(),
+        )
+
+    def _lookup(self, table, keys, index, errors):
+        positions = _positions(table.index, keys)
+        missing = positions == -1
+        if missing.any() and errors == 'raise':
+            missing_keys = pd.Series(np.asarray(keys, dtype=object)[missing]).unique()
+            raise KeyError(f'No coordinates for {len(missing_keys)} keys, e.g. {list(missing_keys[:5])}')
+        values = table.to_numpy()[positions]
+        values[missing] = np.nan
+        return pd.DataFrame(values, columns=COORDINATE_COLUMNS, index=index)
+
+    @staticmethod
+    def _index_of(keys):
+        return keys.index if isinstance(keys, pd.Series) else pd.RangeIndex(len(keys))
+
+    def lookup_zip(self, zip_prefixes, errors='coerce'):
+        """Coordinates for a batch of zip prefixes, aligned with the input.
+
+        Unknown prefixes get NaN coordinates, or raise ``KeyError`` when
+        ``errors='raise'``.
+        """
+        return self._lookup(self.by_zip, zip_prefixes, self._index_of(zip_prefixes), errors)
+
+    def lookup_city(self, cities, states=None, errors='coerce'):
+        """Coordinates for a batch of city names, optionally qualified by state.
+
+        Unknown cities get NaN coordinates, or raise ``KeyError`` when
+        ``errors='raise'``.
+        """
+        index = self._index_of(cities)
+        if states is None:
+            return self._lookup(self.by_city, cities, index, errors)
+        keys = pd.MultiIndex.from_arrays([np.asarray(cities, dtype=object), np.asarray(states, dtype=object)])
+        return self._lookup(self.by_city_state, keys, index, errors)
+
+    def with_city_coordinates(self, df, city_column):
+        """``df`` with the coordinates of its city column, dropping unknown cities."""
+        df = df.join(self.lookup_city(df[city_column]))
+        return df.dropna(subset=COORDINATE_COLUMNS)
+
+    def zip_centroid(self, zip_prefix):
+        """``(lat, lng)`` of one zip prefix; raises ``KeyError`` if unknown."""
+        return tuple(self.by_zip.loc[zip_prefix])
+
+    def city_centroid(self, city, state=None):
+        """``(lat, lng)`` of one city; raises ``KeyError`` if unknown."""
+        key = city if state is None else (city, state)
+        table = self.by_city if state is None else self.by_city_state
+        return tuple(table.loc[key])
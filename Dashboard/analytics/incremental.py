@@ -0,0 +1,180 @@
+"""Incremental ingestion of new order batches.
+
+:func:`append_batch` takes new rows for ``orders``, ``order_items``,
+``order_payments`` and ``order_reviews`` in the layout of the CSV exports,
+stores them as a batch under ``<data_dir>/deltas`` and brings the running
+aggregates up to date by adding the batch's own partial aggregates (counts
+and sums, and each customer's latest purchase per month) to the stored ones. The work is proportional to the batch, apart
+from key lookups into the existing tables.
+
+A batch that changes history (a row whose primary key already exists, or
+duplicated keys within the batch) cannot be added on top. Its rows still
+replace the old ones, but the aggregates are left to be recomputed in full
+the next time they are read.
+"""
+
+import os
+
+import pandas as pd
+
+from analytics import aggregates, segments, store
+from analytics.ingest import DATA_DIR, PRIMARY_KEYS, TABLES, cache_dir, load_table, write_delta
+from analytics.keys import file_lock
+from analytics.schema import apply_schema, concat_tables
+
+APPENDABLE_TABLES = list(PRIMARY_KEYS)
+
+# Partial aggregates kept up to date batch by batch
+RUNNING_AGGREGATES = ['city_stats', 'category_counts', 'payment_type_stats', 'review_score_counts', 'entity_counts',
+                      'customer_months']
+
+# How a batch's partial is added to the running one, where plain addition does not fit
+MERGES = {'customer_months': segments.merge_customer_months}
+
+
+def _prepare(name, df, data_dir):
+    """Clean a raw batch; returns the cleaned frame and its typed copy."""
+    cleaned = TABLES[name].clean(df.copy())
+    typed = apply_schema(name, cleaned.copy(), cache_dir(data_dir))
+    return cleaned, typed
+
+
+def _changes_history(name, typed, existing):
+    keys = PRIMARY_KEYS[name]
+    if typed.duplicated(keys).any():
+        return True
+    existing_keys = pd.MultiIndex.from_frame(existing[keys])
+    return pd.MultiIndex.from_frame(typed[keys]).isin(existing_keys).any()
+
+
+def _empty_like(df):
+    return df.iloc[:0]
+
+
+def _batch_city_stats(batch, existing, customers):
+    """City partials contributed by a batch of orders and reviews."""
+    cities = pd.Series(customers['customer_city'].to_numpy(), index=customers['customer_id'])
+    new_orders = batch.get('orders', _empty_like(existing['orders']))
+    all_orders = concat_tables([existing['orders'], new_orders])
+    order_cities = pd.Series(all_orders['customer_id'].map(cities).to_numpy(), index=all_orders['order_id'])
+
+    orders = new_orders.assign(
+        customer_city=new_orders['customer_id'].map(cities),
+        delivery_time=(new_orders['order_delivered_customer_date'] - new_orders['order_purchase_timestamp']).dt.days,
+    )
+    order_stats = orders.groupby('customer_city', observed=True).agg(
+        order_count=('order_id', 'size'),
+        delivery_time_sum=('delivery_time', 'sum'),
+        delivery_count=('delivery_time', 'count'),
+    )
+
+    # Reviews count once their order is known: new reviews of known orders, plus
+    # earlier reviews whose order only arrives now
+    new_reviews = batch.get('order_reviews', _empty_like(existing['order_reviews']))
+    earlier_reviews = existing['order_reviews'][existing['order_reviews']['order_id'].isin(new_orders['order_id'])]
+    reviews = concat_tables([new_reviews[new_reviews['order_id'].isin(all_orders['order_id'])], earlier_reviews])
+    reviews = reviews.assign(customer_city=reviews['order_id'].map(order_cities))
+    review_stats = reviews.groupby('customer_city', observed=True).agg(
+        review_count=('review_score', 'size'),
+        review_score_sum=('review_score', 'sum'),
+    )
+
+    stats = order_stats.join(review_stats, how='outer').fillna(0)
+    stats.index = stats.index.astype(object)
+    return stats
+
+
+def _batch_customer_months(batch, existing, customers):
+    """Customer-month partials contributed by a batch of orders and payments."""
+    unique_ids = pd.Series(customers['customer_unique_id'].to_numpy(), index=customers['customer_id'])
+    new_orders = batch.get('orders', _empty_like(existing['orders']))
+    all_orders = concat_tables([existing['orders'], new_orders])
+
+    # Payments count once their order is known: new payments of known orders, plus
+    # earlier payments whose order only arrives now
+    new_payments = batch.get('order_payments', _empty_like(existing['order_payments']))
+    earlier_payments = existing['order_payments'][existing['order_payments']['order_id'].isin(new_orders['order_id'])]
+    payments = concat_tables([new_payments[new_payments['order_id'].isin(all_orders['order_id'])], earlier_payments])
+    paid = payments.groupby('order_id')['payment_value'].sum()
+
+    orders = all_orders[all_orders['order_id'].isin(new_orders['order_id']) | all_orders['order_id'].isin(paid.index)]
+    order_facts = pd.DataFrame({
+        'customer_unique_id': orders['customer_id'].map(unique_ids).to_numpy(),
+        'order_purchase_timestamp': orders['order_purchase_timestamp'].to_numpy(),
+        'payment_value': orders['order_id'].map(paid).to_numpy(),
+    })
+    is_new = orders['order_id'].isin(new_orders['order_id']).to_numpy()
+    # Orders already counted only add their new payments
+    return segments.merge_customer_months(
+        segments.customer_months(order_facts[is_new]),
+        segments.customer_months(order_facts[~is_new]).assign(order_count=0),
+    )
+
+
+def _batch_category_counts(items, data_dir):
+    products = load_table('products', data_dir)
+    trans = load_table('product_category_trans', data_dir)
+    english = dict(zip(trans['product_category_name'].astype(str), trans['product_category_name_english'].astype(str)))
+    categories = pd.Series(products['product_category_name'].map(english).to_numpy(), index=products['product_id'])
+    counts = items['product_id'].map(categories).value_counts()
+    counts.index = counts.index.astype(object)
+    counts.index.name = 'product_category_name_english'
+    return counts.rename('order_count').to_frame()
+
+
+def _batch_partials(batch, existing, data_dir):
+    partials = {}
+    if 'orders' in batch or 'order_reviews' in batch:
+        partials['city_stats'] = _batch_city_stats(batch, existing, load_table('customers', data_dir))
+    if 'order_items' in batch:
+        partials['category_counts'] = _batch_category_counts(batch['order_items'], data_dir)
+    if 'order_payments' in batch:
+        partials['payment_type_stats'] = aggregates.payment_type_stats(batch['order_payments'])
+    if 'order_reviews' in batch:
+        partials['review_score_counts'] = aggregates.review_score_counts(batch['order_reviews'])
+    if 'orders' in batch or 'order_payments' in batch:
+        partials['customer_months'] = _batch_customer_months(batch, existing, load_table('customers', data_dir))
+    if 'orders' in batch:
+        partials['entity_counts'] = pd.DataFrame([{'customers': 0, 'orders': batch['orders']['order_id'].nunique(), 'products': 0}])
+    return partials
+
+
+def append_batch(batch, data_dir=DATA_DIR):
+    """Append new rows to the order tables and update the running aggregates.
+
+    ``batch`` maps table names from :data:`APPENDABLE_TABLES` to frames laid
+    out like the CSV exports. Returns ``True`` when the aggregates were
+    updated incrementally and ``False`` when the batch changed existing rows
+    and the aggregates will be recomputed in full.
+    """
+    unknown = set(batch) - set(APPENDABLE_TABLES)
+    if unknown:
+        raise ValueError(f'Cannot append to {sorted(unknown)}; appendable tables are {APPENDABLE_TABLES}')
+    batch = {name: df for name, df in batch.items() if len(df)}
+    if not batch:
+        return True
+
+    with file_lock(os.path.join(cache_dir(data_dir), 'append.lock')):
+        cleaned, typed = {}, {}
+        for name, df in batch.items():
+            cleaned[name], typed[name] = _prepare(name, df, data_dir)
+        existing = {name: load_table(name, data_dir) for name in ['orders', 'order_payments', 'order_reviews']}
+        for name in typed:
+            if name not in existing:
+                existing[name] = load_table(name, data_dir)
+
+        incremental = not any(_changes_history(name, typed[name], existing[name]) for name in typed)
+        if incremental:
+            # Read the running totals before the batch becomes part of their inputs
+            running = {name: store.materialize(name, data_dir) for name in RUNNING_AGGREGATES}
+            partials = _batch_partials(typed, existing, data_dir)
+
+        for name, df in cleaned.items():
+            write_delta(name, df, data_dir)
+
+        if incremental:
+            for name, current in running.items():
+                if name in partials:
+                    current = MERGES.get(name, aggregates.merge_partials)(current, partials[name])
+                store.save(name, current, data_dir)
+        return incremental
@@ -0,0 +1,364 @@
+"""Columnar ingestion of the Olist CSV exports.
+
+Every table is parsed and cleaned once, then written as a Parquet file under
+``<data_dir>/.cache``. Later loads memory-map that file instead of parsing the
+CSV again. The source file's size and modification time are stored in the
+Parquet metadata, so editing or replacing a CSV triggers a rebuild.
+
+Cached tables use the compact types from :mod:`analytics.schema`; the memory
+footprint before and after that conversion is recorded alongside and can be
+inspected with :func:`memory_report`.
+
+Stale tables can be rebuilt together with :func:`build_caches`, which parses
+their CSVs in parallel worker processes; :func:`load_tables` loads several
+tables at once on top of it.
+
+Rows appended later (see :mod:`analytics.incremental`) live as cleaned
+Parquet batches under ``<data_dir>/deltas/<table>`` and are applied on top of
+the cached CSV data whenever a table is loaded. A row in a later batch
+replaces an earlier row with the same primary key.
+"""
+
+import glob
+import json
+import os
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from analytics import perf
+from analytics.keys import vocabulary
+from analytics.schema import apply_schema, concat_tables, convert_columns, encode_keys, key_columns, memory_bytes
+
+DATA_DIR = 'Data'
+CACHE_DIR = '.cache'
+DELTAS_DIR = 'deltas'
+
+# Bump whenever a cleaning rule changes so stale Parquet files are rebuilt
+CACHE_VERSION = 2
+
+# Every timestamp in the exports is written like this
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Stands in for a missing review title or message
+NO_COMMENT = 'No Comments'
+
+_METADATA_KEY = b'olist_source'
+_STATS_KEY = b'olist_stats'
+
+TableSpec = namedtuple('TableSpec', ['filename', 'clean', 'read_options'])
+
+# Columns identifying a row, for the tables that accept appended batches
+PRIMARY_KEYS = {
+    'orders': ['order_id'],
+    'order_items': ['order_id', 'order_item_id'],
+    'order_payments': ['order_id', 'payment_sequential'],
+    'order_reviews': ['review_id', 'order_id'],
+}
+
+
+def _title_case(df, column):
+    # Title-case each distinct name once; every row then shares that string
+    names = df[column].dropna().unique()
+    df[column] = df[column].map(dict(zip(names, pd.Series(names, dtype=object).str.title())))
+    return df
+
+
+def _parse_dates(df, columns):
+    for column in columns:
+        try:
+            # A fixed format skips per-value format inference, several times faster
+            df[column] = pd.to_datetime(df[column], format=DATE_FORMAT)
+        except ValueError:
+            df[column] = pd.to_datetime(df[column], format='ISO8601')
+    return df
+
+
+def _clean_customers(df):
+    return _title_case(df, 'customer_city')
+
+
+def _clean_geolocation(df):
+    df = _title_case(df, 'geolocation_city')
+    return df.drop_duplicates(ignore_index=True)
+
+
+def _clean_orders(df):
+    return _parse_dates(df, [
+        'order_purchase_timestamp',
+        'order_approved_at',
+        'order_delivered_carrier_date',
+        'order_delivered_customer_date',
+        'order_estimated_delivery_date',
+    ])
+
+
+def _clean_order_items(df):
+    return _parse_dates(df, ['shipping_limit_date'])
+
+
+def _clean_order_reviews(df):
+    df = _parse_dates(df, ['review_creation_date', 'review_answer_timestamp'])
+    df['review_comment_title'] = df['review_comment_title'].fillna(NO_COMMENT)
+    df['review_comment_message'] = df['review_comment_message'].fillna(NO_COMMENT)
+    return df
+
+
+def _clean_products(df):
+    df['product_category_name'] = df['product_category_name'].fillna('Other Categories')
+    return df
+
+
+def _clean_sellers(df):
+    return _title_case(df, 'seller_city')
+
+
+def _no_cleaning(df):
+    return df
+
+
+TABLES = {
+    'customers': TableSpec('customers_dataset.csv', _clean_customers, {}),
+    'geolocation': TableSpec('geolocation_dataset.csv', _clean_geolocation, {'low_memory': False}),
+    'orders': TableSpec('orders_dataset.csv', _clean_orders, {}),
+    'order_items': TableSpec('order_items_dataset.csv', _clean_order_items, {}),
+    'order_payments': TableSpec('order_payments_dataset.csv', _no_cleaning, {}),
+    'order_reviews': TableSpec('order_reviews_dataset.csv', _clean_order_reviews, {}),
+    'products': TableSpec('products_dataset.csv', _clean_products, {}),
+    'product_category_trans': TableSpec('product_category_name_translation.csv', _no_cleaning, {}),
+    'sellers': TableSpec('sellers_dataset.csv', _clean_sellers, {}),
+}
+
+
+def source_path(name, data_dir=DATA_DIR):
+    return os.path.join(data_dir, TABLES[name].filename)
+
+
+def cache_dir(data_dir=DATA_DIR):
+    return os.path.join(data_dir, CACHE_DIR)
+
+
+def cache_path(name, data_dir=DATA_DIR):
+    return os.path.join(cache_dir(data_dir), f'{name}.parquet')
+
+
+def delta_paths(name, data_dir=DATA_DIR):
+    """Appended batches of a table, oldest first."""
+    return sorted(glob.glob(os.path.join(data_dir, DELTAS_DIR, name, '*.parquet')))
+
+
+def input_files(name, data_dir=DATA_DIR):
+    """Every file whose contents make up a table."""
+    return [source_path(name, data_dir)] + delta_paths(name, data_dir)
+
+
+def _source_fingerprint(name, data_dir):
+    # Raises FileNotFoundError with the missing path, which the dashboard reports
+    stat = os.stat(source_path(name, data_dir))
+    parts = [str(CACHE_VERSION), str(stat.st_size), str(stat.st_mtime_ns)]
+    # Codes are only meaningful against the vocabulary they were issued from
+    for column in key_columns(name):
+        parts.append(vocabulary(column, cache_dir(data_dir)).generation)
+    return ':'.join(parts).encode()
+
+
+def table_fingerprint(name, data_dir=DATA_DIR):
+    """Identify the current contents of a table: its CSV and appended batches."""
+    # Batch files are never modified, so their names identify them
+    deltas = [os.path.basename(path) for path in delta_paths(name, data_dir)]
+    return b':'.join([_source_fingerprint(name, data_dir)] + [delta.encode() for delta in deltas])
+
+
+def data_version(data_dir=DATA_DIR):
+    """Cheap token that changes whenever any table's CSV or batches change."""
+    parts = []
+    for name in TABLES:
+        try:
+            stat = os.stat(source_path(name, data_dir))
+        except FileNotFoundError:
+            continue
+        parts.append(f'{name}:{stat.st_size}:{stat.st_mtime_ns}')
+        parts.extend(os.path.basename(path) for path in delta_paths(name, data_dir))
+    return '|'.join(parts)
+
+
+def read_source(name, data_dir=DATA_DIR):
+    """Parse and clean a table straight from its CSV export."""
+    spec = TABLES[name]
+    # Every export starts with an Excel "sep=," hint line
+    df = pd.read_csv(source_path(name, data_dir), skiprows=1, **spec.read_options)
+    return spec.clean(df)
+
+
+def _is_cached(path, fingerprint):
+    try:
+        metadata = pq.read_schema(path).metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return False
+    return metadata.get(_METADATA_KEY) == fingerprint
+
+
+def _read_cache(path, fingerprint):
+    if not _is_cached(path, fingerprint):
+        return None
+    return pq.read_table(path, memory_map=True).to_pandas()
+
+
+def _parse_table(name, data_dir):
+    # Everything but the surrogate codes, so it can run in a worker process
+    df = read_source(name, data_dir)
+    bytes_before = memory_bytes(df)
+    return convert_columns(name, df), bytes_before
+
+
+def _finish_table(name, df, bytes_before, data_dir):
+    df = encode_keys(name, df, cache_dir(data_dir))
+    return df, {'rows': len(df), 'bytes_before': bytes_before, 'bytes_after': memory_bytes(df)}
+
+
+def build_table(name, data_dir=DATA_DIR):
+    """Read a table from its CSV and convert it to its compact schema.
+
+    Returns the typed frame and a dict with its row count and in-memory size
+    before and after the conversion.
+    """
+    with perf.span(f'parse {name}') as record:
+        df, stats = _finish_table(name, *_parse_table(name, data_dir), data_dir)
+        record['rows_out'] = len(df)
+    return df, stats
+
+
+def _write_cache(df, path, fingerprint, stats):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        table = pa.Table.from_pandas(df)
+        table = table.replace_schema_metadata({
+            **table.schema.metadata,
+            _METADATA_KEY: fingerprint,
+            _STATS_KEY: json.dumps(stats).encode(),
+        })
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(table, tmp_path)
+        # Atomic swap so concurrent readers never see a half-written file
+        os.replace(tmp_path, path)
+    except (OSError, pa.ArrowException):
+        # A read-only data directory only costs us the cache, not the data
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_cached(name, fingerprint, build, data_dir=DATA_DIR):
+    """Return the cached frame ``name`` if it matches ``fingerprint``.
+
+    Otherwise ``build()`` is called; it returns the frame and a dict of stats
+    that is stored with it.
+    """
+    path = cache_path(name, data_dir)
+    df = _read_cache(path, fingerprint)
+    if df is None:
+        df, stats = build()
+        _write_cache(df, path, fingerprint, stats)
+    return df
+
+
+def build_caches(names=None, data_dir=DATA_DIR, max_workers=None):
+    """Rebuild the stale Parquet caches of ``names`` (every table by default).
+
+    The CSVs are parsed and cleaned in parallel, one worker process per table,
+    so rebuilding takes about as long as the largest table. Surrogate codes
+    are then issued here, one table at a time in the order of ``names``, so
+    they come out the same as with sequential loads. Returns the names of the
+    rebuilt tables.
+    """
+    names = list(TABLES if names is None else names)
+    fingerprints = {name: _source_fingerprint(name, data_dir) for name in names}
+    stale = [name for name in names if not _is_cached(cache_path(name, data_dir), fingerprints[name])]
+    if not stale:
+        return stale
+
+    def finish(name, df, bytes_before):
+        df, stats = _finish_table(name, df, bytes_before, data_dir)
+        _write_cache(df, cache_path(name, data_dir), fingerprints[name], stats)
+
+    workers = min(len(stale), max_workers or os.cpu_count() or 1)
+    with perf.span(f'build_caches {", ".join(stale)}'):
+        if workers < 2:
+            for name in stale:
+                finish(name, *_parse_table(name, data_dir))
+            return stale
+        # Spawned rather than forked: the dashboard's server process runs threads
+        with ProcessPoolExecutor(workers, mp_context=get_context('spawn')) as pool:
+            # Largest files first, so the longest parse starts straight away
+            by_size = sorted(stale, key=lambda name: os.path.getsize(source_path(name, data_dir)), reverse=True)
+            parsed = {name: pool.submit(_parse_table, name, data_dir) for name in by_size}
+            for name in stale:
+                finish(name, *parsed.pop(name).result())
+    return stale
+
+
+def write_delta(name, df, data_dir=DATA_DIR):
+    """Store a cleaned batch of new rows for ``name``, keeping its original IDs."""
+    directory = os.path.join(data_dir, DELTAS_DIR, name)
+    os.makedirs(directory, exist_ok=True)
+    # Time-ordered names so later batches sort after earlier ones
+    path = os.path.join(directory, f'{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.parquet')
+    tmp_path = f'{path}.tmp'
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_deltas(name, data_dir=DATA_DIR):
+    """Appended batches of ``name`` in the compact schema, or ``None``."""
+    paths = delta_paths(name, data_dir)
+    if not paths:
+        return None
+    frames = [apply_schema(name, pd.read_parquet(path), cache_dir(data_dir)) for path in paths]
+    return concat_tables(frames)
+
+
+def load_table(name, data_dir=DATA_DIR):
+    """Load a cleaned table, rebuilding its Parquet cache when the CSV changed."""
+    with perf.span(f'load_table {name}') as record:
+        fingerprint = _source_fingerprint(name, data_dir)
+        df = load_cached(name, fingerprint, lambda: build_table(name, data_dir), data_dir)
+        deltas = load_deltas(name, data_dir)
+        if deltas is not None:
+            df = concat_tables([df, deltas])
+            df = df.drop_duplicates(PRIMARY_KEYS[name], keep='last', ignore_index=True)
+        record['rows_out'] = len(df)
+    return df
+
+
+def load_tables(names, data_dir=DATA_DIR, max_workers=None):
+    """Load several tables like :func:`load_table`; returns a dict by name.
+
+    Stale caches are rebuilt in parallel by :func:`build_caches`, then the
+    Parquet files are read by a thread pool (Arrow releases the GIL while
+    reading).
+    """
+    names = list(names)
+    build_caches(names, data_dir, max_workers)
+    with ThreadPoolExecutor(max(1, min(len(names), max_workers or os.cpu_count() or 1))) as pool:
+        return dict(zip(names, pool.map(lambda name: load_table(name, data_dir), names)))
+
+
+def memory_report(data_dir=DATA_DIR):
+    """Summarise the memory saved by the compact schema for each cached table."""
+    rows = []
+    for name in TABLES:
+        try:
+            metadata = pq.read_schema(cache_path(name, data_dir)).metadata or {}
+        except (OSError, pa.ArrowInvalid):
+            continue
+        if _STATS_KEY in metadata:
+            rows.append({'table': name, **json.loads(metadata[_STATS_KEY])})
+    report = pd.DataFrame(rows, columns=['table', 'rows', 'bytes_before', 'bytes_after'])
+    report['ratio'] = report['bytes_before'] / report['bytes_after']
+    return report
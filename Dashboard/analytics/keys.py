@@ -0,0 +1,134 @@
+"""Surrogate keys for the 32-character hex IDs.
+
+Each ID column (``order_id``, ``customer_id``, ...) has its own vocabulary
+stored under ``<data_dir>/.cache/keys``. A vocabulary only ever grows, so a
+code handed out once keeps meaning the same ID across rebuilds and processes.
+Every vocabulary file carries a random generation tag; cached tables record
+the tag they were encoded with and are rebuilt if the vocabulary is replaced.
+"""
+
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the in-process lock applies
+    fcntl = None
+
+KEYS_DIR = 'keys'
+
+_GENERATION_KEY = b'olist_generation'
+
+_vocabularies = {}
+_registry_lock = threading.Lock()
+
+
+@contextmanager
+def file_lock(path):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle = open(path, 'a') if fcntl else None
+    except OSError:
+        handle = None
+    if handle is None:
+        yield
+        return
+    with handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+class KeyVocabulary:
+    """Append-only mapping between hex IDs and dense int32 codes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ids = pd.Index([], dtype=object)
+        self._generation = None
+        self._mtime = None
+
+    def _refresh(self):
+        # Another process may have appended keys since we last looked
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        table = pq.read_table(self.path)
+        self._ids = pd.Index(table.column('id').to_numpy(zero_copy_only=False), dtype=object)
+        self._generation = table.schema.metadata[_GENERATION_KEY].decode()
+        self._mtime = mtime
+
+    def _save(self):
+        generation = self._generation or uuid.uuid4().hex
+        table = pa.table({'id': pa.array(self._ids.to_numpy(), type=pa.string())})
+        table = table.replace_schema_metadata({_GENERATION_KEY: generation.encode()})
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        self._generation = generation
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            pq.write_table(table, tmp_path)
+            os.replace(tmp_path, self.path)
+            self._mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            # Read-only data directory: the keys stay valid for this process
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @property
+    def generation(self):
+        with self._lock, file_lock(f'{self.path}.lock'):
+            self._refresh()
+            if self._generation is None:
+                self._save()
+            return self._generation
+
+    def __len__(self):
+        return len(self._ids)
+
+    def encode(self, values):
+        """Return int32 codes for ``values``, registering unseen IDs."""
+        values = pd.Index(values, dtype=object)
+        with self._lock:
+            codes = self._ids.get_indexer(values)
+            if (codes == -1).any():
+                with file_lock(f'{self.path}.lock'):
+                    self._refresh()
+                    codes = self._ids.get_indexer(values)
+                    missing = codes == -1
+                    if missing.any():
+                        new_ids = values[missing].drop_duplicates()
+                        # Check before saving, so an overflowing batch leaves the vocabulary untouched
+                        if len(self._ids) + len(new_ids) > np.iinfo(np.int32).max:
+                            raise OverflowError(f'{self.path} exceeds the int32 key space')
+                        self._ids = self._ids.append(new_ids)
+                        self._save()
+                        codes[missing] = self._ids.get_indexer(values[missing])
+        return codes.astype(np.int32)
+
+    def decode(self, codes):
+        """Map int32 codes back to their original hex IDs."""
+        with self._lock:
+            self._refresh()
+            return self._ids.take(np.asarray(codes))
+
+
+def vocabulary(name, cache_dir):
+    """Return the shared vocabulary for the ID column ``name``."""
+    path = os.path.join(cache_dir, KEYS_DIR, f'{name}.parquet')
+    with _registry_lock:
+        if path not in _vocabularies:
+            _vocabularies[path] = KeyVocabulary(path)
+        return _vocabularies[path]
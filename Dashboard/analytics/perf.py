@@ -0,0 +1,229 @@
+"""Timing spans for dashboard reruns and the analytics code they call.
+
+A rerun starts with :func:`start_run` and ends with :func:`finish_run`. In
+between, every :func:`span` (or function wrapped with :func:`traced`)
+records its wall time, CPU time, rows in and out and the change in resident
+memory. Spans nest, so a page section shows the loaders and aggregates it
+waited for. Outside a run, spans cost a thread-local lookup and record
+nothing.
+
+Runs are thread-local, matching Streamlit's one script thread per session.
+Work handed to another thread through :func:`bind` records its spans into
+the run that handed it over, under one top-level span per call; other
+threads record nothing. Resident memory belongs to the whole
+process, so with several sessions or threads running at once the memory
+deltas are only indicative.
+
+:func:`finish_run` appends one JSON line per rerun to a log that
+:func:`summarize` turns into p50/p95 latencies per page or per span.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import pandas as pd
+
+LOG_NAME = 'perf.jsonl'
+
+_local = threading.local()
+_log_lock = threading.Lock()
+
+
+def _rss():
+    # Current resident set, as opposed to the peak that analytics.bench reads
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def rows(value):
+    """Number of rows in a frame, or in the frames of a tuple or dict; ``None`` if unsized."""
+    if isinstance(value, (tuple, list)):
+        counts = [rows(part) for part in value]
+        return None if None in counts else sum(counts)
+    if isinstance(value, dict):
+        return rows(list(value.values()))
+    return len(value) if hasattr(value, '__len__') and not isinstance(value, str) else None
+
+
+class Run:
+    """Spans recorded during one rerun of a page."""
+
+    def __init__(self, page):
+        self.page = page
+        self.spans = []
+        # Worker threads bound to the run append to its spans too
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+
+    def summary(self):
+        return {
+            'time': self.started,
+            'page': self.page,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'wall_ms': (time.perf_counter() - self._wall) * 1000,
+            'cpu_ms': (time.thread_time() - self._cpu) * 1000,
+            'spans': list(self.spans),
+        }
+
+
+class _Branch:
+    """Spans of one call in another thread, collected apart until they join their run."""
+
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+
+
+def start_run(page):
+    """Start recording the spans of a rerun of ``page`` in this thread."""
+    _local.run = Run(page)
+    _local.depth = 0
+    return _local.run
+
+
+def current_run():
+    return getattr(_local, 'run', None)
+
+
+def bind(function, name=None):
+    """``function``, recording its spans into this thread's current run from whichever thread calls it.
+
+    Each call is timed as a top-level span ``"<name> (background)"``, with
+    ``name`` defaulting to the function's name, and the spans inside it are
+    nested under it. They are added to the run together once the call ends,
+    so calls running at the same time do not interleave.
+    """
+    run = current_run()
+    name = f'{name or function.__name__} (background)'
+
+    @wraps(function)
+    def bound(*args, **kwargs):
+        if run is None:
+            return function(*args, **kwargs)
+        previous = current_run(), getattr(_local, 'depth', 0)
+        branch = _Branch()
+        _local.run, _local.depth = branch, 0
+        try:
+            with span(name) as record:
+                result = function(*args, **kwargs)
+                record['rows_out'] = rows(result)
+                return result
+        finally:
+            _local.run, _local.depth = previous
+            with run.lock:
+                run.spans.extend(branch.spans)
+    return bound
+
+
+@contextmanager
+def span(name, rows_in=None):
+    """Time the enclosed block as ``name``.
+
+    Yields the span's record; set its ``rows_out`` to report output rows.
+    """
+    run = current_run()
+    if run is None:
+        yield {}
+        return
+    depth = getattr(_local, 'depth', 0)
+    record = {'name': name, 'depth': depth, 'rows_in': rows_in, 'rows_out': None}
+    with run.lock:
+        run.spans.append(record)
+    _local.depth = depth + 1
+    wall, cpu, rss = time.perf_counter(), time.thread_time(), _rss()
+    try:
+        yield record
+    finally:
+        _local.depth = depth
+        end_rss = _rss()
+        record['wall_ms'] = (time.perf_counter() - wall) * 1000
+        record['cpu_ms'] = (time.thread_time() - cpu) * 1000
+        record['memory_mb'] = None if rss is None or end_rss is None else (end_rss - rss) / 2 ** 20
+
+
+def traced(name=None):
+    """Decorator running the function inside ``span(name)`` and counting the rows it returns.
+
+    ``name`` defaults to the function's name.
+    """
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name or function.__name__) as record:
+                result = function(*args, **kwargs)
+                record['rows_out'] = rows(result)
+                return result
+        return wrapper
+    return decorate
+
+
+def finish_run(log_path=None):
+    """End this thread's run and return its summary, appending it to ``log_path`` if given."""
+    run = current_run()
+    if run is None:
+        return None
+    _local.run = None
+    summary = run.summary()
+    if log_path:
+        line = json.dumps(summary, default=str) + '\n'
+        try:
+            os.makedirs(os.path.dirname(log_path) or '.', exist_ok=True)
+            # Appends of one line are atomic, so server processes can share the log
+            with _log_lock, open(log_path, 'a') as log:
+                log.write(line)
+        except OSError:
+            # A read-only data directory only costs us the log
+            pass
+    return summary
+
+
+def spans_frame(summary):
+    """The spans of a run summary as a frame, names indented by nesting depth."""
+    spans = pd.DataFrame(summary['spans'], columns=['name', 'depth', 'wall_ms', 'cpu_ms', 'rows_in', 'rows_out', 'memory_mb'])
+    spans['name'] = ['  ' * depth + name for name, depth in zip(spans['name'], spans['depth'])]
+    return spans.drop(columns='depth')
+
+
+def read_log(log_path, since=None):
+    """One row per logged rerun, optionally only those from ``since`` (a timestamp) on."""
+    with open(log_path) as log:
+        runs = pd.DataFrame([json.loads(line) for line in log if line.strip()])
+    if runs.empty:
+        return runs
+    runs['time'] = pd.to_datetime(runs['time'], unit='s')
+    if since is not None:
+        runs = runs[runs['time'] >= pd.Timestamp(since)]
+    return runs.reset_index(drop=True)
+
+
+def _percentiles(wall_ms, group):
+    grouped = wall_ms.groupby(group, sort=True)
+    return pd.DataFrame({
+        'runs': grouped.size(),
+        'p50_ms': grouped.quantile(0.5),
+        'p95_ms': grouped.quantile(0.95),
+        'max_ms': grouped.max(),
+    })
+
+
+def summarize(log_path, by='page', since=None):
+    """p50/p95 wall time per page (``by='page'``) or per page and span (``by='span'``)."""
+    runs = read_log(log_path, since)
+    if runs.empty:
+        return pd.DataFrame(columns=['runs', 'p50_ms', 'p95_ms', 'max_ms'])
+    if by == 'page':
+        return _percentiles(runs['wall_ms'], runs['page'])
+    spans = runs[['page', 'spans']].explode('spans').dropna(subset=['spans'])
+    spans = pd.concat([spans['page'].reset_index(drop=True), pd.json_normalize(spans['spans'].tolist())], axis=1)
+    return _percentiles(spans['wall_ms'], [spans['page'], spans['name']])
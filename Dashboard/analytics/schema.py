@@ -0,0 +1,130 @@
+"""Compact column types for the nine Olist tables.
+
+Each table maps its columns to a storage type:
+
+* ``'key'``: a hex ID, replaced by an int32 code from the vocabulary of the
+  same name (see :mod:`analytics.keys`), so ``order_id`` joins stay integer
+  joins across every table.
+* ``'category'``: low-cardinality text, dictionary encoded by pandas.
+* any numpy dtype name: the column is downcast to it.
+
+Columns that are not listed keep the type pandas parsed them as.
+"""
+
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from analytics.keys import vocabulary
+
+SCHEMAS = {
+    'customers': {
+        'customer_id': 'key',
+        'customer_unique_id': 'key',
+        'customer_zip_code_prefix': 'int32',
+        'customer_city': 'category',
+        'customer_state': 'category',
+    },
+    'geolocation': {
+        'geolocation_zip_code_prefix': 'int32',
+        'geolocation_lat': 'float32',
+        'geolocation_lng': 'float32',
+        'geolocation_city': 'category',
+        'geolocation_state': 'category',
+    },
+    'orders': {
+        'order_id': 'key',
+        'customer_id': 'key',
+        'order_status': 'category',
+    },
+    'order_items': {
+        'order_id': 'key',
+        'order_item_id': 'int16',
+        'product_id': 'key',
+        'seller_id': 'key',
+    },
+    'order_payments': {
+        'order_id': 'key',
+        'payment_sequential': 'int16',
+        'payment_type': 'category',
+        'payment_installments': 'int16',
+    },
+    'order_reviews': {
+        'review_id': 'key',
+        'order_id': 'key',
+        'review_score': 'int8',
+    },
+    'products': {
+        'product_id': 'key',
+        'product_category_name': 'category',
+        'product_name_lenght': 'float32',
+        'product_description_lenght': 'float32',
+        'product_photos_qty': 'float32',
+        'product_weight_g': 'float32',
+        'product_length_cm': 'float32',
+        'product_height_cm': 'float32',
+        'product_width_cm': 'float32',
+    },
+    'product_category_trans': {
+        'product_category_name': 'category',
+        'product_category_name_english': 'category',
+    },
+    'sellers': {
+        'seller_id': 'key',
+        'seller_zip_code_prefix': 'int32',
+        'seller_city': 'category',
+        'seller_state': 'category',
+    },
+}
+
+
+def key_columns(name):
+    return [column for column, kind in SCHEMAS[name].items() if kind == 'key']
+
+
+def convert_columns(name, df):
+    """Convert every column of a cleaned table except its IDs to its compact type."""
+    for column, kind in SCHEMAS[name].items():
+        if column not in df or kind == 'key':
+            continue
+        if kind == 'category':
+            df[column] = df[column].astype('category')
+        else:
+            df[column] = df[column].astype(kind)
+    return df
+
+
+def encode_keys(name, df, cache_dir):
+    """Replace the ID columns of a table with their surrogate codes."""
+    for column in key_columns(name):
+        if column in df:
+            df[column] = vocabulary(column, cache_dir).encode(df[column])
+    return df
+
+
+def apply_schema(name, df, cache_dir):
+    """Convert a cleaned table to its compact storage types."""
+    return encode_keys(name, convert_columns(name, df), cache_dir)
+
+
+def decode_keys(column, codes, cache_dir):
+    """Map surrogate codes of the ID column ``column`` back to hex IDs."""
+    return pd.Series(vocabulary(column, cache_dir).decode(codes), name=column)
+
+
+def memory_bytes(df):
+    return int(df.memory_usage(index=False, deep=True).sum())
+
+
+def concat_tables(frames):
+    """Concatenate typed frames, keeping categorical columns categorical."""
+    frames = [df for df in frames if len(df)] or frames[:1]
+    if len(frames) == 1:
+        return frames[0]
+    frames = [df.copy() for df in frames]
+    for column, dtype in frames[0].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            # Give every frame the same categories so concat does not fall back to object
+            categories = union_categoricals([df[column] for df in frames], ignore_order=True).categories
+            for df in frames:
+                df[column] = df[column].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
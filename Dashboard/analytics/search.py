@@ -0,0 +1,139 @@
+"""Keyword search over review comments.
+
+:class:`ReviewIndex` is an inverted index over the review titles and
+messages: for every word, the sorted row numbers of the reviews that
+contain it. Text is lower-cased and accent-folded before it is split into
+words, so ``Atraso``, ``atraso`` and ``atrasó`` are the same word and a
+search for ``nao`` finds ``não``. Each distinct text is split only once,
+however many reviews repeat it.
+
+A query keeps the reviews containing all of its words; a word ending in
+``*`` matches every word that starts with it (``atras*`` finds ``atraso``
+and ``atrasou``). Posting lists are intersected shortest first, and the
+score and city filters are applied only to the rows that remain.
+"""
+
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+from analytics.ingest import NO_COMMENT
+
+TEXT_COLUMNS = ['review_comment_title', 'review_comment_message']
+
+_WORD = re.compile(r'[a-z0-9]+')
+
+
+def fold(text):
+    """``text`` in lower case without accents: ``Não`` becomes ``nao``."""
+    # Decomposing separates each accent from its letter, and the ASCII encoding drops it
+    return unicodedata.normalize('NFKD', text.lower()).encode('ascii', 'ignore').decode()
+
+
+def tokenize(text):
+    """The words of ``text`` after :func:`fold`, in order."""
+    return _WORD.findall(fold(text))
+
+
+def query_words(query):
+    """The words of a search query; a part ending in ``*`` makes its last word a prefix."""
+    words = []
+    for part in query.split():
+        found = tokenize(part)
+        if found and part.endswith('*'):
+            found[-1] += '*'
+        words.extend(found)
+    return words
+
+
+def _word_rows(texts):
+    """Distinct words of each distinct text of a column, how many rows hold that text, and those rows."""
+    codes, distinct = pd.factorize(texts)
+    words, owners = [], []
+    for position, text in enumerate(distinct):
+        if text == NO_COMMENT:
+            continue
+        found = set(tokenize(text))
+        words.extend(found)
+        owners.extend([position] * len(found))
+    owners = np.asarray(owners, dtype='int64')
+    # Rows of each distinct text, as runs of `order`
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes[codes >= 0], minlength=len(distinct))
+    starts = np.cumsum(counts) - counts + np.count_nonzero(codes < 0)
+    repeats = counts[owners]
+    within = np.arange(repeats.sum()) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    rows = order[np.repeat(starts[owners], repeats) + within]
+    return np.asarray(words, dtype=object), repeats, rows
+
+
+class ReviewIndex:
+    """Posting lists of review row numbers by folded word, with each row's score and city."""
+
+    def __init__(self, reviews, cities):
+        self.row_count = len(reviews)
+        columns = [_word_rows(reviews[column]) for column in TEXT_COLUMNS]
+        word_ids, self.words = pd.factorize(np.concatenate([words for words, _, _ in columns]), sort=True)
+        # One (word, row) pair for every row holding each text
+        word_ids = np.repeat(word_ids, np.concatenate([repeats for _, repeats, _ in columns]))
+        rows = np.concatenate([rows for _, _, rows in columns])
+        # Sorting (word, row) keys gives every posting list in row order, without duplicates
+        keys = np.unique(word_ids.astype('int64') * max(self.row_count, 1) + rows)
+        self._rows = (keys % max(self.row_count, 1)).astype('int32')
+        self._offsets = np.searchsorted(keys // max(self.row_count, 1), np.arange(len(self.words) + 1))
+        self.words = np.asarray(self.words, dtype=str)
+        self.scores = reviews['review_score'].to_numpy()
+        cities = pd.Categorical(cities)
+        self.cities = cities.categories
+        self._city_codes = cities.codes
+
+    @classmethod
+    def from_reviews(cls, reviews, order_facts):
+        """Index ``reviews``, placing each in the city of its order."""
+        cities = order_facts['customer_city'].reindex(reviews['order_id']).to_numpy()
+        return cls(reviews, cities)
+
+    def __len__(self):
+        return len(self.words)
+
+    def cities_of(self, rows):
+        """Customer city of each of ``rows``; missing where the review's order is unknown."""
+        return pd.Categorical.from_codes(self._city_codes[rows], self.cities)
+
+    def postings(self, word):
+        """Sorted rows containing ``word``, or any word starting with it if it ends in ``*``."""
+        if word.endswith('*'):
+            prefix = word[:-1]
+            first, last = np.searchsorted(self.words, [prefix, prefix + '\x7f'])
+            if last - first > 1:
+                return np.unique(self._rows[self._offsets[first]:self._offsets[last]])
+        else:
+            first = np.searchsorted(self.words, word)
+            last = first + 1 if first < len(self.words) and self.words[first] == word else first
+        return self._rows[self._offsets[first]:self._offsets[last]]
+
+    def search(self, query, scores=None, cities=None, within=None):
+        """Sorted rows matching every word of ``query`` and the given filters.
+
+        ``scores`` and ``cities`` keep rows with one of those review scores or
+        customer cities, and ``within`` is a boolean mask of rows to search in.
+        A query without words matches every row.
+        """
+        words = query_words(query)
+        if words:
+            lists = sorted((self.postings(word) for word in words), key=len)
+            rows = lists[0]
+            for other in lists[1:]:
+                rows = np.intersect1d(rows, other, assume_unique=True)
+        else:
+            rows = np.arange(self.row_count)
+        if scores:
+            rows = rows[np.isin(self.scores[rows], list(scores))]
+        if cities:
+            codes = self.cities.get_indexer(list(cities))
+            rows = rows[np.isin(self._city_codes[rows], codes[codes >= 0])]
+        if within is not None:
+            rows = rows[np.asarray(within)[rows]]
+        return rows
@@ -0,0 +1,230 @@
+"""Customer segments: RFM scores and monthly cohorts.
+
+Customers are told apart by ``customer_unique_id``, so a customer who
+ordered under several ``customer_id`` values counts once. Everything here
+is derived from one partial aggregate, :func:`customer_months`: the orders,
+amount paid and last purchase of every customer in every month they bought
+something. Its counts and sums add up across batches and its last purchase
+is a maximum, so :func:`merge_customer_months` brings it up to date from a
+batch alone.
+
+From it, :func:`customer_rfm` scores every customer on recency (days since
+their last purchase), frequency (orders) and monetary value (amount paid)
+and names their segment, and :func:`cohort_retention` counts how many
+customers of each first-purchase month bought again 1, 2, ... months later.
+Both work on whole arrays: the partial is kept sorted by customer and
+month, so each customer's months are one run of rows and per-customer
+totals are ``reduceat`` calls over the run starts.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Segment of each recency (rows) and frequency (columns) score, from 1 to 5
+SEGMENT_GRID = [
+    ['Hibernating', 'Hibernating', 'At Risk', 'At Risk', "Can't Lose"],
+    ['Hibernating', 'Hibernating', 'At Risk', 'At Risk', "Can't Lose"],
+    ['About To Sleep', 'About To Sleep', 'Need Attention', 'Loyal Customers', 'Loyal Customers'],
+    ['Promising', 'Potential Loyalists', 'Potential Loyalists', 'Loyal Customers', 'Loyal Customers'],
+    ['New Customers', 'Potential Loyalists', 'Potential Loyalists', 'Champions', 'Champions'],
+]
+
+# Segments from the most to the least valuable
+SEGMENTS = [
+    'Champions', 'Loyal Customers', 'Potential Loyalists', 'New Customers', 'Promising',
+    'Need Attention', 'About To Sleep', "Can't Lose", 'At Risk', 'Hibernating',
+]
+
+_SEGMENT_CODES = np.array([[SEGMENTS.index(name) for name in row] for row in SEGMENT_GRID], dtype='int8')
+
+
+def _month_numbers(timestamps):
+    # Months since January 1970
+    return np.asarray(timestamps, dtype='datetime64[ns]').astype('datetime64[M]').astype('int64')
+
+
+def _month_starts(numbers):
+    return np.asarray(numbers, dtype='int64').astype('datetime64[M]').astype('datetime64[ns]')
+
+
+def _run_starts(*keys):
+    """Where each run of equal keys starts, in arrays sorted by ``keys``."""
+    starts = np.zeros(len(keys[0]), dtype=bool)
+    starts[:1] = True
+    for key in keys:
+        starts[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(starts)
+
+
+def _reduce(ufunc, values, starts):
+    """``ufunc`` over each run of ``values`` beginning at ``starts``."""
+    return ufunc.reduceat(values, starts) if len(starts) else values[:0]
+
+
+def _sum_months(customers, months, order_counts, payment_values, last_purchases):
+    """Rows of the same customer and month added up; last purchases take the later."""
+    # One integer key per (customer, month) sorts faster than a lexsort on both
+    first = months.min(initial=0)
+    span = months.max(initial=0) - first + 1
+    keys = customers.astype('int64') * span + (months - first)
+    order = np.argsort(keys, kind='stable')
+    customers, months = customers[order], months[order]
+    starts = _run_starts(keys[order])
+    index = pd.MultiIndex.from_arrays(
+        [customers[starts], _month_starts(months[starts])], names=['customer_unique_id', 'month'],
+    )
+    last_purchases = np.asarray(last_purchases, dtype='datetime64[ns]')[order].view('int64')
+    return pd.DataFrame({
+        'order_count': _reduce(np.add, order_counts[order], starts),
+        'payment_value': _reduce(np.add, payment_values[order], starts),
+        'last_purchase': _reduce(np.maximum, last_purchases, starts).view('datetime64[ns]'),
+    }, index=index)
+
+
+def customer_months(order_facts):
+    """Orders, amount paid and last purchase per customer and purchase month, sorted by both."""
+    order_facts = order_facts[order_facts['customer_unique_id'].notna() & order_facts['order_purchase_timestamp'].notna()]
+    return _sum_months(
+        # IDs are int32 codes (see analytics.schema); a lookup with misses may have made them floats
+        order_facts['customer_unique_id'].to_numpy().astype('int32'),
+        _month_numbers(order_facts['order_purchase_timestamp']),
+        np.ones(len(order_facts), dtype='int64'),
+        order_facts['payment_value'].fillna(0).to_numpy(dtype='float64'),
+        order_facts['order_purchase_timestamp'].to_numpy(),
+    )
+
+
+def merge_customer_months(left, right):
+    """Add two :func:`customer_months` partials: counts and sums add up, last purchases take the later."""
+    merged = pd.concat([left, right])
+    return _sum_months(
+        merged.index.get_level_values('customer_unique_id').to_numpy(),
+        _month_numbers(merged.index.get_level_values('month')),
+        merged['order_count'].to_numpy(),
+        merged['payment_value'].to_numpy(),
+        merged['last_purchase'].to_numpy(),
+    ).astype(left.dtypes.to_dict())
+
+
+def _customer_starts(customer_months):
+    """``customer_months`` sorted by customer and month, and where each customer's rows start."""
+    if not customer_months.index.is_monotonic_increasing:
+        customer_months = customer_months.sort_index()
+    customers = customer_months.index.get_level_values('customer_unique_id').to_numpy()
+    return customer_months, _run_starts(customers)
+
+
+def _quintiles(values):
+    """Score from 1 to 5 by quintile of ``values``; equal values get the same score."""
+    values = np.asarray(values)
+    ranks = np.empty(len(values), dtype='int64')
+    if values.dtype.kind in 'iu' and len(values) and values.max() - values.min() < 1 << 20:
+        # Whole numbers such as days: count each value instead of sorting
+        ranks[:] = np.cumsum(np.bincount(values - values.min()))[values - values.min()]
+    else:
+        order = np.argsort(values)
+        ordered = values[order]
+        # Searching the sorted values for themselves is sequential, so much faster than in row order
+        ranks[order] = np.searchsorted(ordered, ordered, side='right')
+    return np.ceil(5 * ranks / max(len(values), 1)).astype('int8')
+
+
+def customer_rfm(customer_months, as_of=None):
+    """Recency, frequency and monetary value of every customer, with their scores and segment.
+
+    Recency is counted in days up to ``as_of``, by default the last purchase
+    in the data. Recency and monetary scores are quintiles; the frequency
+    score is the number of orders up to 5, since most customers order once.
+    """
+    customer_months, starts = _customer_starts(customer_months)
+    last_purchase = _reduce(np.maximum, customer_months['last_purchase'].to_numpy().view('int64'), starts)
+    if as_of is None:
+        as_of = last_purchase.max(initial=0)
+    else:
+        as_of = pd.Timestamp(as_of).value
+    recency = ((as_of - last_purchase) // (24 * 3600 * 10 ** 9)).astype('int32')
+    frequency = _reduce(np.add, customer_months['order_count'].to_numpy(), starts)
+    customers = pd.DataFrame({
+        'recency_days': recency,
+        'frequency': frequency,
+        'monetary': _reduce(np.add, customer_months['payment_value'].to_numpy(), starts),
+        'last_purchase': last_purchase.view('datetime64[ns]'),
+        'r_score': (6 - _quintiles(recency)).astype('int8'),
+        'f_score': np.minimum(frequency, 5).astype('int8'),
+    }, index=customer_months.index.get_level_values('customer_unique_id')[starts])
+    customers['m_score'] = _quintiles(customers['monetary'])
+    codes = _SEGMENT_CODES[customers['r_score'] - 1, customers['f_score'] - 1]
+    customers['segment'] = pd.Categorical.from_codes(codes, SEGMENTS)
+    return customers
+
+
+def rfm_segments(customer_rfm):
+    """Customers, their share and their average recency, frequency and spend per segment."""
+    grouped = customer_rfm.groupby('segment', observed=False)
+    segments = grouped.agg(
+        customer_count=('frequency', 'size'),
+        recency_days=('recency_days', 'mean'),
+        frequency=('frequency', 'mean'),
+        monetary=('monetary', 'mean'),
+        revenue=('monetary', 'sum'),
+    )
+    segments.insert(1, 'customer_share', segments['customer_count'] / max(len(customer_rfm), 1))
+    segments.index = segments.index.astype(object)
+    return segments.reset_index()
+
+
+def rfm_grid(customer_rfm):
+    """Customers and their average spend per recency and frequency score."""
+    grid = customer_rfm.groupby(['r_score', 'f_score']).agg(
+        customer_count=('monetary', 'size'),
+        monetary=('monetary', 'mean'),
+    )
+    return grid.reset_index()
+
+
+def cohort_retention(customer_months):
+    """Customers of each first-purchase month still buying 0, 1, 2, ... months later.
+
+    One row per cohort and period: the cohort's month, the months since the
+    first purchase, the customers who bought in that month and their share
+    of the cohort.
+    """
+    customer_months, starts = _customer_starts(customer_months)
+    months = _month_numbers(customer_months.index.get_level_values('month'))
+    if not len(months):
+        return pd.DataFrame({'cohort': _month_starts([]), 'period': months, 'customer_count': months, 'retention': []})
+    # Each customer's rows are sorted by month, so their cohort is the month of their first row
+    cohorts = np.repeat(months[starts], np.diff(np.append(starts, len(months))))
+    first, periods = cohorts.min(), months - cohorts
+    span = periods.max() + 1
+    counts = np.bincount((cohorts - first) * span + periods)
+    keys = np.flatnonzero(counts)
+    retention = pd.DataFrame({
+        'cohort': _month_starts(first + keys // span),
+        'period': keys % span,
+        'customer_count': counts[keys],
+    })
+    sizes = counts[(keys // span) * span]
+    retention['retention'] = retention['customer_count'] / sizes
+    return retention
+
+
+def retention_curve(cohort_retention):
+    """Share of customers buying again 1, 2, ... months after their first purchase, over all cohorts.
+
+    Each period averages only the cohorts old enough to have reached it,
+    weighted by cohort size.
+    """
+    retention = cohort_retention
+    sizes = retention.loc[retention['period'] == 0].set_index('cohort')['customer_count']
+    last = _month_numbers(retention['cohort']).max() if len(retention) else 0
+    periods = np.arange(1, int(retention['period'].max()) + 1) if len(retention) else np.zeros(0, dtype='int64')
+    # Cohort sizes of the cohorts that reached each period
+    ages = last - _month_numbers(sizes.index)
+    reached = (ages[None, :] >= periods[:, None]) @ sizes.to_numpy()
+    returning = retention.groupby('period')['customer_count'].sum().reindex(periods, fill_value=0).to_numpy()
+    return pd.DataFrame({
+        'period': periods,
+        'customer_count': returning,
+        'retention': returning / np.where(reached > 0, reached, np.nan),
+    })
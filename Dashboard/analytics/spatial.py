@@ -0,0 +1,127 @@
+"""Server-side spatial binning and map layers for point maps.
+
+Plotting every customer as its own marker overwhelms the browser. Instead,
+points are counted into square grid cells with NumPy and only the non-empty
+cells are sent to the map. Cell sizes follow web-map zoom levels, so each
+level draws cells of about the same size on screen.
+
+Smaller point sets, such as one marker per city, are sent as a single GeoJSON
+layer built column by column, with colours looked up in bulk, instead of one
+map object per marker.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Side of a grid cell on screen, in pixels of a 256px web-map tile
+CELL_PIXELS = 16
+
+# Zoom levels precomputed for the customer map (4 shows all of Brazil)
+ZOOM_LEVELS = [4, 5, 6]
+
+
+def cell_size_for_zoom(zoom, cell_pixels=CELL_PIXELS):
+    """Side of a grid cell in degrees at the given web-map zoom level."""
+    return 360 * cell_pixels / (256 * 2 ** zoom)
+
+
+def bin_points(lat, lng, cell_size):
+    """Count points per square cell of ``cell_size`` degrees.
+
+    Points with missing coordinates are ignored. Returns one row per
+    non-empty cell with its centre and point count.
+    """
+    lat = np.asarray(lat, dtype='float64')
+    lng = np.asarray(lng, dtype='float64')
+    valid = ~(np.isnan(lat) | np.isnan(lng))
+    row = np.floor((lat[valid] + 90) / cell_size).astype('int64')
+    col = np.floor((lng[valid] + 180) / cell_size).astype('int64')
+    columns = int(np.ceil(360 / cell_size)) + 1
+    cells, counts = np.unique(row * columns + col, return_counts=True)
+    row, col = np.divmod(cells, columns)
+    return pd.DataFrame({
+        'lat': (row + 0.5) * cell_size - 90,
+        'lng': (col + 0.5) * cell_size - 180,
+        'count': counts,
+    })
+
+
+def bin_points_by_zoom(lat, lng, zoom_levels=ZOOM_LEVELS):
+    """Bin the same points once per zoom level, keyed by zoom."""
+    return {zoom: bin_points(lat, lng, cell_size_for_zoom(zoom)) for zoom in zoom_levels}
+
+
+def cells_to_geojson(cells, cell_size, colors):
+    """Square polygons for binned cells as a GeoJSON FeatureCollection.
+
+    ``colors`` holds one fill colour per cell; the cell count is kept as a
+    property for tooltips.
+    """
+    half = cell_size / 2
+    west = (cells['lng'] - half).round(5).tolist()
+    east = (cells['lng'] + half).round(5).tolist()
+    south = (cells['lat'] - half).round(5).tolist()
+    north = (cells['lat'] + half).round(5).tolist()
+    features = [
+        {
+            'type': 'Feature',
+            'geometry': {'type': 'Polygon', 'coordinates': [[[w, s], [e, s], [e, n], [w, n], [w, s]]]},
+            'properties': {'count': count, 'color': color},
+        }
+        for w, e, s, n, count, color in zip(west, east, south, north, cells['count'].tolist(), list(colors))
+    ]
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def value_range(values):
+    """``(vmin, vmax)`` of the finite ``values``, for a colormap.
+
+    ``branca`` needs ``vmin < vmax``, so a single value gets a range of 1
+    above it and no values get ``(0, 1)``.
+    """
+    values = np.asarray(values, dtype='float64')
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return 0.0, 1.0
+    vmin, vmax = float(values.min()), float(values.max())
+    return (vmin, vmax) if vmax > vmin else (vmin, vmin + 1)
+
+
+def value_colors(values, colormap, steps=256):
+    """Hex colour of every value on ``colormap``.
+
+    ``colormap`` is a ``branca`` linear colormap (anything with ``vmin``,
+    ``vmax`` and ``rgb_hex_str``). It is evaluated at ``steps`` levels once,
+    then values are mapped to the nearest level; values outside the colormap's
+    range get its end colours. A colormap with ``vmin == vmax`` colours every
+    value with its first colour.
+    """
+    if not len(values):
+        return np.empty(0, dtype=object)
+    if not colormap.vmax > colormap.vmin:
+        return np.full(len(values), colormap.rgb_hex_str(colormap.vmin), dtype=object)
+    palette = np.array([colormap.rgb_hex_str(level) for level in np.linspace(colormap.vmin, colormap.vmax, steps)])
+    scale = (np.asarray(values, dtype='float64') - colormap.vmin) / max(colormap.vmax - colormap.vmin, 1e-9)
+    return palette[np.round(np.clip(scale, 0, 1) * (steps - 1)).astype(int)]
+
+
+def points_to_geojson(points, colors):
+    """Points as a GeoJSON FeatureCollection of ``Point`` features.
+
+    ``points`` has ``lat``, ``lng``, ``value`` and ``label`` columns; the value
+    and label are kept as properties for tooltips, next to one colour per
+    point from ``colors``.
+    """
+    lng = points['lng'].round(5).tolist()
+    lat = points['lat'].round(5).tolist()
+    features = [
+        {
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [x, y]},
+            'properties': {'value': value, 'label': label, 'color': color},
+        }
+        for x, y, value, label, color in zip(
+            lng, lat, points['value'].tolist(), points['label'].astype(str).tolist(), list(colors)
+        )
+    ]
+    return {'type': 'FeatureCollection', 'features': features}
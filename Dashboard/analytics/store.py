@@ -0,0 +1,291 @@
+"""Materialised aggregates persisted in SQLite.
+
+Each named aggregate in :data:`AGGREGATES` declares the source tables it
+reads and how to compute it. :func:`materialize` keys the result by a hash
+of the aggregate's name, version and parameters plus the content hashes of
+its source files (CSV exports and appended batches), stores it as Parquet bytes in
+``<data_dir>/.cache/aggregates.sqlite`` and serves it from there until an
+input file changes. Several server processes can share the same store.
+"""
+
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import time
+from collections import namedtuple
+
+import pandas as pd
+
+from analytics import aggregates, distance, perf, segments
+from analytics.facts import ITEM_FACT_SOURCES, ORDER_FACT_SOURCES, load_item_facts, load_order_facts
+from analytics.geo import GeoIndex
+from analytics.ingest import DATA_DIR, cache_dir, input_files, load_table
+from analytics.keys import vocabulary
+
+STORE_NAME = 'aggregates.sqlite'
+
+# Bump whenever an aggregate's definition changes
+AGGREGATES_VERSION = 2
+
+_HASH_CHUNK = 1 << 20
+
+# ``compute(resolve, data_dir, **params)`` builds the aggregate; ``resolve(name)``
+# returns another aggregate it is derived from
+Aggregate = namedtuple('Aggregate', ['sources', 'compute', 'defaults'])
+
+
+AGGREGATES = {
+    # Partial aggregates: plain counts and sums
+    'city_stats': Aggregate(
+        ORDER_FACT_SOURCES,
+        lambda resolve, data_dir: aggregates.city_stats(load_order_facts(data_dir)),
+        {},
+    ),
+    'category_counts': Aggregate(
+        ITEM_FACT_SOURCES,
+        lambda resolve, data_dir: aggregates.category_counts(load_item_facts(data_dir)),
+        {},
+    ),
+    'payment_type_stats': Aggregate(
+        ['order_payments'],
+        lambda resolve, data_dir: aggregates.payment_type_stats(load_table('order_payments', data_dir)),
+        {},
+    ),
+    'review_score_counts': Aggregate(
+        ['order_reviews'],
+        lambda resolve, data_dir: aggregates.review_score_counts(load_table('order_reviews', data_dir)),
+        {},
+    ),
+    'entity_counts': Aggregate(
+        ['customers', 'orders', 'products'],
+        lambda resolve, data_dir: aggregates.entity_counts(*(load_table(name, data_dir) for name in ['customers', 'orders', 'products'])),
+        {},
+    ),
+    'customer_months': Aggregate(
+        ORDER_FACT_SOURCES,
+        lambda resolve, data_dir: segments.customer_months(load_order_facts(data_dir)),
+        {},
+    ),
+    # Final aggregates shown on the pages
+    'top_bottom_cities_by_orders': Aggregate(
+        ORDER_FACT_SOURCES,
+        lambda resolve, data_dir, n: aggregates.top_bottom_cities_by_orders(resolve('city_stats'), n),
+        {'n': 15},
+    ),
+    'city_delivery_times': Aggregate(
+        ORDER_FACT_SOURCES,
+        lambda resolve, data_dir: aggregates.city_delivery_times(resolve('city_stats')),
+        {},
+    ),
+    'worst_rated_cities': Aggregate(
+        ORDER_FACT_SOURCES,
+        lambda resolve, data_dir, min_reviews: aggregates.worst_rated_cities(resolve('city_stats'), min_reviews),
+        {'min_reviews': 5},
+    ),
+    'category_order_counts': Aggregate(
+        ITEM_FACT_SOURCES,
+        lambda resolve, data_dir: aggregates.category_order_counts(resolve('category_counts')),
+        {},
+    ),
+    'payment_stats': Aggregate(
+        ['order_payments'],
+        lambda resolve, data_dir: aggregates.payment_stats(resolve('payment_type_stats')),
+        {},
+    ),
+    'review_score_distribution': Aggregate(
+        ['order_reviews'],
+        lambda resolve, data_dir: aggregates.review_score_distribution(resolve('review_score_counts')),
+        {},
+    ),
+    'overview_metrics': Aggregate(
+        ['customers', 'orders', 'products', 'order_reviews', 'order_payments'],
+        lambda resolve, data_dir: aggregates.overview_metrics(*(
+            resolve(name) for name in ['entity_counts', 'review_score_counts', 'payment_type_stats']
+        )),
+        {},
+    ),
+    'city_delivery_percentiles': Aggregate(
+        ORDER_FACT_SOURCES,
+        lambda resolve, data_dir: aggregates.delivery_percentiles(load_order_facts(data_dir), 'customer_city'),
+        {},
+    ),
+    'state_delivery_percentiles': Aggregate(
+        ORDER_FACT_SOURCES,
+        lambda resolve, data_dir: aggregates.delivery_percentiles(load_order_facts(data_dir), 'customer_state'),
+        {},
+    ),
+    'customer_rfm': Aggregate(
+        ORDER_FACT_SOURCES,
+        lambda resolve, data_dir: segments.customer_rfm(resolve('customer_months')),
+        {},
+    ),
+    'rfm_segments': Aggregate(
+        ORDER_FACT_SOURCES,
+        lambda resolve, data_dir: segments.rfm_segments(resolve('customer_rfm')),
+        {},
+    ),
+    'rfm_grid': Aggregate(
+        ORDER_FACT_SOURCES,
+        lambda resolve, data_dir: segments.rfm_grid(resolve('customer_rfm')),
+        {},
+    ),
+    'cohort_retention': Aggregate(
+        ORDER_FACT_SOURCES,
+        lambda resolve, data_dir: segments.cohort_retention(resolve('customer_months')),
+        {},
+    ),
+    'delivery_time_histogram': Aggregate(
+        ORDER_FACT_SOURCES,
+        lambda resolve, data_dir, max_days: aggregates.delivery_time_histogram(load_order_facts(data_dir), max_days),
+        {'max_days': 180},
+    ),
+    'state_delivery_distances': Aggregate(
+        ITEM_FACT_SOURCES + ['geolocation'],
+        lambda resolve, data_dir: distance.state_delivery_distances(
+            load_order_facts(data_dir), load_item_facts(data_dir), load_table('sellers', data_dir),
+            GeoIndex.from_geolocation(load_table('geolocation', data_dir)),
+        ),
+        {},
+    ),
+}
+
+# Customer segments, all derived from the per customer and month partial
+SEGMENT_AGGREGATES = ['customer_months', 'customer_rfm', 'rfm_segments', 'rfm_grid', 'cohort_retention']
+
+# Aggregates computed from the rows of the fact tables rather than from the cube's partial aggregates,
+# so neither the cube nor the chunked mode can derive them
+FACT_AGGREGATES = ['city_delivery_percentiles', 'state_delivery_percentiles', 'delivery_time_histogram',
+                   'state_delivery_distances'] + SEGMENT_AGGREGATES
+
+# Aggregates indexed by the surrogate codes of an ID column (see analytics.keys). Their keys include
+# the vocabulary's generation, since the same codes mean other IDs once the vocabulary is replaced
+CODE_INDEXED = {'customer_months': 'customer_unique_id', 'customer_rfm': 'customer_unique_id'}
+
+
+def _connect(data_dir):
+    path = os.path.join(cache_dir(data_dir), STORE_NAME)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30)
+    # WAL lets readers in other processes continue while one process writes
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS aggregates ('
+        'key TEXT PRIMARY KEY, name TEXT, params TEXT, created REAL, payload BLOB)'
+    )
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS file_hashes ('
+        'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT)'
+    )
+    return connection
+
+
+def file_digest(path, connection):
+    """Content hash of ``path``, reused while its size and mtime are unchanged."""
+    # Raises FileNotFoundError with the missing path, which the dashboard reports
+    stat = os.stat(path)
+    row = connection.execute(
+        'SELECT digest FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ?',
+        (os.path.abspath(path), stat.st_size, stat.st_mtime_ns),
+    ).fetchone()
+    if row:
+        return row[0]
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(_HASH_CHUNK), b''):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+    with connection:
+        connection.execute(
+            'INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)',
+            (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, digest),
+        )
+    return digest
+
+
+def aggregate_key(name, params, connection, data_dir=DATA_DIR):
+    aggregate = AGGREGATES[name]
+    digests = [
+        file_digest(path, connection)
+        for source in sorted(aggregate.sources)
+        for path in input_files(source, data_dir)
+    ]
+    if name in CODE_INDEXED:
+        digests.append(vocabulary(CODE_INDEXED[name], cache_dir(data_dir)).generation)
+    identity = json.dumps([name, AGGREGATES_VERSION, params, digests], sort_keys=True, default=str)
+    return hashlib.sha256(identity.encode()).hexdigest()
+
+
+def _to_bytes(df):
+    buffer = io.BytesIO()
+    df.to_parquet(buffer)
+    return buffer.getvalue()
+
+
+def _params(name, params):
+    return {**AGGREGATES[name].defaults, **params}
+
+
+def _put(connection, key, name, params, df):
+    with connection:
+        connection.execute(
+            'INSERT OR REPLACE INTO aggregates VALUES (?, ?, ?, ?, ?)',
+            (key, name, json.dumps(params, sort_keys=True), time.time(), _to_bytes(df)),
+        )
+
+
+def save(name, df, data_dir=DATA_DIR, **params):
+    """Store an already computed result for ``name`` under the current inputs."""
+    params = _params(name, params)
+    connection = _connect(data_dir)
+    try:
+        _put(connection, aggregate_key(name, params, connection, data_dir), name, params, df)
+    finally:
+        connection.close()
+
+
+def compute(name, data_dir=DATA_DIR, **params):
+    """Compute the aggregate ``name`` from the tables, bypassing the store."""
+    params = _params(name, params)
+    return AGGREGATES[name].compute(lambda dependency: compute(dependency, data_dir), data_dir, **params)
+
+
+def materialize(name, data_dir=DATA_DIR, **params):
+    """Return the aggregate ``name``, computing and storing it if needed."""
+    aggregate = AGGREGATES[name]
+    params = _params(name, params)
+    try:
+        connection = _connect(data_dir)
+    except (OSError, sqlite3.Error):
+        # No writable cache directory: compute without persisting
+        return compute(name, data_dir, **params)
+    try:
+        key = aggregate_key(name, params, connection, data_dir)
+        row = connection.execute('SELECT payload FROM aggregates WHERE key = ?', (key,)).fetchone()
+        if row:
+            return pd.read_parquet(io.BytesIO(row[0]))
+        with perf.span(f'compute {name}') as record:
+            df = aggregate.compute(lambda dependency: materialize(dependency, data_dir), data_dir, **params)
+            record['rows_out'] = len(df)
+        _put(connection, key, name, params, df)
+        return df
+    finally:
+        connection.close()
+
+
+def prune(data_dir=DATA_DIR):
+    """Drop stored results that no longer match the current input files."""
+    connection = _connect(data_dir)
+    try:
+        current = set()
+        for name, params in connection.execute('SELECT name, params FROM aggregates').fetchall():
+            if name in AGGREGATES:
+                current.add(aggregate_key(name, json.loads(params), connection, data_dir))
+        stored = [key for key, in connection.execute('SELECT key FROM aggregates').fetchall()]
+        stale = [(key,) for key in stored if key not in current]
+        with connection:
+            connection.executemany('DELETE FROM aggregates WHERE key = ?', stale)
+        return len(stale)
+    finally:
+        connection.close()
@@ -0,0 +1,429 @@
+"""Synthetic Olist-shaped data for benchmarks.
+
+:func:`generate` writes all nine CSV exports in the layout the loaders read:
+an Excel ``sep=,`` first line, the original column names and order, 32
+character hex IDs and ``YYYY-MM-DD HH:MM:SS`` timestamps. The tables are
+consistent with each other: every order has a customer, items point at
+existing products and sellers, payments add up to the order total, and
+customer and seller zip prefixes appear in the geolocation table.
+
+Scale 1 matches the size of the public dataset (about 99k orders); larger
+scales multiply customers, orders, products and sellers. The geography (zip
+prefixes, cities and their coordinates) describes the country rather than the
+business, so it is the same at every scale. Orders are written in chunks, so
+memory use does not grow with the scale. The output only depends on the scale
+and the seed.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from analytics.ingest import DATA_DIR, TABLES
+
+# Row counts of the public dataset, i.e. scale 1
+ORDERS = 99441
+PRODUCTS = 32951
+SELLERS = 3095
+ZIP_PREFIXES = 19015
+GEOLOCATION_POINTS_PER_ZIP = 52
+
+CHUNK_ORDERS = 250000
+MARKER = 'synthetic.json'
+
+_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+_FIRST_PURCHASE = pd.Timestamp('2016-09-04')
+_LAST_PURCHASE = pd.Timestamp('2018-10-17')
+
+# State, zip prefix range, approximate centre, share of customers, number of municipalities
+_STATES = [
+    ('SP', 1000, 19999, -22.5, -48.6, 0.420, 645),
+    ('RJ', 20000, 28999, -22.3, -42.7, 0.129, 92),
+    ('ES', 29000, 29999, -19.6, -40.7, 0.020, 78),
+    ('MG', 30000, 39999, -18.5, -44.6, 0.117, 853),
+    ('BA', 40000, 48999, -12.6, -41.7, 0.034, 417),
+    ('SE', 49000, 49999, -10.6, -37.4, 0.004, 75),
+    ('PE', 50000, 56999, -8.3, -37.9, 0.017, 185),
+    ('AL', 57000, 57999, -9.6, -36.6, 0.004, 102),
+    ('PB', 58000, 58999, -7.2, -36.7, 0.005, 223),
+    ('RN', 59000, 59999, -5.8, -36.6, 0.005, 167),
+    ('CE', 60000, 63999, -5.2, -39.5, 0.013, 184),
+    ('PI', 64000, 64999, -7.7, -42.7, 0.005, 224),
+    ('MA', 65000, 65999, -5.4, -45.4, 0.008, 217),
+    ('PA', 66000, 68899, -3.8, -52.5, 0.010, 144),
+    ('AP', 68900, 68999, 1.4, -51.8, 0.001, 16),
+    ('AM', 69000, 69299, -3.4, -64.5, 0.002, 62),
+    ('RR', 69300, 69399, 2.0, -61.4, 0.001, 15),
+    ('AC', 69900, 69999, -9.0, -70.5, 0.001, 22),
+    ('DF', 70000, 72799, -15.8, -47.9, 0.021, 1),
+    ('GO', 72800, 76799, -16.0, -49.6, 0.020, 246),
+    ('RO', 76800, 76999, -10.9, -62.8, 0.003, 52),
+    ('TO', 77000, 77999, -10.2, -48.3, 0.003, 139),
+    ('MT', 78000, 78899, -12.9, -55.9, 0.009, 141),
+    ('MS', 79000, 79999, -20.5, -54.6, 0.007, 79),
+    ('PR', 80000, 87999, -24.6, -51.6, 0.051, 399),
+    ('SC', 88000, 89999, -27.2, -50.5, 0.037, 295),
+    ('RS', 90000, 99999, -29.7, -53.2, 0.055, 497),
+]
+
+# Parts of generated municipality names
+_NAME_STARTS = ['são', 'santa', 'santo', 'nova', 'porto', 'campo', 'vila', 'rio', 'bom', 'boa', 'monte',
+                'alto', 'serra', 'lagoa', 'ponte', 'barra', 'cachoeira', 'morro', 'pedra', 'jardim']
+_NAME_MIDDLES = ['josé', 'maria', 'esperança', 'alegre', 'grande', 'verde', 'branco', 'bela', 'vista',
+                 'luzia', 'cruz', 'paulo', 'joão', 'aurora', 'fé', 'jesus', 'antônio', 'pedro', 'rita', 'clara']
+_NAME_ENDS = ['', ' do sul', ' do norte', ' da serra', ' do oeste', ' dos campos', ' das flores', ' do rio']
+
+_STATUSES = ['delivered', 'shipped', 'canceled', 'unavailable', 'invoiced', 'processing', 'created', 'approved']
+_STATUS_SHARES = [0.9702, 0.0111, 0.0063, 0.0061, 0.0032, 0.0030, 0.00005, 0.00015]
+
+_PAYMENT_TYPES = ['credit_card', 'boleto', 'voucher', 'debit_card', 'not_defined']
+_PAYMENT_SHARES = [0.7630, 0.1990, 0.0220, 0.0160, 0.00003]
+
+# Review score shares for orders delivered on time, late, and never delivered
+_SCORE_SHARES = np.array([
+    [0.07, 0.025, 0.08, 0.20, 0.625],
+    [0.45, 0.10, 0.13, 0.14, 0.18],
+    [0.70, 0.10, 0.10, 0.05, 0.05],
+])
+_REVIEW_TITLES = [
+    ['Não recebi', 'Péssimo', 'Ruim', 'Não recomendo'],
+    ['Bom', 'Regular', 'Razoável'],
+    ['Ótimo', 'recomendo', 'Super recomendo', 'Excelente', 'Muito bom'],
+]
+_REVIEW_MESSAGES = [
+    ['Não recebi o produto', 'Produto chegou com defeito', 'Entrega atrasada, muito tempo esperando',
+     'Péssimo atendimento', 'Veio faltando uma peça', 'Produto diferente do anunciado',
+     'Ainda aguardo a entrega do meu pedido', 'Não recomendo essa loja', 'Comprei dois e só chegou um'],
+    ['Produto ok', 'Atendeu as expectativas', 'Razoável, poderia ser melhor', 'A cor é diferente da foto',
+     'Chegou no prazo mas a embalagem estava danificada', 'Bom produto, entrega demorou um pouco'],
+    ['Produto chegou antes do prazo', 'Ótimo produto, recomendo', 'Muito bom', 'Excelente qualidade',
+     'Entrega rápida e produto conforme anunciado', 'Adorei, chegou bem embalado', 'Recomendo a loja',
+     'Tudo certo, obrigado', 'Produto de ótima qualidade, chegou rápido'],
+]
+
+# Salts giving each kind of ID its own, unrelated hex values
+_CUSTOMER_SALT = 1
+_UNIQUE_CUSTOMER_SALT = 2
+_ORDER_SALT = 3
+_PRODUCT_SALT = 4
+_SELLER_SALT = 5
+_REVIEW_SALT = 6
+
+
+def _mix(x):
+    # splitmix64 finaliser: a bijection on uint64, so distinct keys stay distinct
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def hex_ids(keys, salt):
+    """32 character hex IDs derived from integer ``keys``, like Olist's MD5 IDs."""
+    high = _mix(np.asarray(keys, dtype=np.uint64) ^ np.uint64(salt << 56))
+    low = _mix(high ^ np.uint64(salt))
+    digits = np.stack([high, low], axis=1).astype('>u8').tobytes().hex().encode()
+    return np.frombuffer(digits, dtype='S32').astype(str)
+
+
+def _rng(seed, *stream):
+    return np.random.default_rng([seed, *stream])
+
+
+def _write(df, path, header=True):
+    mode = 'w' if header else 'a'
+    with open(path, mode, encoding='utf-8', newline='') as handle:
+        if header:
+            handle.write('sep=,\n')
+        df.to_csv(handle, index=False, header=header, date_format=_DATE_FORMAT)
+
+
+def _zipf_weights(n, exponent=1.1):
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def _choose(rng, weights, size):
+    # Inverse CDF sampling, much faster than rng.choice with large weight arrays
+    return np.minimum(np.searchsorted(np.cumsum(weights), rng.random(size)), len(weights) - 1)
+
+
+def build_geography(seed=0):
+    """Municipalities and zip prefixes, identical at every scale.
+
+    Returns the cities frame (name, state, centre, customer weight) and the
+    zips frame (prefix, city index, centre), sorted by city.
+    """
+    rng = _rng(seed, 0)
+    shares = np.array([state[5] for state in _STATES])
+    zip_counts = np.round(ZIP_PREFIXES * shares ** 0.6 / (shares ** 0.6).sum()).astype(int)
+    names = np.array([start + ' ' + middle + end
+                      for start in _NAME_STARTS for middle in _NAME_MIDDLES for end in _NAME_ENDS])
+    cities, zips = [], []
+    for (state, zip_low, zip_high, lat, lng, share, city_count), zip_count in zip(_STATES, zip_counts):
+        zip_count = min(max(zip_count, city_count), zip_high - zip_low + 1)
+        city_names = rng.choice(names, city_count, replace=False)
+        weights = _zipf_weights(city_count)
+        first_city = sum(len(frame) for frame in cities)
+        cities.append(pd.DataFrame({
+            'city': city_names,
+            'state': state,
+            'lat': np.clip(lat + rng.normal(0, 1.5, city_count), -33.7, 5.2),
+            'lng': np.clip(lng + rng.normal(0, 1.5, city_count), -73.9, -34.8),
+            'weight': share * weights,
+        }))
+        # Every city gets one zip prefix, the rest go mostly to the large cities
+        prefixes = np.sort(rng.choice(np.arange(zip_low, zip_high + 1), zip_count, replace=False))
+        owners = np.concatenate([np.arange(city_count), _choose(rng, weights, zip_count - city_count)])
+        zips.append(pd.DataFrame({'zip': prefixes, 'city': first_city + rng.permutation(owners)}))
+    cities = pd.concat(cities, ignore_index=True)
+    cities['weight'] /= cities['weight'].sum()
+    zips = pd.concat(zips, ignore_index=True).sort_values(['city', 'zip'], ignore_index=True)
+    zips['lat'] = cities['lat'].to_numpy()[zips['city']] + rng.normal(0, 0.05, len(zips))
+    zips['lng'] = cities['lng'].to_numpy()[zips['city']] + rng.normal(0, 0.05, len(zips))
+    return cities, zips
+
+
+def _place(rng, cities, zips, size, weights):
+    """Draw ``size`` (city index, zip prefix) pairs, cities by ``weights``."""
+    city = _choose(rng, weights, size)
+    starts = np.searchsorted(zips['city'].to_numpy(), np.arange(len(cities)))
+    counts = np.diff(np.append(starts, len(zips)))
+    row = starts[city] + (rng.random(size) * counts[city]).astype(np.int64)
+    return city, zips['zip'].to_numpy()[row]
+
+
+def _geolocation(rng, cities, zips):
+    points = rng.poisson(GEOLOCATION_POINTS_PER_ZIP - 1, len(zips)) + 1
+    row = np.repeat(np.arange(len(zips)), points)
+    city = zips['city'].to_numpy()[row]
+    return pd.DataFrame({
+        'geolocation_zip_code_prefix': zips['zip'].to_numpy()[row],
+        'geolocation_lat': zips['lat'].to_numpy()[row] + rng.normal(0, 0.01, len(row)),
+        'geolocation_lng': zips['lng'].to_numpy()[row] + rng.normal(0, 0.01, len(row)),
+        'geolocation_city': cities['city'].to_numpy()[city],
+        'geolocation_state': cities['state'].to_numpy()[city],
+    })
+
+
+def _categories(reference_dir):
+    """Category translations from the shipped file, or generated ones if it is missing."""
+    path = os.path.join(reference_dir, TABLES['product_category_trans'].filename)
+    if os.path.exists(path):
+        return pd.read_csv(path, skiprows=1, encoding='utf-8-sig')
+    return pd.DataFrame({
+        'product_category_name': [f'categoria_{k}' for k in range(71)],
+        'product_category_name_english': [f'category_{k}' for k in range(71)],
+    })
+
+
+def _products(rng, count, categories):
+    category = _choose(rng, _zipf_weights(len(categories), 0.9), count)
+    category = categories['product_category_name'].to_numpy().astype(object)[category]
+    # About 2% of products have no category or description
+    unknown = rng.random(count) < 0.0185
+    category[unknown] = np.nan
+    described = pd.Series(~unknown)
+    weight = np.round(rng.lognormal(6.7, 1.2, count)).clip(2, 40425)
+    return pd.DataFrame({
+        'product_id': hex_ids(np.arange(count), _PRODUCT_SALT),
+        'product_category_name': category,
+        'product_name_lenght': pd.Series(rng.integers(5, 77, count), dtype='Int64').where(described),
+        'product_description_lenght': pd.Series(rng.integers(4, 3993, count), dtype='Int64').where(described),
+        'product_photos_qty': pd.Series(rng.integers(1, 7, count), dtype='Int64').where(described),
+        'product_weight_g': weight,
+        'product_length_cm': rng.integers(7, 106, count),
+        'product_height_cm': rng.integers(2, 106, count),
+        'product_width_cm': rng.integers(6, 119, count),
+    })
+
+
+def _sellers(rng, count, cities, zips):
+    # Sellers are even more concentrated in the south east than customers
+    weights = cities['weight'].to_numpy() ** 1.3
+    city, prefix = _place(rng, cities, zips, count, weights / weights.sum())
+    return pd.DataFrame({
+        'seller_id': hex_ids(np.arange(count), _SELLER_SALT),
+        'seller_zip_code_prefix': prefix,
+        'seller_city': cities['city'].to_numpy()[city],
+        'seller_state': cities['state'].to_numpy()[city],
+    })
+
+
+def _days(rng, shape, scale, size):
+    return pd.to_timedelta(rng.gamma(shape, scale, size) * 86400, unit='s').round('s')
+
+
+def _order_chunk(rng, first, count, geography, catalogue):
+    """Customers, orders, items, payments and reviews for orders ``first .. first+count``."""
+    cities, zips = geography
+    product_price, product_seller, product_weight, seller_ids, product_ids = catalogue
+    keys = np.arange(first, first + count, dtype=np.uint64)
+
+    # Customers: one per order, with about 3% of people ordering again
+    person = keys.copy()
+    repeat = rng.random(count) < 0.034
+    person[repeat] = (rng.random(repeat.sum()) * np.maximum(keys[repeat], 1)).astype(np.uint64)
+    city, prefix = _place(rng, cities, zips, count, cities['weight'].to_numpy())
+    customer_ids = hex_ids(keys, _CUSTOMER_SALT)
+    customers = pd.DataFrame({
+        'customer_id': customer_ids,
+        'customer_unique_id': hex_ids(person, _UNIQUE_CUSTOMER_SALT),
+        'customer_zip_code_prefix': prefix,
+        'customer_city': cities['city'].to_numpy()[city],
+        'customer_state': cities['state'].to_numpy()[city],
+    })
+
+    # Orders: more of them towards the end of the period, like the real growth
+    span = (_LAST_PURCHASE - _FIRST_PURCHASE).total_seconds()
+    purchase = _FIRST_PURCHASE + pd.to_timedelta(np.sqrt(rng.random(count)) * span, unit='s').round('s')
+    status = np.array(_STATUSES)[_choose(rng, _STATUS_SHARES, count)]
+    approved = pd.Series(purchase + pd.to_timedelta(rng.exponential(10 * 3600, count), unit='s').round('s'))
+    approved[status == 'created'] = pd.NaT
+    shipped = np.isin(status, ['delivered', 'shipped'])
+    carrier = pd.Series(approved + _days(rng, 2, 1.5, count)).where(shipped)
+    delivered = pd.Series(carrier + _days(rng, 3, 3.5, count)).where(status == 'delivered')
+    estimated = pd.Series(purchase.normalize() + pd.to_timedelta(rng.integers(10, 40, count), unit='D'))
+    order_ids = hex_ids(keys, _ORDER_SALT)
+    orders = pd.DataFrame({
+        'order_id': order_ids,
+        'customer_id': customer_ids,
+        'order_status': status,
+        'order_purchase_timestamp': purchase,
+        'order_approved_at': approved,
+        'order_delivered_carrier_date': carrier,
+        'order_delivered_customer_date': delivered,
+        'order_estimated_delivery_date': estimated,
+    })
+
+    # Items: mostly one per order, popular products sold far more often
+    item_counts = np.where(status == 'unavailable', 0, 1 + rng.poisson(0.14, count))
+    order = np.repeat(np.arange(count), item_counts)
+    product = (len(product_price) * rng.random(len(order)) ** 2.5).astype(np.int64)
+    freight = np.round(7 + rng.gamma(2, 4, len(order)) + product_weight[product] / 1000, 2)
+    items = pd.DataFrame({
+        'order_id': order_ids[order],
+        'order_item_id': np.arange(len(order)) - np.repeat(np.cumsum(item_counts) - item_counts, item_counts) + 1,
+        'product_id': product_ids[product],
+        'seller_id': seller_ids[product_seller[product]],
+        'shipping_limit_date': (approved.fillna(pd.Series(purchase)).to_numpy()[order]
+                                + np.timedelta64(6, 'D')),
+        'price': product_price[product],
+        'freight_value': freight,
+    })
+
+    # Payments: add up to the order total; a few orders combine vouchers with a card
+    total = np.bincount(order, weights=items['price'] + items['freight_value'], minlength=count)
+    total = np.where(item_counts == 0, np.round(rng.gamma(2, 70, count), 2), total)
+    payment_counts = np.where(rng.random(count) < 0.03, rng.integers(2, 5, count), 1)
+    payment_order = np.repeat(np.arange(count), payment_counts)
+    sequential = np.arange(len(payment_order)) - np.repeat(np.cumsum(payment_counts) - payment_counts, payment_counts) + 1
+    last = sequential == payment_counts[payment_order]
+    payment_type = np.array(_PAYMENT_TYPES)[_choose(rng, _PAYMENT_SHARES, len(payment_order))]
+    payment_type[~last] = 'voucher'
+    payment_type[last & (payment_counts[payment_order] > 1)] = 'credit_card'
+    share = rng.random(len(payment_order))
+    share = share / np.bincount(payment_order, weights=share, minlength=count)[payment_order]
+    value = np.round(total[payment_order] * share, 2)
+    value[payment_type == 'not_defined'] = 0
+    installments = np.where(payment_type == 'credit_card', _choose(rng, _zipf_weights(10, 1.2), len(payment_order)) + 1, 1)
+    payments = pd.DataFrame({
+        'order_id': order_ids[payment_order],
+        'payment_sequential': sequential,
+        'payment_type': payment_type,
+        'payment_installments': installments,
+        'payment_value': value,
+    })
+
+    # Reviews: nearly every order gets one, worse when the order was late or never arrived
+    reviewed = np.flatnonzero(rng.random(count) < 0.9978)
+    late = (delivered > estimated + pd.Timedelta(days=1)).to_numpy()[reviewed]
+    outcome = np.where(delivered.isna().to_numpy()[reviewed], 2, late.astype(int))
+    cumulative = np.cumsum(_SCORE_SHARES, axis=1)[outcome]
+    score = (rng.random(len(reviewed))[:, None] > cumulative).sum(axis=1).clip(0, 4) + 1
+    tone = np.select([score <= 2, score == 3], [0, 1], 2)
+    titles = _review_text(rng, _REVIEW_TITLES, tone, 0.12)
+    messages = _review_text(rng, _REVIEW_MESSAGES, tone, 0.41)
+    created = pd.Series(delivered.fillna(estimated).to_numpy()[reviewed]).dt.normalize() + pd.Timedelta(days=1)
+    reviews = pd.DataFrame({
+        'review_id': hex_ids(keys[reviewed], _REVIEW_SALT),
+        'order_id': order_ids[reviewed],
+        'review_score': score,
+        'review_comment_title': titles,
+        'review_comment_message': messages,
+        'review_creation_date': created,
+        'review_answer_timestamp': created + pd.to_timedelta(rng.exponential(3 * 86400, len(reviewed)), unit='s').round('s'),
+    })
+    return customers, orders, items, payments, reviews
+
+
+def _review_text(rng, banks, tone, share):
+    text = np.full(len(tone), np.nan, dtype=object)
+    written = rng.random(len(tone)) < share
+    for level, bank in enumerate(banks):
+        rows = written & (tone == level)
+        text[rows] = np.array(bank, dtype=object)[rng.integers(0, len(bank), rows.sum())]
+    return text
+
+
+def generate(out_dir, scale=1, seed=0, reference_dir=DATA_DIR, chunk_orders=CHUNK_ORDERS):
+    """Write a synthetic dataset of ``scale`` times the public one to ``out_dir``.
+
+    Category names are taken from the translation file in ``reference_dir``
+    when it exists. Returns the number of rows written per table.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    path = lambda name: os.path.join(out_dir, TABLES[name].filename)
+    rows = {}
+
+    cities, zips = build_geography(seed)
+    geolocation = _geolocation(_rng(seed, 1), cities, zips)
+    _write(geolocation, path('geolocation'))
+    rows['geolocation'] = len(geolocation)
+    del geolocation
+
+    categories = _categories(reference_dir)
+    _write(categories, path('product_category_trans'))
+    rows['product_category_trans'] = len(categories)
+
+    products = _products(_rng(seed, 2), round(PRODUCTS * scale), categories)
+    sellers = _sellers(_rng(seed, 3), round(SELLERS * scale), cities, zips)
+    _write(products, path('products'))
+    _write(sellers, path('sellers'))
+    rows['products'], rows['sellers'] = len(products), len(sellers)
+
+    rng = _rng(seed, 4)
+    catalogue = (
+        np.round(rng.lognormal(4.4, 0.9, len(products)).clip(0.85, 6735), 2),
+        (len(sellers) * rng.random(len(products)) ** 2).astype(np.int64),
+        products['product_weight_g'].to_numpy(),
+        sellers['seller_id'].to_numpy(),
+        products['product_id'].to_numpy(),
+    )
+    del products, sellers
+
+    names = ['customers', 'orders', 'order_items', 'order_payments', 'order_reviews']
+    total_orders = round(ORDERS * scale)
+    for chunk, first in enumerate(range(0, total_orders, chunk_orders)):
+        count = min(chunk_orders, total_orders - first)
+        frames = _order_chunk(_rng(seed, 5, chunk), first, count, (cities, zips), catalogue)
+        for name, frame in zip(names, frames):
+            _write(frame, path(name), header=chunk == 0)
+            rows[name] = rows.get(name, 0) + len(frame)
+
+    with open(os.path.join(out_dir, MARKER), 'w') as handle:
+        json.dump({'scale': scale, 'seed': seed, 'rows': rows}, handle, indent=2)
+    return rows
+
+
+def generated_scale(out_dir):
+    """``(scale, seed)`` of a complete synthetic dataset in ``out_dir``, or ``None``."""
+    try:
+        with open(os.path.join(out_dir, MARKER)) as handle:
+            marker = json.load(handle)
+    except (OSError, ValueError):
+        return None
+    return marker['scale'], marker['seed']
@@ -1,13 +1,22 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import wraps
+
 import streamlit as st
+import streamlit.components.v1 as components
+import numpy as np
 import pandas as pd
-import seaborn as sns
-import folium
-import branca.colormap as cm
-from streamlit_folium import st_folium
-import plotly.express as px
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from streamlit_option_menu import option_menu
 
-sns.set_style('whitegrid')
+from analytics import aggregates, cube, perf, segments, spatial
+from analytics.dataset import Dataset
+from analytics.ingest import cache_dir, data_version
+from analytics.schema import decode_keys
+from analytics.store import materialize
+
+# Plotting libraries (plotly, folium, branca) are imported inside the pages and functions that draw with them
 
 # Set page config
 st.set_page_config(
@@ -16,91 +25,329 @@ st.set_page_config(
     layout="wide"
 )
 
-# Function to load data
-@st.cache_data
-def load_customers():
-    customers_df = pd.read_csv('Data/customers_dataset.csv', skiprows=1)
-    customers_df['customer_city'] = customers_df['customer_city'].str.title()
-    return customers_df
-
-@st.cache_data
-def load_geolocation():
-    geolocation_df = pd.read_csv('Data/geolocation_dataset.csv', low_memory=False, skiprows=1)
-    geolocation_df['geolocation_city'] = geolocation_df['geolocation_city'].str.title()
-    geolocation_df.drop_duplicates(inplace=True)
-    return geolocation_df
-
-@st.cache_data
-def load_orders():
-    orders_df = pd.read_csv('Data/orders_dataset.csv', skiprows=1)
-    orders_df['order_purchase_timestamp'] = pd.to_datetime(orders_df['order_purchase_timestamp'])
-    orders_df['order_approved_at'] = pd.to_datetime(orders_df['order_approved_at'])
-    orders_df['order_delivered_carrier_date'] = pd.to_datetime(orders_df['order_delivered_carrier_date'])
-    orders_df['order_delivered_customer_date'] = pd.to_datetime(orders_df['order_delivered_customer_date'])
-    orders_df['order_estimated_delivery_date'] = pd.to_datetime(orders_df['order_estimated_delivery_date'])
-    return orders_df
-
-@st.cache_data
-def load_order_items():
-    order_items_df = pd.read_csv('Data/order_items_dataset.csv', skiprows=1)
-    order_items_df['shipping_limit_date'] = pd.to_datetime(order_items_df['shipping_limit_date'])
-    return order_items_df
-
-@st.cache_data
-def load_order_payments():
-    return pd.read_csv('Data/order_payments_dataset.csv', skiprows=1)
-
-@st.cache_data
-def load_order_reviews():
-    order_reviews_df = pd.read_csv('Data/order_reviews_dataset.csv', skiprows=1)
-    order_reviews_df['review_creation_date'] = pd.to_datetime(order_reviews_df['review_creation_date'])
-    order_reviews_df['review_answer_timestamp'] = pd.to_datetime(order_reviews_df['review_answer_timestamp'])
-    order_reviews_df['review_comment_title'].fillna('No Comments', inplace=True)
-    order_reviews_df['review_comment_message'].fillna('No Comments', inplace=True)
-    return order_reviews_df
-
-@st.cache_data
-def load_products():
-    products_df = pd.read_csv('Data/products_dataset.csv', skiprows=1)
-    products_df['product_category_name'].fillna('Other Categories', inplace=True)
-    return products_df
-
-@st.cache_data
-def load_product_category_trans():
-    return pd.read_csv('Data/product_category_name_translation.csv', skiprows=1)
-
-@st.cache_data
-def load_seller():
-    seller_df = pd.read_csv('Data/sellers_dataset.csv', skiprows=1)
-    seller_df['seller_city'] = seller_df['seller_city'].str.title()
-    return seller_df
-
-# Load data with caching
-customers_df = load_customers()
-geolocation_df = load_geolocation()
-orders_df = load_orders()
-order_items_df = load_order_items()
-order_payment_df = load_order_payments()
-order_reviews_df = load_order_reviews()
-products_df = load_products()
-product_category_trans_df = load_product_category_trans()
-seller_df = load_seller()
+# perf.traced spans inside cached functions only show up on cache misses. Page data is loaded in
+# background threads (see load_page_data), so the loaders below show no spinner of their own
+
+# One dataset per process, shared read-only by all sessions (see analytics.dataset). Its tables, fact
+# tables and cube are each loaded the first time a page asks for them, and kept until `version`
+# changes. `python -m analytics warm` only builds their disk caches; this process still loads them,
+# all at once in the background when PRELOAD is set.
+# cache_resource hands every session the same object instead of a deserialized copy
+@st.cache_resource(max_entries=1)
+@perf.traced()
+def load_dataset(version):
+    dataset = Dataset.load()
+    if PRELOAD:
+        # Pages still load what they need first; the preload skips whatever they already loaded
+        threading.Thread(target=dataset.preload, name='dashboard-preload', daemon=True).start()
+    return dataset
+
+# Chart aggregates, materialized on disk so they survive restarts and are shared by server processes
+@st.cache_data(show_spinner=False)
+@perf.traced()
+def load_aggregate(version, name, **params):
+    return materialize(name, **params)
+
+# The cube holds counts and sums per day, state, city, category and payment type; filters roll it up instead of rescanning orders
+@st.cache_data(max_entries=1)
+@perf.traced()
+def load_filter_options(version):
+    cube_df = load_dataset(version)['cube']
+    return {
+        'first_day': cube_df['day'].min().date(),
+        'last_day': cube_df['day'].max().date(),
+        'states': sorted(cube_df['customer_state'].dropna().unique()),
+        'categories': sorted(cube_df['category'].dropna().unique()),
+    }
 
-# Load data
-try:
-    customers_df = load_customers()
-    geolocation_df = load_geolocation()
-    orders_df = load_orders()
-    order_items_df = load_order_items()
-    order_payment_df = load_order_payments()
-    order_reviews_df = load_order_reviews()
-    products_df = load_products()
-    product_category_trans_df = load_product_category_trans()
-    seller_df = load_seller()
-except FileNotFoundError as e:
-    missing_file = str(e).split("'")[1]
-    st.error(f'File not found: {missing_file}. Please ensure all dataset files are in the "Data" directory of this script.')
-    st.stop()
+# Aggregates of the filtered orders, rolled up from the cube and the fact tables
+@st.cache_data(max_entries=32, show_spinner=False)
+@perf.traced()
+def load_filtered_aggregate(version, filters, name):
+    return load_dataset(version).filtered(name, filters)
+
+# Customers counted per map grid cell at every zoom level, placed by zip prefix
+@st.cache_data(max_entries=8, show_spinner=False)
+@perf.traced()
+def load_customer_grid(version, filters):
+    dataset = load_dataset(version)
+    if cube.is_active(filters):
+        order_facts_df = dataset['order_facts']
+        zip_codes = order_facts_df.loc[cube.order_mask(dataset['order_dimensions'], filters), 'customer_zip_code_prefix']
+    else:
+        zip_codes = dataset['customers']['customer_zip_code_prefix']
+    coordinates = dataset.geo_index.lookup_zip(zip_codes)
+    return spatial.bin_points_by_zoom(coordinates['geolocation_lat'], coordinates['geolocation_lng'])
+
+@st.cache_data(max_entries=8, show_spinner=False)
+@perf.traced()
+def load_delivery_summary(version, filters):
+    return cube.mean_and_std(cube.slice_cube(load_dataset(version)['cube'], filters), 'delivery_time', 'delivery_count')
+
+# Orders inside the sidebar filters, summed from the cube
+@st.cache_data(max_entries=32, show_spinner=False)
+@perf.traced()
+def load_order_count(version, filters):
+    return int(cube.slice_cube(load_dataset(version)['cube'], filters)['order_count'].sum())
+
+# Data each page needs, in the order the page draws it. Only these, and the dataset frames they are
+# computed from, are loaded when the page is opened; the sidebar filters always load the cube.
+# The city maps load their own data (see the map functions below)
+PAGE_DATA = {
+    "🏠 Overview": ['overview_metrics'],
+    "🌍 Customer Distribution": ['customer_grid'],
+    "🚚 Delivery Analysis": ['delivery_summary', 'delivery_time_histogram', 'city_delivery_times', 'city_delivery_percentiles',
+                            'state_delivery_percentiles', 'state_delivery_distances'],
+    "⭐ Customer Reviews": ['review_score_distribution', 'worst_rated_cities'],
+    "📦 Product Analysis": ['category_order_counts'],
+    "💳 Payment Analysis": ['payment_stats'],
+    "👥 Customer Segments": ['rfm_segments', 'rfm_grid', 'cohort_retention'],
+}
+
+# Data that depends on the sidebar filters
+FILTERED_LOADERS = {
+    'customer_grid': load_customer_grid,
+    'delivery_summary': load_delivery_summary,
+}
+
+# The biggest spenders of one segment, with their original customer IDs. Reads the per-customer
+# scores without keeping them in the cache, since there is a row for every customer
+@st.cache_data(max_entries=32, show_spinner=False)
+@perf.traced()
+def load_segment_customers(version, filters, segment, n=100):
+    if cube.is_active(filters):
+        customer_rfm = load_dataset(version).filtered('customer_rfm', filters)
+    else:
+        customer_rfm = materialize('customer_rfm')
+    top = customer_rfm[customer_rfm['segment'] == segment].nlargest(n, 'monetary')
+    ids = decode_keys('customer_unique_id', top.index.to_numpy(), cache_dir())
+    return top.reset_index(drop=True).assign(customer_unique_id=ids.to_numpy())
+
+def load_page_item(version, filters, name):
+    dataset = load_dataset(version)
+    # Tables and fact tables come straight from the shared dataset
+    if name == 'geo_index':
+        return dataset.geo_index
+    if name in dataset:
+        return dataset[name]
+    if name in FILTERED_LOADERS:
+        return FILTERED_LOADERS[name](version, filters)
+    # Anything else is an aggregate: materialized for all orders, rolled up from the cube when filtered
+    if cube.is_active(filters):
+        return load_filtered_aggregate(version, filters, name)
+    return load_aggregate(version, name)
+
+# Worker threads shared by all sessions: page data and maps are computed there while the script draws what is ready
+@st.cache_resource
+def background_pool():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix='dashboard-background')
+
+def in_background(function, *args, name=None):
+    # Workers need the session's script context to use st.cache_data. Tasks call the cached loaders
+    # rather than waiting on other tasks, so a full pool can never wait on work queued behind it
+    ctx = get_script_run_ctx()
+    # The task's spans (loads, aggregate computations) go into this rerun's timings, under `name`
+    function = perf.bind(function, name)
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return function(*args)
+    return background_pool().submit(run)
+
+class PageData:
+    # A page's data by name, loading in the background; reading an item waits for it
+    def __init__(self, version, filters, futures):
+        self.version = version
+        self.filters = filters
+        self.futures = futures
+
+    def __getitem__(self, name):
+        future = self.futures[name]
+        if future.done():
+            return future.result()
+        with perf.span(f'wait for {name}') as record:
+            record['rows_out'] = perf.rows(future.result())
+            return future.result()
+
+    def background(self, function, *args):
+        # Start `function(version, filters, *args)`, e.g. building a map, next to the page data
+        return in_background(function, self.version, self.filters, *args)
+
+def load_page_data(page, filters):
+    version = data_version()
+    # Loaded here rather than in a worker, so a missing file stops the page before anything is drawn
+    load_dataset(version)
+    return PageData(version, filters, {name: in_background(load_page_item, version, filters, name, name=f'load {name}') for name in PAGE_DATA[page]})
+
+# Sections whose content is computed in the background: a placeholder keeps their spot and
+# fill_deferred draws them once the rest of the page is out. Their work is started where the
+# placeholder is drawn, after the sections above it, so it does not hold up the first chart
+deferred = []
+# Set once the whole page is out: a fragment rerun then fills its own sections straight away
+page_drawn = False
+
+def defer(name, future, draw, message="Drawing the map..."):
+    placeholder = st.empty()
+    placeholder.info(message)
+    deferred.append((name, placeholder, future, draw))
+
+def fill_deferred():
+    # In the order the results arrive
+    sections = {future: (name, placeholder, draw) for name, placeholder, future, draw in deferred}
+    for future in as_completed(sections):
+        name, placeholder, draw = sections[future]
+        with perf.span(name), placeholder.container():
+            draw(future.result())
+    deferred.clear()
+
+def timed_fragment(function):
+    # A fragment rerun runs only the fragment, after the page's run has been logged, so it
+    # times and logs itself as "<page>: <fragment>". In a full rerun it is part of the page's run
+    @wraps(function)
+    def run(*args, **kwargs):
+        if perf.current_run() is not None:
+            return function(*args, **kwargs)
+        perf.start_run(f"{page}: {function.__name__}")
+        try:
+            return function(*args, **kwargs)
+        finally:
+            perf.finish_run(PERF_LOG)
+    return run
+
+def sidebar_filters():
+    options = load_filter_options(data_version())
+    with st.sidebar:
+        st.markdown("### Filters")
+        days = st.date_input("Purchase date", value=(options['first_day'], options['last_day']),
+                             min_value=options['first_day'], max_value=options['last_day'])
+        states = st.multiselect("Customer state", options['states'])
+        categories = st.multiselect("Product category", options['categories'])
+    # While a range is being picked only its first day is set
+    start, end = (tuple(days) + (None, None))[:2]
+    return cube.Filters(
+        start=start if start and start > options['first_day'] else None,
+        end=end if end and end < options['last_day'] else None,
+        states=tuple(sorted(states)),
+        categories=tuple(sorted(categories)),
+    )
+
+# Every rerun's timing spans are appended here; summarize with `python -m analytics perf`
+PERF_LOG = os.path.join(cache_dir(), perf.LOG_NAME)
+
+# DASHBOARD_PRELOAD=1 loads every table, fact table and index as soon as the server is first used,
+# instead of when a page first needs it
+PRELOAD = os.environ.get('DASHBOARD_PRELOAD', '0') not in ('', '0')
+
+BRAZIL_CENTER = [-14.2350, -51.9253]
+MAP_HEIGHT = 700
+
+def city_points(cities, value, label):
+    # The lat/lng/value/label columns render_point_map draws
+    return pd.DataFrame({
+        'lat': cities['geolocation_lat'],
+        'lng': cities['geolocation_lng'],
+        'value': value,
+        'label': label,
+    })
+
+# One GeoJSON layer for all the points, coloured in bulk. st.cache_data hashes `points`, so the
+# map is rendered once per distinct data and reruns reuse its HTML instead of rebuilding it
+@st.cache_data(max_entries=16, show_spinner=False)
+@perf.traced()
+def render_point_map(points, colors, caption, vmin=None, vmax=None):
+    import folium
+    import branca.colormap as cm
+
+    # Nothing to draw; draw_map says so instead
+    if points.empty:
+        return None
+
+    # Filters can leave one city or none, where the values alone give no usable range
+    value_min, value_max = spatial.value_range(points['value'])
+    vmin = value_min if vmin is None else vmin
+    vmax = vmax if vmax is not None and vmax > vmin else max(value_max, vmin + 1)
+    colormap = cm.LinearColormap(colors=list(colors), vmin=vmin, vmax=vmax)
+    colormap.caption = caption
+    layer = spatial.points_to_geojson(points, spatial.value_colors(points['value'], colormap))
+    point_map = folium.Map(location=BRAZIL_CENTER, zoom_start=4)
+    folium.GeoJson(
+        layer,
+        marker=folium.CircleMarker(radius=5, fill=True, fill_opacity=0.8, weight=1),
+        style_function=lambda feature: {
+            'color': feature['properties']['color'],
+            'fillColor': feature['properties']['color']
+        },
+        tooltip=folium.GeoJsonTooltip(fields=['label'], labels=False)
+    ).add_to(point_map)
+    point_map.add_child(colormap)
+    return point_map.get_root().render()
+
+# The city maps, built in the background from the same loaders as the page data
+
+def orders_map(version, filters):
+    geo_index = load_page_item(version, filters, 'geo_index')
+    # Every city with known coordinates, on a log scale so the largest cities do not wash out the rest
+    city_orders = geo_index.with_city_coordinates(load_page_item(version, filters, 'city_stats').reset_index(), 'customer_city')
+    order_points = city_points(
+        city_orders,
+        np.log10(city_orders['order_count']),
+        city_orders['customer_city'] + ': ' + city_orders['order_count'].astype(str) + ' orders'
+    )
+    return render_point_map(order_points, ('orange', 'green'), 'Orders per City (log10)'), len(order_points)
+
+# What the delivery map can show: column of city_delivery_percentiles, legend caption and tooltip format
+DELIVERY_MAP_METRICS = {
+    "Average": ('mean_days', 'Average Delivery Time (days)', '{:.2f} days'),
+    "Median": ('p50_days', 'Median Delivery Time (days)', '{:.1f} days median'),
+    "90th percentile": ('p90_days', '90th Percentile of Delivery Time (days)', '{:.1f} days at the 90th percentile'),
+    "99th percentile": ('p99_days', '99th Percentile of Delivery Time (days)', '{:.1f} days at the 99th percentile'),
+    "Late rate": ('late_rate', 'Share of Orders Delivered Late', '{:.0%} delivered late'),
+}
+
+def delivery_map(version, filters, metric="Average"):
+    column, caption, label = DELIVERY_MAP_METRICS[metric]
+    geo_index = load_page_item(version, filters, 'geo_index')
+    city_delivery = load_page_item(version, filters, 'city_delivery_percentiles').dropna(subset=[column])
+
+    # Add the average coordinates of each city, dropping cities without any
+    city_delivery = geo_index.with_city_coordinates(city_delivery, 'customer_city')
+    delivery_points = city_points(
+        city_delivery,
+        city_delivery[column],
+        city_delivery['customer_city'] + ': ' + city_delivery[column].map(label.format)
+    )
+
+    # The scale stops at the 95th percentile so a few extreme cities do not wash out the rest
+    return render_point_map(delivery_points, ('yellow', 'red'), caption,
+                            vmax=delivery_points['value'].quantile(0.95))
+
+def rating_map(version, filters):
+    geo_index = load_page_item(version, filters, 'geo_index')
+    city_reviews = load_page_item(version, filters, 'worst_rated_cities')
+
+    # Average review score for each city with at least 5 ratings
+    city_avg_ratings = city_reviews[['city', 'avg_score']].rename(columns={'city': 'customer_city', 'avg_score': 'review_score'})
+
+    # Add the average coordinates of each city, dropping cities without any
+    city_avg_ratings = geo_index.with_city_coordinates(city_avg_ratings, 'customer_city')
+    rating_points = city_points(
+        city_avg_ratings,
+        city_avg_ratings['review_score'],
+        city_avg_ratings['customer_city'] + ': ' + city_avg_ratings['review_score'].map('{:.2f}'.format) + ' average rating'
+    )
+    return render_point_map(rating_points, ('red', 'yellow'), 'Average Review Score')
+
+def draw_map(html):
+    if html is None:
+        st.info("No orders match the filters")
+    else:
+        components.html(html, height=MAP_HEIGHT)
+
+def has_rows(df):
+    # A narrow filter can leave a chart without data; say so in its place
+    if len(df):
+        return True
+    st.info("No orders match the filters")
+    return False
 
 with open('.streamlit/style.css') as f:
     st.write(f"<style>{f.read()}</style>", unsafe_allow_html=True)
@@ -117,16 +364,16 @@ with st.sidebar:
          "🚚 Delivery Analysis",
          "⭐ Customer Reviews",
          "📦 Product Analysis",
-         "💳 Payment Analysis"],
+         "💳 Payment Analysis",
+         "👥 Customer Segments"],
         styles = {
             "menu-title" : {"font-size": "20px"},
             "nav-link": {"font-size": "14px", "text-align": "left", "margin":"0px", "--hover-color": "#6082B6",
         }}
     )
 
-# Add disclaimer for Customer Distribution page
-if page == "🌍 Customer Distribution":
-    st.sidebar.warning("Note: Loading the Customer Distribution page may take a while due to extensive use of folium for mapping and visualization.")
+# Time everything from here on; the rerun is logged once the page is drawn
+perf.start_run(page)
 
 # Add credits to the bottom right corner
 st.markdown(
@@ -150,8 +397,22 @@ st.markdown(
     unsafe_allow_html=True
 )
 
+# Load data
+try:
+    filters = sidebar_filters()
+    # Without any matching order every page would be empty, so its data is not loaded at all
+    has_orders = not cube.is_active(filters) or load_order_count(data_version(), filters) > 0
+    data = load_page_data(page, filters) if has_orders else None
+except FileNotFoundError as e:
+    missing_file = str(e).split("'")[1]
+    st.error(f'File not found: {missing_file}. Please ensure all dataset files are in the "Data" directory of this script.')
+    st.stop()
+
+if not has_orders:
+    st.info("No orders match the filters")
+
 # Overview Page
-if page == "🏠 Overview":
+elif page == "🏠 Overview":
     st.title("E-Commerce Analysis Dashboard")
     st.markdown("""
     This dashboard provides insights into various aspects of the brazillian e-commerce business:
@@ -160,23 +421,25 @@ if page == "🏠 Overview":
     * ⭐ Customer Reviews
     * 📦 Product Analysis
     * 💳 Payment Methods
+    * 👥 Customer Segments
     """)
     
     st.markdown("Use the navigation bar on the left to explore different aspects of the e-commerce data.")
     # Key Metrics
     col1, col2, col3, col4, col5 = st.columns(5)
+    metrics = data['overview_metrics'].iloc[0]
     
     with col1:
-        st.metric("Total Customers", customers_df["customer_unique_id"].nunique())
+        st.metric("Total Customers", int(metrics['total_customers']))
     with col2:
-        st.metric("Total Orders", orders_df["order_id"].nunique())
+        st.metric("Total Orders", int(metrics['total_orders']))
     with col3:
-        st.metric("Total Products", products_df["product_id"].nunique())
+        st.metric("Total Products", int(metrics['total_products']))
     with col4:
-        st.metric("Average Rating", f"{order_reviews_df['review_score'].mean():.2f}")
+        st.metric("Average Rating", f"{metrics['average_rating']:.2f}")
     with col5:
         st.metric("Average Order Value", 
-                 f"${order_payment_df['payment_value'].mean():.2f}")
+                 f"${metrics['average_order_value']:.2f}")
 
     # Button to show profile of the maker
     with st.popover("About the Maker"):
@@ -207,6 +470,10 @@ if page == "🏠 Overview":
         
 # Customer Distribution Page
 elif page == "🌍 Customer Distribution":
+    import folium
+    import branca.colormap as cm
+    from streamlit_folium import st_folium
+
     st.title("Customer Distribution Analysis")
     st.image(".streamlit/Border_H.png", use_column_width=True)
     st.subheader(" Q. Where are the majority of our customers located in and Which city has the highest and lowest number of orders?")
@@ -215,73 +482,70 @@ elif page == "🌍 Customer Distribution":
     st.markdown("Lets answer the first question by visualizing the customer distribution in a map")
     st.markdown("")
     
-    with st.container(border=True):
-        # Customer Location Map
-        st.markdown("#### Customer Distribution Map")
-        st.markdown("")
-
-        # Display prerendered customer distribution map
-        st.image(".streamlit/Prerendered_Customer_Map.JPG", use_column_width=True, caption="This map is pre-rendered due to folium and st.map crashing the app when rendering with all customer locations.")
+    # A fragment: moving the slider redraws only this section, not the whole page
+    @st.fragment
+    @timed_fragment
+    def customer_map_section(customer_grid):
+        with st.container(border=True), perf.span("Customer Distribution Map"):
+            # Customer Location Map
+            st.markdown("#### Customer Distribution Map")
+            st.markdown("")
+
+            # Customers are binned into grid cells on the server, so the browser only draws the cells
+            zoom = st.select_slider(
+                "Grid cell size",
+                options=spatial.ZOOM_LEVELS,
+                value=5,
+                format_func=lambda level: f"~{spatial.cell_size_for_zoom(level) * 111:.0f} km"
+            )
+            cells = customer_grid[zoom]
+            if not has_rows(cells):
+                return
+
+            # Color cells on a log scale so the dense southeast does not wash out the rest
+            log_counts = np.log10(cells['count'])
+            vmin, vmax = spatial.value_range(log_counts)
+            colormap = cm.LinearColormap(colors=['yellow', 'orange', 'red'], vmin=vmin, vmax=vmax)
+            colormap.caption = 'Customers per Cell (log10)'
+            colors = spatial.value_colors(log_counts, colormap)
+
+            customer_map = folium.Map(location=BRAZIL_CENTER, zoom_start=4)
+            folium.GeoJson(
+                spatial.cells_to_geojson(cells, spatial.cell_size_for_zoom(zoom), colors),
+                style_function=lambda feature: {
+                    'fillColor': feature['properties']['color'],
+                    'weight': 0,
+                    'fillOpacity': 0.7
+                },
+                tooltip=folium.GeoJsonTooltip(fields=['count'], aliases=['Customers'])
+            ).add_to(customer_map)
+            customer_map.add_child(colormap)
+            st_folium(customer_map, width='100%', returned_objects=[])
+            st.caption(f"{cells['count'].sum():,} customers aggregated into {len(cells):,} grid cells")
         
-        st.markdown("The map shows the distribution of customers across Brazil, with the highest concentration of customers in the southeast region, particularly around the city of Sao Paulo. The northeastern and northern regions have fewer customers, indicating potential areas for growth and expansion.")
+            st.markdown("The map shows the distribution of customers across Brazil, with the highest concentration of customers in the southeast region, particularly around the city of Sao Paulo. The northeastern and northern regions have fewer customers, indicating potential areas for growth and expansion.")
+
+    customer_map_section(data['customer_grid'])
         
-    st.markdown("Now, lets answer the second question by visualizing 15 city with the highest and lowest number of orders") 
+    st.markdown("Now, lets answer the second question by visualizing the number of orders of every city") 
     st.markdown("")
     
-    with st.container(border = True):
-        st.markdown("#### Top 15 Cities with the Highest and Lowest Number of Orders")
-        # Merge orders_df with customers_df to include customer_city
-        orders_with_city_df = pd.merge(orders_df, customers_df[['customer_id', 'customer_city']], on='customer_id')
-
-        # Aggregate the number of orders in each city
-        city_order_counts = orders_with_city_df.groupby('customer_city').size().reset_index(name='order_count')
-
-        # Sort the cities by order count
-        sorted_city_order_counts = city_order_counts.sort_values(by='order_count', ascending=False)
-
-        # Select the top 15 and bottom 15 cities
-        top_15_cities = sorted_city_order_counts.head(15)
-        bottom_15_cities = sorted_city_order_counts.tail(15)
-        
-        # Create a Folium map centered around Brazil
-        map_center = [-14.2350, -51.9253]  # Coordinates of Brazil
-        city_order_map = folium.Map(location=map_center, zoom_start=4)
-
-        # Add top 15 cities to the map with green markers
-        for idx, row in top_15_cities.iterrows():
-            city_data = geolocation_df[geolocation_df['geolocation_city'] == row['customer_city']]
-            if not city_data.empty:
-                city_data = city_data.iloc[0]
-                folium.CircleMarker(
-                    location=[city_data['geolocation_lat'], city_data['geolocation_lng']],
-                    radius=10,
-                    color='green',
-                    fill=True,
-                    fill_color='green',
-                    popup=f"{row['customer_city']}: {row['order_count']} orders"
-                ).add_to(city_order_map)
-
-        # Add bottom 15 cities to the map with orange markers
-        for idx, row in bottom_15_cities.iterrows():
-            city_data = geolocation_df[geolocation_df['geolocation_city'] == row['customer_city']]
-            if not city_data.empty:
-                city_data = city_data.iloc[0]
-                folium.CircleMarker(
-                    location=[city_data['geolocation_lat'], city_data['geolocation_lng']],
-                    radius=10,
-                    color='orange',
-                    fill=True,
-                    fill_color='orange',
-                    popup=f"{row['customer_city']}: {row['order_count']} orders"
-                ).add_to(city_order_map)
+    with st.container(border = True), perf.span("Number of Orders in Every City"):
+        st.markdown("#### Number of Orders in Every City")
 
         # Display the map
         st.markdown("City with high number of orders are marked in green, while city with low number of orders are marked in orange")
-        st_folium(city_order_map, width='100%')
+        def draw_orders_map(result):
+            html, city_count = result
+            draw_map(html)
+            st.caption(f"{city_count:,} cities")
+        defer("Number of Orders in Every City (map)", data.background(orders_map), draw_orders_map)
         st.markdown("Again, the areas with the highest number of orders are concentrated in the southeast of Brazil, around the city of Sao Paulo. On the other hand, the areas with the lowest number of orders are in the northeast of Brazil and the outskirts of large cities, which need more attention and infrastructure support to grow the number of orders from these areas.")
 
 # Delivery Analysis Page
 elif page == "🚚 Delivery Analysis":
+    import plotly.express as px
+
     st.title("Delivery Time Analysis")
     st.image(".streamlit/Border_H.png", use_column_width=True)
     st.subheader(" Q. Which city experiences the longest delivery times, and which areas might benefit from infrastructure improvements?")
@@ -289,97 +553,131 @@ elif page == "🚚 Delivery Analysis":
     st.markdown("")
     st.markdown("Before answering the question, Lets see the distribution of delivery time first")
     
-    with st.container(border = True):
-        # Calculate delivery times
-        orders_df['delivery_time'] = (orders_df['order_delivered_customer_date'].astype('datetime64[ns]') - 
-                                    orders_df['order_purchase_timestamp'].astype('datetime64[ns]')).dt.days
-        
+    # Mean and spread from the cube's sums and sums of squares
+    mean_delivery_time, std_delivery_time = data['delivery_summary']
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric("Average Delivery Time", f"{mean_delivery_time:.1f} days")
+    with col2:
+        st.metric("Standard Deviation", f"{std_delivery_time:.1f} days")
+
+    with st.container(border = True), perf.span("Distribution of Delivery Times (Days)"):
         # Distribution of delivery times
         st.markdown("#### Distribution of Delivery Times (Days)")
-        fig = px.histogram(orders_df[orders_df['delivery_time'].between(0, 180)],
-                        x='delivery_time',
-                        nbins=180,
-                        labels={'delivery_time': 'Delivery Time (Days)'})
-        st.plotly_chart(fig)
+        # Binned per day on the server, so the chart gets 181 counts instead of every order
+        delivery_histogram = data['delivery_time_histogram'].query('count > 0')
+        if has_rows(delivery_histogram):
+            fig = px.bar(x=(delivery_histogram['bin_start'] + delivery_histogram['bin_end']) / 2,
+                            y=delivery_histogram['count'],
+                            labels={'x': 'Delivery Time (Days)', 'y': 'count'})
+            fig.update_layout(bargap=0)
+            st.plotly_chart(fig)
         st.markdown("As we can see, most deliveries are made within 10 days, with a few outliers taking up to 30 days. However, some cities may experience longer delivery times that reached 180 days due to infrastructure issues or seller location.")
     
     st.markdown("")
     st.markdown("Now, lets see the cities with the longest average delivery times in a map")
     st.markdown("")
     
-    with st.container(border = True):
-        st.markdown("#### 30 Cities with Longest Average Delivery Times")
-        # Calculate delivery time in days
-        orders_with_city_df = pd.merge(orders_df, customers_df[['customer_id', 'customer_city']], on='customer_id')
-        orders_with_city_df['delivery_time_days'] = (orders_with_city_df['order_delivered_customer_date'] - orders_with_city_df['order_purchase_timestamp']).dt.days
-
-        # Aggregate the average delivery time for each city
-        city_delivery_times = orders_with_city_df.groupby('customer_city')['delivery_time_days'].mean().reset_index()
-
-        # Calculate the average latitude and longitude for each city
-        city_avg_coords = geolocation_df.groupby('geolocation_city').agg({
-            'geolocation_lat': 'mean',
-            'geolocation_lng': 'mean'
-        }).reset_index()
-
-        # Merge the average coordinates with the city delivery times
-        city_delivery_times = pd.merge(city_delivery_times, city_avg_coords, left_on='customer_city', right_on='geolocation_city')
-
-        # Drop the old latitude and longitude columns and rename the new ones
-        city_delivery_times.drop(columns=['geolocation_city'], inplace=True)
-        city_delivery_times.rename(columns={'geolocation_lat': 'geolocation_lat', 'geolocation_lng': 'geolocation_lng'}, inplace=True)
-
-        # Filter to only choose the top 15 cities with the longest delivery time
-        city_delivery_times = city_delivery_times.nlargest(30, 'delivery_time_days')
-
-        # Create a Folium map centered around Brazil
-        map_center = [-14.2350, -51.9253]  # Coordinates of Brazil
-        delivery_time_map = folium.Map(location=map_center, zoom_start=4)
-
-        # Create a color map
-        colormap = cm.LinearColormap(colors=['yellow', 'red'], vmin=city_delivery_times['delivery_time_days'].min(), vmax=city_delivery_times['delivery_time_days'].max())
-        colormap.caption = 'Average Delivery Time (days)'
-
-        # Add city delivery times to the map with gradient markers
-        for idx, row in city_delivery_times.iterrows():
-            folium.CircleMarker(
-                location=[row['geolocation_lat'], row['geolocation_lng']],
-                radius=10,
-                color=colormap(row['delivery_time_days']),
-                fill=True,
-                fill_color=colormap(row['delivery_time_days']),
-                popup=f"{row['customer_city']}: {row['delivery_time_days']:.2f} days"
-            ).add_to(delivery_time_map)
-            
-        # Add the colormap to the map
-        delivery_time_map.add_child(colormap)
-        
-        st_folium(delivery_time_map, width='100%')
-        st.markdown("From the map showing areas with its average delivery time, it can be seen that the eastern coast, northeastern, and inland areas of Brazil experience high average delivery time. If infrastructure is to be built or evaluated, the eastern coast between the cities of Salvador and Fortaleza would benefit greatly because the number of cases of delays and their severity occur around these two cities.")
+    # A fragment: picking another metric redraws only the map
+    @st.fragment
+    @timed_fragment
+    def delivery_map_section():
+        with st.container(border = True), perf.span("Delivery Time of Every City"):
+            st.markdown("#### Delivery Time of Every City")
+            metric = st.radio("Map metric", list(DELIVERY_MAP_METRICS), horizontal=True)
+            defer("Delivery Time of Every City (map)", data.background(delivery_map, metric), draw_map)
+            st.markdown("From the map showing areas with its average delivery time, it can be seen that the eastern coast, northeastern, and inland areas of Brazil experience high average delivery time. If infrastructure is to be built or evaluated, the eastern coast between the cities of Salvador and Fortaleza would benefit greatly because the number of cases of delays and their severity occur around these two cities.")
+            st.markdown("An average can be pulled up by a single very late order in a small city. The median shows the typical delivery, the 90th and 99th percentiles show how long the slowest deliveries take, and the late rate shows how often the estimated delivery date was missed.")
+            if page_drawn:
+                fill_deferred()
+
+    delivery_map_section()
     
     st.markdown("")
     st.markdown("How about specific cities with the longest average delivery times? Lets see it in a bar chart") 
     st.markdown("")
     
-    with st.container(border = True):
+    with st.container(border = True), perf.span("Top 10 Cities with Longest Average Delivery Times"):
         # Cities with longest delivery times
         st.markdown("#### Top 10 Cities with Longest Average Delivery Times")
         
-        orders_with_city = pd.merge(orders_df, customers_df[['customer_id', 'customer_city']], on='customer_id')
-        avg_delivery_times = orders_with_city.groupby('customer_city')['delivery_time'].mean()
+        # Average delivery time for each city
+        avg_delivery_times = data['city_delivery_times'].set_index('customer_city')['delivery_time_days']
         longest_delivery_times = avg_delivery_times.nlargest(10)
         
-        fig = px.bar(
-            x=longest_delivery_times.index, 
-            y=longest_delivery_times.values,
-            labels={'x': 'City', 'y': 'Average Delivery Time (Days)'},
-            color_discrete_sequence=['orange'] * len(longest_delivery_times)
-        )
-        st.plotly_chart(fig)
+        if has_rows(longest_delivery_times):
+            fig = px.bar(
+                x=longest_delivery_times.index, 
+                y=longest_delivery_times.values,
+                labels={'x': 'City', 'y': 'Average Delivery Time (Days)'},
+                color_discrete_sequence=['orange']
+            )
+            st.plotly_chart(fig)
         st.markdown("From the bar chart shown, it can be seen that the longest average delivery time is in the city of Novo Brasil and followed by the cities of Capinzal Do Norte and Adhemar De Barros. These cities are recommended to be evaluated and given infrastructure support to make the delivery of goods more efficient.")
 
+    st.markdown("")
+    st.markdown("Lets look at the whole distribution of delivery times in every city and state, not just the average")
+    st.markdown("")
+
+    @st.fragment
+    @timed_fragment
+    def delivery_percentiles_section():
+        with st.container(border = True), perf.span("Delivery Time Percentiles"):
+            st.markdown("#### Delivery Time Percentiles")
+            level = st.radio("Group by", ["City", "State"], horizontal=True)
+            percentiles = data['city_delivery_percentiles' if level == "City" else 'state_delivery_percentiles']
+            st.dataframe(
+                percentiles.assign(late_rate=percentiles['late_rate'] * 100),
+                hide_index=True,
+                column_config={
+                    'customer_city': 'City',
+                    'customer_state': 'State',
+                    'order_count': st.column_config.NumberColumn('Orders'),
+                    'delivered_count': st.column_config.NumberColumn('Delivered'),
+                    'p50_days': st.column_config.NumberColumn('Median (days)', format='%.1f'),
+                    'p90_days': st.column_config.NumberColumn('90th Percentile (days)', format='%.1f'),
+                    'p99_days': st.column_config.NumberColumn('99th Percentile (days)', format='%.1f'),
+                    'mean_days': st.column_config.NumberColumn('Average (days)', format='%.1f'),
+                    'late_rate': st.column_config.NumberColumn('Delivered Late', format='%.1f%%'),
+                },
+            )
+            st.markdown("Click a column header to sort. Percentiles of cities with only a few delivered orders are as unreliable as their averages, so check the Delivered column before drawing conclusions.")
+
+    delivery_percentiles_section()
+
+    st.markdown("")
+    st.markdown("Is it the infrastructure, or do the goods simply travel further? Lets compare the delivery time with the distance from seller to customer in each state")
+    st.markdown("")
+
+    with st.container(border = True), perf.span("Delivery Time vs Distance by State"):
+        st.markdown("#### Delivery Time vs Distance by State")
+        state_distances = data['state_delivery_distances'].dropna(subset=['distance_km', 'delivery_days'])
+
+        if has_rows(state_distances):
+            fig = px.scatter(
+                state_distances,
+                x='distance_km',
+                y='delivery_days',
+                size='item_count',
+                text='customer_state',
+                hover_data={'nearest_seller_km': ':.0f', 'distance_km': ':.0f', 'delivery_days': ':.1f'},
+                labels={
+                    'distance_km': 'Average Seller-to-Customer Distance (km)',
+                    'delivery_days': 'Average Delivery Time (Days)',
+                    'item_count': 'Items',
+                    'nearest_seller_km': 'Nearest Seller (km)',
+                    'customer_state': 'State',
+                },
+                color_discrete_sequence=['orange'],
+            )
+            fig.update_traces(textposition='top center')
+            st.plotly_chart(fig)
+        st.markdown("Distances are measured in a straight line between the seller's and the customer's zip code areas. States far above the others at the same distance are slow for reasons other than distance, while the nearest-seller distance (in the tooltip) shows how far their customers are from any seller at all.")
+
 # Customer Reviews Page
 elif page == "⭐ Customer Reviews":
+    import plotly.express as px
+
     st.title("Customer Reviews Analysis")
     st.image(".streamlit/Border_H.png", use_column_width=True)
     st.subheader(" Q. Which cities have lowest review scores, indicating a need for service evaluation in those areas?")
@@ -387,79 +685,27 @@ elif page == "⭐ Customer Reviews":
     st.markdown("")
     st.markdown("Before answering the question, Lets see the distribution of review scores first")
         
-    with st.container(border = True):
+    with st.container(border = True), perf.span("Distribution of Review Scores"):
         # Overall rating distribution
         st.markdown("#### Distribution of Review Scores")
-        review_dist = order_reviews_df['review_score'].value_counts().sort_index()
-        fig = px.bar(x=review_dist.index, 
-             y=review_dist.values,
-             labels={'x': 'Review Score', 'y': 'Count'},
-             color_discrete_sequence=['blue'] * len(review_dist))
-        st.plotly_chart(fig)
+        review_dist = data['review_score_distribution']
+        if has_rows(review_dist):
+            fig = px.bar(x=review_dist['review_score'], 
+                 y=review_dist['count'],
+                 labels={'x': 'Review Score', 'y': 'Count'},
+                 color_discrete_sequence=['blue'])
+            st.plotly_chart(fig)
         st.markdown("Rating 5 is the most common rating, signifying that most customers are satisfied with their purchases. But, does that can represent all cities?")
     
     st.markdown("")
     st.markdown("Now, lets see the cities with lowest average review scores in a map")
     st.markdown("")
     
-    with st.container(border = True):
-        st.markdown("#### 30 Cities with Lowest Average Review Scores")
-        
-        # Calculate the average latitude and longitude for each city
-        city_avg_coords = geolocation_df.groupby('geolocation_city').agg({
-            'geolocation_lat': 'mean',
-            'geolocation_lng': 'mean'
-        }).reset_index()
-
-        # Merge order_reviews_df with orders_df to get customer_id and customer_city
-        reviews_with_city_df = pd.merge(order_reviews_df, orders_df[['order_id', 'customer_id']], on='order_id')
-        reviews_with_city_df = pd.merge(reviews_with_city_df, customers_df[['customer_id', 'customer_city']], on='customer_id')
-
-        # Calculate the number of ratings for each city
-        city_rating_counts = reviews_with_city_df.groupby('customer_city').size().reset_index(name='rating_count')
-
-        # Filter cities with at least 5 ratings
-        cities_with_min_ratings = city_rating_counts[city_rating_counts['rating_count'] >= 5]['customer_city']
-
-        # Filter reviews_with_city_df to include only cities with at least 5 ratings
-        filtered_reviews_with_city_df = reviews_with_city_df[reviews_with_city_df['customer_city'].isin(cities_with_min_ratings)]
-
-        # Calculate the average review score for each city
-        city_avg_ratings = filtered_reviews_with_city_df.groupby('customer_city')['review_score'].mean().reset_index()
-
-        # Sort the cities by average review score in ascending order
-        sorted_city_avg_ratings = city_avg_ratings.sort_values(by='review_score')
-
-        # Select the bottom 20 cities with the worst average rating
-        bottom_30_cities_ratings = sorted_city_avg_ratings.head(30)
-
-        # Merge with city_avg_coords to get the coordinates for each city
-        bottom_30_cities_ratings = pd.merge(bottom_30_cities_ratings, city_avg_coords, left_on='customer_city', right_on='geolocation_city')
-        
-        # Create a Folium map centered around Brazil
-        map_center = [-14.2350, -51.9253]  # Coordinates of Brazil
-        rating_map = folium.Map(location=map_center, zoom_start=4)
-
-        # Create a color map
-        colormap = cm.LinearColormap(colors=['red', 'yellow'], vmin=bottom_30_cities_ratings['review_score'].min(), vmax=bottom_30_cities_ratings['review_score'].max())
-        colormap.caption = 'Average Review Score'
-
-        # Add city average ratings to the map with gradient markers
-        for idx, row in bottom_30_cities_ratings.iterrows():
-            folium.CircleMarker(
-                location=[row['geolocation_lat'], row['geolocation_lng']],
-                radius=10,
-                color=colormap(row['review_score']),
-                fill=True,
-                fill_color=colormap(row['review_score']),
-                popup=f"{row['customer_city']}: {row['review_score']:.2f} average rating"
-            ).add_to(rating_map)
-
-        # Add the colormap to the map
-        rating_map.add_child(colormap)
+    with st.container(border = True), perf.span("Average Review Score of Every City (Minimum 5 Reviews)"):
+        st.markdown("#### Average Review Score of Every City (Minimum 5 Reviews)")
 
         # Display the map
-        st_folium(rating_map, width='100%')
+        defer("Average Review Score of Every City (map)", data.background(rating_map), draw_map)
         
         st.markdown("This map illustrates cities with the worst average scores are dominated by cities located in the southeastern and western coastal areas. Interestingly, only a few cities in central and northeastern Brazil have low average scores despite minimal infrastructure and sellers.")
         
@@ -467,37 +713,67 @@ elif page == "⭐ Customer Reviews":
     st.markdown("Now lets focus on the top 10 cities with lowest average review scores, which city is it?")
     st.markdown("")
     
-    with st.container(border = True):
+    with st.container(border = True), perf.span("10 Cities with Lowest Average Review Scores (Minimum 5 Reviews)"):
         # Cities with lowest average reviews
         st.markdown("#### 10 Cities with Lowest Average Review Scores (Minimum 5 Reviews)")
         
-        reviews_with_city = pd.merge(
-            order_reviews_df,
-            pd.merge(orders_df[['order_id', 'customer_id']], 
-                    customers_df[['customer_id', 'customer_city']], 
-                    on='customer_id'),
-            on='order_id'
-        )
-        
-        city_reviews = reviews_with_city.groupby('customer_city').agg({
-            'review_score': ['mean', 'count']
-        }).reset_index()
-        
-        city_reviews.columns = ['city', 'avg_score', 'review_count']
-        city_reviews = city_reviews[city_reviews['review_count'] >= 5]
+        # Average score of each city with at least 5 reviews, counting every review
+        city_reviews = data['worst_rated_cities']
         worst_reviewed_cities = city_reviews.nsmallest(10, 'avg_score')
         
-        fig = px.bar(worst_reviewed_cities,
-                x='city',
-                y='avg_score',
-                labels={'city': 'City', 'avg_score': 'Average Review Score'},
-                color_discrete_sequence=['orange'] * len(worst_reviewed_cities))
-        st.plotly_chart(fig)
+        if has_rows(worst_reviewed_cities):
+            fig = px.bar(worst_reviewed_cities,
+                    x='city',
+                    y='avg_score',
+                    labels={'city': 'City', 'avg_score': 'Average Review Score'},
+                    color_discrete_sequence=['orange'])
+            st.plotly_chart(fig)
         
         st.markdown("The bar chart highlights the 10 cities with the lowest average customer ratings, with Prudente De Morais, Abelardo Luz, and Iguaba Grande at the bottom. These cities may face recurring issues affecting customer satisfaction, suggesting areas for targeted service improvements. Addressing specific concerns in these locations could help boost overall customer ratings.")
 
+    st.markdown("")
+    st.markdown("Scores show where customers are unhappy, their comments show why. Lets search what they wrote")
+    st.markdown("")
+
+    # A fragment: typing a search or picking a filter reruns only this section
+    @st.fragment
+    @timed_fragment
+    def review_search_section():
+        with st.container(border = True), perf.span("Search Review Comments"):
+            st.markdown("#### Search Review Comments")
+            dataset = load_dataset(data.version)
+            query = st.text_input("Words to search for", placeholder="atraso, não recebi, defeito*")
+            col1, col2 = st.columns(2)
+            with col1:
+                scores = st.multiselect("Review score", [1, 2, 3, 4, 5])
+            with col2:
+                cities = st.multiselect("City", dataset.review_index.cities)
+            # Answered from the inverted index built when the data was loaded
+            with perf.span("search reviews") as record:
+                matches = dataset.search_reviews(query, scores, cities, data.filters)
+                record['rows_out'] = len(matches)
+            st.markdown(f"**{len(matches):,}** reviews found, newest first")
+            st.dataframe(
+                matches.nlargest(500, 'review_creation_date')[
+                    ['review_creation_date', 'review_score', 'customer_city', 'review_comment_title', 'review_comment_message']
+                ],
+                hide_index=True,
+                column_config={
+                    'review_creation_date': st.column_config.DateColumn('Date'),
+                    'review_score': st.column_config.NumberColumn('Score'),
+                    'customer_city': 'City',
+                    'review_comment_title': 'Title',
+                    'review_comment_message': 'Message',
+                },
+            )
+            st.markdown("Accents and capitals are ignored, so atraso also finds Atrasó. A word ending in * matches every word that starts with it, for example receb* finds recebi and recebido. Only the 500 newest matches are listed.")
+
+    review_search_section()
+
 # Product Analysis Page
 elif page == "📦 Product Analysis":
+    import plotly.express as px
+
     st.title("Product Analysis")
     st.image(".streamlit/Border_H.png", use_column_width=True)
     st.subheader(" Q. Which product categories have the highest and lowest sales?")
@@ -505,23 +781,19 @@ elif page == "📦 Product Analysis":
     st.markdown("")
     st.markdown("Lets see the most popular product categories by number of orders")
     
-    # Merge product data
-    products_with_category = pd.merge(
-        order_items_df,
-        pd.merge(products_df, product_category_trans_df, on='product_category_name'),
-        on='product_id'
-    )
+    category_order_counts = data['category_order_counts'].set_index('product_category_name_english')['order_count']
         
-    with st.container(border = True):
+    with st.container(border = True), perf.span("Top 10 Product Categories by Number of Orders"):
         # Top product categories
         st.markdown("#### Top 10 Product Categories by Number of Orders")
         
-        category_orders = products_with_category['product_category_name_english'].value_counts().head(10)
-        fig = px.bar(x=category_orders.index,
-            y=category_orders.values,
-            labels={'x': 'Category', 'y': 'Number of Orders'},
-            color_discrete_sequence=['green'] * len(category_orders))
-        st.plotly_chart(fig)
+        category_orders = category_order_counts.head(10)
+        if has_rows(category_orders):
+            fig = px.bar(x=category_orders.index,
+                y=category_orders.values,
+                labels={'x': 'Category', 'y': 'Number of Orders'},
+                color_discrete_sequence=['green'])
+            st.plotly_chart(fig)
         st.markdown('Top 5 Product Categories: The "Bed_Bath_Table" category has the highest number of orders, followed closely by "Health_Beauty," "Sports_Leisure," and "Furniture_Decor." These categories demonstrate higher consumer demand, with "Computers_Accessories" rounding out the top five.')
         st.markdown("if managed properly, these categories could drive significant revenue growth.")
         
@@ -529,37 +801,42 @@ elif page == "📦 Product Analysis":
     st.markdown("Now, lets see the bottom 10 product categories by number of orders")
     st.markdown("")
     
-    with st.container(border = True):
+    with st.container(border = True), perf.span("Bottom 10 Product Categories by Number of Orders"):
         # Bottom product categories
         st.markdown("#### Bottom 10 Product Categories by Number of Orders")
         
-        category_orders = products_with_category['product_category_name_english'].value_counts().tail(10)
-        fig = px.bar(x=category_orders.index,
-            y=category_orders.values,
-            labels={'x': 'Category', 'y': 'Number of Orders'},
-            color_discrete_sequence=['orange'] * len(category_orders))
-        st.plotly_chart(fig)
+        category_orders = category_order_counts.tail(10)
+        if has_rows(category_orders):
+            fig = px.bar(x=category_orders.index,
+                y=category_orders.values,
+                labels={'x': 'Category', 'y': 'Number of Orders'},
+                color_discrete_sequence=['orange'])
+            st.plotly_chart(fig)
         st.markdown('Bottom 5 Product Categories: The "Security_and_Services" category has the lowest number of orders, followed by "Fashion_Children_s_Clothes," "La Cuisine," "CD DVD Musical," and "Art/Craftmanship". These categories may require further evaluation to determine why they have lower demand compared to other categories.')
         st.markdown("Improving product quality, marketing, or pricing strategies could help boost sales in these categories.")
 
 # Payment Analysis Page
 elif page == "💳 Payment Analysis":
+    import plotly.express as px
+
     st.title("Payment Analysis")
     st.image(".streamlit/Border_H.png", use_column_width=True)
     st.subheader(" Q. What are the most common payment methods, and how do they compare in terms of average purchase size?")
     
     st.markdown("")
     st.markdown("Lets see the distribution of payment methods first")
+
+    payment_stats = data['payment_stats']
     
-    with st.container(border = True):
+    with st.container(border = True), perf.span("Distribution of Payment Methods"):
         # Payment method distribution
         st.markdown("#### Distribution of Payment Methods")
         
-        payment_dist = order_payment_df['payment_type'].value_counts()
-        payment_dist = payment_dist[payment_dist > 1000]
-        fig = px.pie(values=payment_dist.values,
-                names=payment_dist.index)
-        st.plotly_chart(fig)
+        payment_dist = aggregates.payment_type_distribution(payment_stats, threshold=1000)
+        if has_rows(payment_dist):
+            fig = px.pie(values=payment_dist.values,
+                    names=payment_dist.index)
+            st.plotly_chart(fig)
         
         st.markdown("The pie chart shows that the most common payment method is credit card, followed by boleto, voucher, and debit card. These payment methods are widely used by customers, indicating a preference for convenience and security.")
     
@@ -567,15 +844,158 @@ elif page == "💳 Payment Analysis":
     st.markdown("Now, lets see the average purchase size by payment method")
     st.markdown("")
     
-    with st.container(border = True):
+    with st.container(border = True), perf.span("Average Purchase Size by Payment Method"):
         # Average purchase size by payment method
         st.subheader("Average Purchase Size by Payment Method")
         
-        avg_purchase = order_payment_df.groupby('payment_type')['payment_value'].mean()
-        avg_purchase = avg_purchase[avg_purchase.index != 'not_defined']
-        fig = px.bar(x=avg_purchase.index,
-                    y=avg_purchase.values,
-                    labels={'x': 'Payment Method', 'y': 'Average Purchase Value ($)'})
-        st.plotly_chart(fig)
+        avg_purchase = aggregates.average_payment_by_type(payment_stats, exclude=['not_defined'])
+        if has_rows(avg_purchase):
+            fig = px.bar(x=avg_purchase.index,
+                        y=avg_purchase.values,
+                        labels={'x': 'Payment Method', 'y': 'Average Purchase Value ($)'})
+            st.plotly_chart(fig)
         
-        st.markdown("The bar chart illustrates the average purchase size for each payment method, with credit card having the highest average purchase value. Boleto and voucher have similar average purchase values, while debit card has the lowest. These insights can help businesses tailor marketing strategies to encourage higher-value purchases and increase revenue.")
\ No newline at end of file
+        st.markdown("The bar chart illustrates the average purchase size for each payment method, with credit card having the highest average purchase value. Boleto and voucher have similar average purchase values, while debit card has the lowest. These insights can help businesses tailor marketing strategies to encourage higher-value purchases and increase revenue.")
+
+# Customer Segments Page
+elif page == "👥 Customer Segments":
+    import plotly.express as px
+
+    st.title("Customer Segments")
+    st.image(".streamlit/Border_H.png", use_column_width=True)
+    st.subheader(" Q. How many customers come back, and which groups of customers are worth keeping or winning back?")
+
+    st.markdown("")
+    st.markdown("Every customer is scored from 1 to 5 on how recently they ordered (recency), how often (frequency) and how much they paid (monetary), then grouped into segments by their recency and frequency scores")
+
+    rfm_segments = data['rfm_segments']
+    rfm_grid = data['rfm_grid']
+    customer_count = rfm_segments['customer_count'].sum()
+    repeat_count = rfm_grid.loc[rfm_grid['f_score'] > 1, 'customer_count'].sum()
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Total Customers", int(customer_count))
+    with col2:
+        st.metric("Repeat Customers", f"{repeat_count / max(customer_count, 1):.1%}")
+    with col3:
+        st.metric("Average Spend per Customer", f"${rfm_segments['revenue'].sum() / max(customer_count, 1):.2f}")
+
+    with st.container(border = True), perf.span("Customers per Segment"):
+        st.markdown("#### Customers per Segment")
+        fig = px.bar(rfm_segments,
+                x='segment',
+                y='customer_count',
+                labels={'segment': 'Segment', 'customer_count': 'Customers'},
+                color_discrete_sequence=['blue'])
+        st.plotly_chart(fig)
+        st.dataframe(rfm_segments, hide_index=True, column_config={
+            'segment': 'Segment',
+            'customer_count': st.column_config.NumberColumn('Customers'),
+            'customer_share': st.column_config.ProgressColumn('Share', format='%.3f', min_value=0, max_value=1),
+            'recency_days': st.column_config.NumberColumn('Days Since Last Order', format='%.0f'),
+            'frequency': st.column_config.NumberColumn('Orders per Customer', format='%.2f'),
+            'monetary': st.column_config.NumberColumn('Average Spend ($)', format='%.2f'),
+            'revenue': st.column_config.NumberColumn('Revenue ($)', format='%.2f'),
+        })
+        st.markdown("Most customers have ordered only once, so they fall into the New Customers, Promising, About To Sleep and Hibernating segments depending on how long ago that order was. The few repeat customers spend about twice as much as one-time customers.")
+
+    st.markdown("")
+    st.markdown("Where do the segments come from? Lets see how many customers have each recency and frequency score")
+    st.markdown("")
+
+    with st.container(border = True), perf.span("Customers by Recency and Frequency Score"):
+        st.markdown("#### Customers by Recency and Frequency Score")
+        grid = rfm_grid.pivot(index='r_score', columns='f_score', values='customer_count').reindex(index=range(1, 6), columns=range(1, 6))
+        fig = px.imshow(grid,
+                labels={'x': 'Frequency Score (orders, 5 = five or more)', 'y': 'Recency Score (5 = most recent)', 'color': 'Customers'},
+                text_auto=True,
+                origin='lower',
+                color_continuous_scale='Blues')
+        st.plotly_chart(fig)
+        st.markdown("Each cell is one recency and frequency score pair. Cells on the right are customers who came back; the higher up they are, the more recently they ordered.")
+
+    st.markdown("")
+    st.markdown("Do customers come back after their first order? Lets follow every monthly cohort of new customers")
+    st.markdown("")
+
+    with st.container(border = True), perf.span("Monthly Cohort Retention"):
+        st.markdown("#### Monthly Cohort Retention")
+        cohort_retention = data['cohort_retention']
+        # Month 0 is always 100%, so the colours start from the first month after
+        returning = cohort_retention[cohort_retention['period'] > 0]
+        matrix = returning.pivot(index='cohort', columns='period', values='retention') * 100
+        matrix.index = matrix.index.strftime('%Y-%m')
+        if has_rows(matrix):
+            fig = px.imshow(matrix,
+                    labels={'x': 'Months Since First Order', 'y': 'First Order Month', 'color': 'Ordering Again (%)'},
+                    aspect='auto',
+                    color_continuous_scale='Blues')
+            st.plotly_chart(fig)
+
+        curve = segments.retention_curve(cohort_retention)
+        fig = px.line(curve.assign(retention=curve['retention'] * 100),
+                x='period',
+                y='retention',
+                markers=True,
+                labels={'period': 'Months Since First Order', 'retention': 'Customers Ordering Again (%)'})
+        st.plotly_chart(fig)
+        st.markdown("Each row is the customers whose first order was in that month, and each column the share of them who ordered again that many months later. The line averages all cohorts old enough to reach each month. Well under 1% of customers order again in any later month, so winning back one-time customers matters more than rewarding loyal ones.")
+
+    st.markdown("")
+    st.markdown("Who exactly is in each segment? Pick one to see its biggest spenders")
+    st.markdown("")
+
+    # A fragment: picking another segment reruns only this section
+    @st.fragment
+    @timed_fragment
+    def segment_explorer():
+        with st.container(border = True), perf.span("Explore a Segment"):
+            st.markdown("#### Explore a Segment")
+            populated = rfm_segments.loc[rfm_segments['customer_count'] > 0, 'segment'].tolist()
+            segment = st.selectbox("Segment", populated)
+            if segment is None:
+                return
+            summary = rfm_segments.set_index('segment').loc[segment]
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Customers", int(summary['customer_count']))
+            with col2:
+                st.metric("Days Since Last Order", f"{summary['recency_days']:.0f}")
+            with col3:
+                st.metric("Average Spend", f"${summary['monetary']:.2f}")
+            customers = load_segment_customers(data.version, data.filters, segment)
+            st.dataframe(customers, hide_index=True,
+                column_order=['customer_unique_id', 'recency_days', 'frequency', 'monetary', 'r_score', 'f_score', 'm_score', 'last_purchase'],
+                column_config={
+                    'customer_unique_id': 'Customer',
+                    'recency_days': st.column_config.NumberColumn('Days Since Last Order'),
+                    'frequency': st.column_config.NumberColumn('Orders'),
+                    'monetary': st.column_config.NumberColumn('Spend ($)', format='%.2f'),
+                    'r_score': st.column_config.NumberColumn('R'),
+                    'f_score': st.column_config.NumberColumn('F'),
+                    'm_score': st.column_config.NumberColumn('M'),
+                    'last_purchase': st.column_config.DatetimeColumn('Last Order', format='YYYY-MM-DD'),
+                })
+            st.markdown("The 100 customers of the segment who spent the most, for example to contact first in a win-back campaign.")
+
+    segment_explorer()
+
+# Maps and other sections computed in the background
+fill_deferred()
+page_drawn = True
+
+# Performance panel with this rerun's timing spans. A fragment, so the toggle redraws only the panel
+@st.fragment
+def performance_panel(rerun):
+    if st.toggle("Show performance", help="Timing of the last full rerun's loaders and page sections"):
+        with st.expander("Performance", expanded=True):
+            st.metric("Rerun", f"{rerun['wall_ms']:.0f} ms", help=f"CPU: {rerun['cpu_ms']:.0f} ms")
+            st.dataframe(perf.spans_frame(rerun), hide_index=True, column_config={
+                'wall_ms': st.column_config.NumberColumn('Wall (ms)', format='%.1f'),
+                'cpu_ms': st.column_config.NumberColumn('CPU (ms)', format='%.1f'),
+                'memory_mb': st.column_config.NumberColumn('Memory (MB)', format='%+.1f'),
+            })
+
+rerun = perf.finish_run(PERF_LOG)
+with st.sidebar:
+    performance_panel(rerun)
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+DASHBOARD_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DASHBOARD_DIR)
+
+from analytics import synthetic  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app_dir(tmp_path_factory):
+    """A folder laid out like Dashboard/, with a small synthetic dataset in Data/."""
+    root = tmp_path_factory.mktemp('app')
+    synthetic.generate(str(root / 'Data'), scale=0.02, seed=0, reference_dir=os.path.join(DASHBOARD_DIR, 'Data'))
+    os.symlink(os.path.join(DASHBOARD_DIR, '.streamlit'), root / '.streamlit')
+    return root
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+import streamlit_option_menu
+from streamlit.testing.v1 import AppTest
+
+from analytics.cube import load_cube
+
+from conftest import DASHBOARD_DIR
+
+SCRIPT = os.path.join(DASHBOARD_DIR, 'ecommerce-dashboard.py')
+
+PAGES = ["🏠 Overview", "🌍 Customer Distribution", "🚚 Delivery Analysis", "⭐ Customer Reviews",
+         "📦 Product Analysis", "💳 Payment Analysis", "👥 Customer Segments"]
+
+
+def open_page(page, app_dir, monkeypatch):
+    # The navigation menu is a custom component AppTest cannot click, so it always returns `page`
+    monkeypatch.chdir(app_dir)
+    monkeypatch.setattr(streamlit_option_menu, 'option_menu', lambda *args, **kwargs: page)
+    at = AppTest.from_file(SCRIPT, default_timeout=120)
+    at.run()
+    assert not at.exception
+    return at
+
+
+def empty_filter(data_dir):
+    """The first purchase day and a state without any order on that day."""
+    cells = load_cube(str(data_dir))
+    first_day = cells['day'].min()
+    ordering = set(cells.loc[(cells['day'] == first_day) & (cells['order_count'] > 0), 'customer_state'])
+    return first_day.date(), sorted(set(cells['customer_state'].dropna()) - ordering)[0]
+
+
+@pytest.mark.parametrize('page', PAGES)
+def test_page_without_matching_orders(page, app_dir, monkeypatch):
+    day, state = empty_filter(app_dir / 'Data')
+    at = open_page(page, app_dir, monkeypatch)
+    at.sidebar.date_input[0].set_value((day, day))
+    at.sidebar.multiselect[0].set_value([state])
+    at.run()
+    assert not at.exception
+    assert [info.value for info in at.info] == ['No orders match the filters']
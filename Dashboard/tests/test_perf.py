@@ -0,0 +1,40 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from analytics import perf
+
+
+@perf.traced('load in background')
+def load():
+    return pd.DataFrame({'value': [1, 2, 3]})
+
+
+def test_background_spans_are_logged_with_the_run(tmp_path):
+    log_path = tmp_path / perf.LOG_NAME
+    perf.start_run('page')
+    with perf.span('section'), ThreadPoolExecutor(1) as pool:
+        assert len(pool.submit(perf.bind(load)).result()) == 3
+        # Unbound work in another thread records nothing
+        pool.submit(load).result()
+        # Concurrent calls keep their own spans together
+        list(pool.map(lambda function: function(), [perf.bind(load, 'first'), perf.bind(load, 'second')]))
+    perf.finish_run(str(log_path))
+
+    [run] = [json.loads(line) for line in log_path.read_text().splitlines()]
+    spans = [(span['name'], span['depth'], span['rows_out']) for span in run['spans']]
+    assert spans == [
+        ('section', 0, None),
+        ('load (background)', 0, 3), ('load in background', 1, 3),
+        ('first (background)', 0, 3), ('load in background', 1, 3),
+        ('second (background)', 0, 3), ('load in background', 1, 3),
+    ]
+
+
+def test_bound_function_leaves_the_worker_without_a_run():
+    perf.start_run('page')
+    with ThreadPoolExecutor(1) as pool:
+        pool.submit(perf.bind(load)).result()
+        assert pool.submit(perf.current_run).result() is None
+    perf.finish_run()